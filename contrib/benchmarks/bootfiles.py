@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Compare cold and warm cache run times of 'pxconf bootfiles'"""
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Time 'pxconf bootfiles' with a cold and a warm cache")
+    parser.add_argument('nodes', type=str, help='Nodes to generate bootfiles for')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='Runs per measurement')
+    parser.add_argument('--pxconf', type=str, default=shutil.which('pxconf') or 'pxconf', help='Path to pxconf')
+    return parser
+
+def run(args, env):
+    start = time.monotonic()
+    subprocess.run([args.pxconf, args.nodes, 'bootfiles'], env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.monotonic() - start
+
+def report(label, times):
+    print("%-6s min %7.3fs  median %7.3fs  max %7.3fs" % (label, min(times), statistics.median(times), max(times)))
+
+def main():
+    args = get_parser().parse_args()
+    env = dict(os.environ)
+    # Keep generated bootfiles out of the real artifact directory
+    artifacts = tempfile.mkdtemp(prefix='pxbench-artifacts')
+    os.mkdir(os.path.join(artifacts, 'bootfiles'))
+    env['PHOENIX_ARTIFACTS'] = artifacts
+
+    cold = list()
+    warm = list()
+    try:
+        for i in range(args.runs):
+            cachedir = tempfile.mkdtemp(prefix='pxbench-cache')
+            env['PHOENIX_CACHE'] = cachedir
+            try:
+                # The first run starts from an empty snapshot and bytecode cache
+                cold.append(run(args, env))
+                warm.append(run(args, env))
+            finally:
+                shutil.rmtree(cachedir)
+    finally:
+        shutil.rmtree(artifacts)
+
+    report('cold', cold)
+    report('warm', warm)
+    print("speedup %.2fx" % (statistics.median(cold) / statistics.median(warm)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
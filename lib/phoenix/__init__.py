@@ -3,6 +3,7 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
 import os
+import stat
 import logging
 import sys
 import resource
@@ -48,6 +49,31 @@ def get_component(category, provider=None, providerclass=None):
     except Exception as e:
         raise ImportError("Could not find class %s (%s)" % (providerclass, e))
 
+def get_bytecode_cache():
+    ''' Returns a Jinja bytecode cache stored under cache_path, or None if
+        that directory can't be used. Entries are checked against the
+        template source, so a stale entry is never used. The cached code
+        is executed, so the directory must only be writable by the user
+        running phoenix.
+    '''
+    from jinja2 import FileSystemBytecodeCache
+    cachedir = os.path.join(cache_path, 'jinja')
+    try:
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+        st = os.lstat(cachedir)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid() or st.st_mode & 0o022:
+            logging.warning("Not using a bytecode cache: %s could be written by other users", cachedir)
+            return None
+        if st.st_mode & 0o077:
+            os.chmod(cachedir, 0o700)
+    except OSError as e:
+        logging.debug("Not using a bytecode cache: %s", e)
+        return None
+    if not os.access(cachedir, os.W_OK):
+        logging.debug("Not using a bytecode cache: %s is not writable", cachedir)
+        return None
+    return FileSystemBytecodeCache(cachedir)
+
 # Lightweight attempt to standardize a location for config files
 try:
     conf_path = os.environ['PHOENIX_CONF']
@@ -56,10 +82,15 @@ except KeyError:
 
 
 try:
-    data_pata = os.environ['PHOENIX_DATA']
+    data_path = os.environ['PHOENIX_DATA']
 except KeyError:
     data_path = '/var/opt/phoenix/data'
 
+try:
+    cache_path = os.environ['PHOENIX_CACHE']
+except KeyError:
+    cache_path = '/var/opt/phoenix/cache'
+
 try:
     artifact_path = os.environ['PHOENIX_ARTIFACTS']
 except KeyError:
@@ -13,31 +13,47 @@ def get_bootloader_script(node, interface=None, provider=None):
     loader_class = _find_class(node, provider)
     return loader_class.script(node, interface=interface)
 
-def write_bootloader_scripts():
+def bootloader_scripts(node):
+    ''' Returns (path, script) for each bootfile of a node, with paths
+        relative to the bootfiles directory
+    '''
+    scripts = list()
+    if 'interfaces' not in node:
+        return scripts
+    for ifacename, iface in node['interfaces'].items():
+        if ifacename == 'bmc':
+            continue
+        if 'dhcp' not in iface or iface['dhcp'] == False:
+            logging.debug("Skipping %s %s because it is not set for DHCP", node['name'], ifacename)
+            continue
+        try:
+            provider = _find_provider(node)
+            script = get_bootloader_script(node, interface=ifacename, provider=provider)
+        except Exception as e:
+            logging.debug("Skipping %s %s because a script was not generated (%s)", node['name'], ifacename, e)
+            continue
+        scripts.append(('%s/%s' % (provider, iface['ip']), script))
+    return scripts
+
+def write_bootfiles(scripts):
+    ''' Writes (path, script) pairs under the bootfiles directory '''
     bldir = Path(phoenix.artifact_path) / 'bootfiles'
-    if not bldir.is_dir():
-        bldir.mkdir()
-    for nodename,node in sorted(Node.nodes.items()):
-        if 'interfaces' in node:
-            for ifacename, iface in node['interfaces'].items():
-                if ifacename == 'bmc':
-                    continue
-                if 'dhcp' not in iface or iface['dhcp'] == False:
-                    logging.debug("Skipping %s %s because it is not set for DHCP", node['name'], ifacename)
-                    continue
-                try:
-                    provider = _find_provider(node)
-                    script = get_bootloader_script(node, interface=ifacename, provider=provider)
-                except Exception as e:
-                    logging.debug("Skipping %s %s because a script was not generated (%s)", node['name'], ifacename, e)
-                    continue
-                provdir = bldir / provider
-                if not provdir.is_dir():
-                    provdir.mkdir()
-                outputpath = provdir / iface['ip']
-                logging.debug("Writing bootfile to %s", outputpath)
-                with open (outputpath, 'w') as ofile:
-                    ofile.write(script)
+    for relpath, script in scripts:
+        outputpath = bldir / relpath
+        if not outputpath.parent.is_dir():
+            outputpath.parent.mkdir(parents=True)
+        logging.debug("Writing bootfile to %s", outputpath)
+        with open (outputpath, 'w') as ofile:
+            ofile.write(script)
+
+def write_bootloader_scripts(nodes=None, jobs=None):
+    ''' Writes the bootfiles of nodes (every built node by default),
+        generating them with Node.map_nodes
+    '''
+    if nodes is None:
+        nodes = sorted(Node.nodes)
+    results = Node.map_nodes(nodes, bootloader_scripts, jobs=jobs)
+    write_bootfiles([script for nodename, scripts in results for script in scripts])
 
 def _find_provider(node):
     try:
@@ -5,12 +5,13 @@
 import sys
 import logging
 import os
+import asyncio
 
 from ClusterShell.NodeSet import NodeSet
 import phoenix
 from phoenix.system import System
 
-from phoenix.oob import OOBTimeoutError
+from phoenix.oob import OOBTimeoutError, PENDING, ResourceCache, RequestPolicy
 
 class CommandTimeout(Exception):
     pass
@@ -27,26 +28,107 @@ class Command(object):
                 command_parts = client.command.split()
                 command = command_parts[0]
                 args = command_parts[1:]
-            if command == "firmware":
-                oob = _load_oob_class("bmc", client.node['bmctype'])
-                rc = oob.firmware(client.node, client, args)
-            elif command == "discover":
-                oob = _load_oob_class("bmc", client.node['discovertype'])
-                rc = oob.discover(client.node, client, args)
+            with ResourceCache.scope(), RequestPolicy.scope(client):
+                if command == "firmware":
+                    oob = _load_oob_class("bmc", client.node['bmctype'])
+                    rc = oob.firmware(client.node, client, args)
+                elif command == "discover":
+                    oob = _load_oob_class("bmc", client.node['discovertype'])
+                    rc = oob.discover(client.node, client, args)
+                else:
+                    cmdclass = phoenix.get_component('command', command)
+                    rc = cmdclass.run(client)
+            if rc is PENDING:
+                client.mark_command_pending()
             else:
-                cmdclass = phoenix.get_component('command', command)
-                rc = cmdclass.run(client)
-            client.mark_command_complete(rc=rc)
+                client.mark_command_complete(rc=rc)
         except CommandTimeout:
-            client._engine.remove(client, did_timeout=True)
+            client.mark_command_timeout()
         except OOBTimeoutError:
-            client._engine.remove(client, did_timeout=True)
+            client.mark_command_timeout()
         except Exception as e:
             client.output("Error running command: %s - %s" % (str(e), e.args), stderr=True)
             client.mark_command_complete(rc=1)
         logging.debug("command.run complete")
         return True
 
+    @classmethod
+    async def run_async(cls, client):
+        ''' Coroutine version of run, used by the asyncio engine. Commands
+            without a run_async of their own return NotImplemented and run
+            in the worker's thread pool instead.
+        '''
+        logging.debug("Inside Command.run_async for %s and node %s", client.command, client.node['name'])
+        rc = NotImplemented
+        try:
+            if isinstance(client.command, list):
+                command = client.command[0]
+            else:
+                command = client.command.split()[0]
+            if command not in ["firmware", "discover"]:
+                cmdclass = phoenix.get_component('command', command)
+                if cmdclass.run_async.__func__ is not Command.run_async.__func__:
+                    with ResourceCache.scope(), RequestPolicy.scope(client):
+                        rc = await cmdclass.run_async(client)
+            if rc is NotImplemented:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(client.worker.executor, cls.run, client)
+                return True
+            if rc is PENDING:
+                client.mark_command_pending()
+            else:
+                client.mark_command_complete(rc=rc)
+        except CommandTimeout:
+            client.mark_command_timeout()
+        except OOBTimeoutError:
+            client.mark_command_timeout()
+        except Exception as e:
+            client.output("Error running command: %s - %s" % (str(e), e.args), stderr=True)
+            client.mark_command_complete(rc=1)
+        return True
+
+    # Commands that talk to the BMC, or the PDU with --pdu
+    oob_commands = ['power', 'firmware', 'bios', 'inventory']
+
+    @classmethod
+    def oobkind(cls, command):
+        ''' Returns 'bmc' or 'pdu' if the command talks to an out of band
+            controller, otherwise None
+        '''
+        if not isinstance(command, list):
+            command = command.split()
+        if len(command) == 0 or command[0] not in cls.oob_commands:
+            return None
+        return "pdu" if "pdu" in command else "bmc"
+
+    @classmethod
+    def endpoint(cls, command, node):
+        ''' Returns the controller the command talks to for a node, or None '''
+        oobkind = cls.oobkind(command)
+        if oobkind is None:
+            return None
+        try:
+            return node[oobkind]
+        except KeyError:
+            return None
+
+    @classmethod
+    def preconnect_hosts(cls, command, nodes):
+        ''' Returns (oob class, host) for every out of band controller the
+            command is going to talk to for the nodes
+        '''
+        oobkind = cls.oobkind(command)
+        if oobkind is None:
+            return set()
+        hosts = set()
+        for node in nodes:
+            try:
+                oobcls = _load_oob_class(oobkind, node[oobkind + 'type'])
+                hosts.add((oobcls, node[oobkind]))
+            except (KeyError, ImportError):
+                continue
+        return hosts
+
 def _load_oob_class(oobtype, oobprovider):
     if oobprovider is None:
         logging.debug("Node does not have %stype set", oobtype)
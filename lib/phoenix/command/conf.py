@@ -8,7 +8,6 @@ import logging
 import argparse
 import socket
 import errno
-from pathlib import Path
 
 from yaml import load, dump
 try:
@@ -24,7 +23,8 @@ from phoenix.system import System
 from phoenix.command import Command
 from phoenix.node import Node
 from phoenix.network import Network
-from phoenix.bootloader import write_bootloader_scripts
+from phoenix.network import AddressIndex
+from phoenix.bootloader import bootloader_scripts, write_bootfiles
 from phoenix.dhcp import load_dhcp_provider
 
 try:
@@ -48,11 +48,13 @@ class ConfCommand(Command):
         parser_dhcp = subparsers.add_parser('dhcp', help='dhcp help')
         parser_updatedhcp = subparsers.add_parser('updatedhcp', help='update dhcp help')
         parser_bootfile = subparsers.add_parser('bootfiles', help='bootfile help')
+        subparsers.add_parser('precompile', help='Compile the templates used by the nodes ahead of time')
         parser_ethers = subparsers.add_parser('ethers', help='ethers help')
         parser_ethers.add_argument('--interface', '-i', default=[], type=str, action='append', dest='interfaces', help='Interface to include (default: show all)')
         parser_slingshot = subparsers.add_parser('slingshot', help='slingshot help')
         parser_slingshot.add_argument('--interface', '-i', default=[], type=str, action='append', dest='interfaces', help='Interface to include (default: show all)')
         parser.add_argument('-v', '--verbose', action='count', default=0)
+        parser.add_argument('-j', '--jobs', default=None, type=int, help='Processes used to resolve nodes (default: number of cpus)')
         phoenix.parallel.parser_add_arguments_parallel(parser)
         return parser
 
@@ -67,6 +69,7 @@ class ConfCommand(Command):
         cmdmap = { 'hosts':      cls.hosts,
                    'ips':        cls.ips,
                    'bootfiles':  cls.bootfiles,
+                   'precompile': cls.precompile,
                    'ethers':     cls.ethers,
                    'dhcp':       cls.dhcp,
                    'updatedhcp': cls.updatedhcp,
@@ -83,10 +86,9 @@ class ConfCommand(Command):
     @classmethod
     def hosts(cls, nodes, args):
         System.load_config()
-        Node.load_nodes(nodeset=nodes)
+        records = Node.resolve_nodes(nodes, ['interfaces'], jobs=args.jobs)
         output = list()
-        for nodename in nodes:
-            node = Node.find_node(nodename)
+        for nodename, node in records.items():
             if 'interfaces' not in node:
                 continue
             primary = None
@@ -165,35 +167,36 @@ class ConfCommand(Command):
         red = '\033[1;31m'
         end = '\033[0;0m'
         System.load_config()
-        Node.load_nodes(nodeset=nodes)
+        index = AddressIndex.load(nodes, jobs=args.jobs)
+        for ip in index.duplicates:
+            logging.error("Duplicate address %s used by %s", ip,
+                          ", ".join(["%s:%s" % owner for owner in index.duplicates[ip]]))
+        for (nodename, iface, ip, network) in index.violations:
+            logging.error("%s %s address %s is not in network %s", nodename, iface, ip, network)
+
         data = dict()
-        ips = dict()
-        dupes = dict()
         for nodename in nodes:
-            node = Node.find_node(nodename)
-            if 'interfaces' not in node:
+            if nodename not in index.interfaces:
                 continue
+            interfaces = index.interfaces[nodename]
             nettoipmap = dict()
-            for iface in node['interfaces']:
-                if 'ip' not in node['interfaces'][iface]:
+            for iface in interfaces:
+                if 'ip' not in interfaces[iface]:
                     continue
-                if 'network' in node['interfaces'][iface]:
-                    key = node['interfaces'][iface]['network']
+                if 'network' in interfaces[iface]:
+                    key = interfaces[iface]['network']
                 else:
                     key = iface
-                ip = node['interfaces'][iface]['ip']
-                if iface == "bmc" and (node['interfaces']['bmc']['network'] in [node['interfaces'][if2]['network'] for if2 in node['interfaces'] if if2 != "bmc"]):
-                    data[node['name'] + "-bmc"] = { key: ip }
-                elif iface == "bond0.float" and (node['interfaces']['bond0.float']['network'] in [node['interfaces'][if2]['network'] for if2 in node['interfaces'] if if2 != "bond0.floar"]):
-                    data[node['name'] + "-float"] = { key: ip }
+                ip = interfaces[iface]['ip']
+                othernets = [interfaces[if2].get('network') for if2 in interfaces if if2 != iface]
+                if iface == "bmc" and interfaces[iface].get('network') in othernets:
+                    data[nodename + "-bmc"] = { key: ip }
+                elif iface == "bond0.float" and interfaces[iface].get('network') in othernets:
+                    data[nodename + "-float"] = { key: ip }
                 else:
                     nettoipmap[key] = ip
-                # Check to see if this IP is a duplicate
-                if ip in ips:
-                    dupes[ip] = True
-                    logging.error("Duplicate IP %s", ip)
-                ips[ip] = True
-            data[node['name']] = nettoipmap
+            data[nodename] = nettoipmap
+        dupes = set(index.duplicates)
         networks = list(set([network for item in data.values() for network in item.keys()]))
         cols = ["Node"] + networks
         cls.interface_sort = networks[0]
@@ -207,7 +210,7 @@ class ConfCommand(Command):
                     logging.error("Could not find interface %s to sort by", args.sort)
         print("|%s|" % "|".join(['{:<15}'.format(x) for x in cols]))
         for node, val in sorted(data.items(), key=cls._sort_ips):
-            cols = [ (red + '{:<15}'.format(val[network]) + end if val[network] in dupes else '{:<15}'.format(val[network])) if network in val else '{:<15}'.format("<None>") for network in networks ]
+            cols = [ (red + '{:<15}'.format(val[network]) + end if AddressIndex.normalize(val[network]) in dupes else '{:<15}'.format(val[network])) if network in val else '{:<15}'.format("<None>") for network in networks ]
             cols.insert(0, '{:<15}'.format(node))
             print("|%s|" % "|".join(cols))
 
@@ -215,17 +218,26 @@ class ConfCommand(Command):
 
     @classmethod
     def bootfiles(cls, nodes, args):
+        # Only the index is needed here, the workers build the nodes
+        Node.load_nodes(nodeset=NodeSet())
+        Node.precompile_templates()
+        nodes = sorted(nodes.intersection(Node.indexed_nodes()))
+        results = Node.map_nodes(nodes, lambda node: bootloader_scripts(node) + ztp_scripts(node), jobs=args.jobs)
+        write_bootfiles([script for nodename, scripts in results for script in scripts])
+        return 0
+
+    @classmethod
+    def precompile(cls, nodes, args):
         Node.load_nodes(nodeset=nodes)
-        write_bootloader_scripts()
-        write_ztp_scripts()
+        names = Node.precompile_templates()
+        logging.info("Compiled %d templates", len(names))
         return 0
 
     @classmethod
     def ethers(cls, nodes, args):
         System.load_config()
-        Node.load_nodes(nodeset=nodes)
-        for nodename in nodes:
-            node = Node.find_node(nodename)
+        records = Node.resolve_nodes(nodes, ['interfaces'], jobs=args.jobs)
+        for nodename, node in records.items():
             if 'interfaces' not in node:
                 continue
             for ifacename, iface in node['interfaces'].items():
@@ -241,9 +253,8 @@ class ConfCommand(Command):
     @classmethod
     def slingshot(cls, nodes, args):
         System.load_config()
-        Node.load_nodes(nodeset=nodes)
-        for nodename in nodes:
-            node = Node.find_node(nodename)
+        records = Node.resolve_nodes(nodes, ['name', 'interfaces'], jobs=args.jobs)
+        for nodename, node in records.items():
             if 'interfaces' not in node:
                 continue
             for ifacename, iface in node['interfaces'].items():
@@ -271,9 +282,9 @@ class ConfCommand(Command):
     def updatedhcp(cls, nodes, args):
         System.load_config()
         # NOTE: it doesn't really make sense to include a nodeset here...
-        Node.load_nodes()
+        Node.load_nodes(nodeset=NodeSet())
         provider = load_dhcp_provider()
-        print(provider.update_dhcp_reservations())
+        print(provider.update_dhcp_reservations(jobs=args.jobs))
         return 0
 
     @classmethod
@@ -283,29 +294,26 @@ class ConfCommand(Command):
         client.output("Not yet implemented", stderr=True)
         return 1
 
-def write_ztp_scripts():
-    ztpdir = Path(phoenix.artifact_path) / 'bootfiles' / 'ztp'
-    if not ztpdir.is_dir():
-        ztpdir.mkdir()
-    for nodename,node in sorted(Node.nodes.items()):
-        if 'ztptemplate' not in node:
-            logging.debug("'ztptemplate' not defined for %s", nodename)
-            continue
+def ztp_scripts(node):
+    ''' Returns (path, script) for the ZTP script of a node, with paths
+        relative to the bootfiles directory
+    '''
+    if 'ztptemplate' not in node:
+        logging.debug("'ztptemplate' not defined for %s", node['name'])
+        return []
 
-        if 'interfaces' not in node:
-            continue
-
-        script = node.ztpscript()
+    if 'interfaces' not in node:
+        return []
 
-        for ifacename, iface in node['interfaces'].items():
-            if 'dhcp' not in iface or iface['dhcp'] == False:
-                logging.debug("Skipping ZTP for %s %s because it is not set for DHCP", node['name'], ifacename)
-                continue
+    script = node.ztpscript()
 
-            outputpath = ztpdir / iface['ip']
-            logging.debug("Writing ztpscript to %s", outputpath)
-            with open (outputpath, 'w') as ofile:
-                ofile.write(script)
+    scripts = list()
+    for ifacename, iface in node['interfaces'].items():
+        if 'dhcp' not in iface or iface['dhcp'] == False:
+            logging.debug("Skipping ZTP for %s %s because it is not set for DHCP", node['name'], ifacename)
+            continue
+        scripts.append(('ztp/%s' % iface['ip'], script))
+    return scripts
 
 if __name__ == '__main__':
     sys.exit(ConfCommand.run())
@@ -31,7 +31,7 @@ class DiscoverCommand(Command):
 
         phoenix.setup_logging(args.verbose)
         nodes = NodeSet(args.nodes)
-        Node.load_nodes()
+        Node.load_nodes(nodeset=nodes)
 
         individual_nodes = NodeSet()
         group_nodes = NodeSet()
@@ -67,11 +67,12 @@ class DiscoverCommand(Command):
             cmd = ["inventory", ["mac"]]
             task.shell(cmd, nodes=individual_nodes, autoclose=False, stdin=False, tree=True, remote=False)
             task.resume()
-            for buf, nodes in task.iter_buffers():
-                for node in nodes:
-                    mac = buf.message().decode()
-                    print("%s is %s" % (node, mac))
-                    data.setval('mac', node, mac)
+            with data.batch():
+                for buf, nodes in task.iter_buffers():
+                    for node in nodes:
+                        mac = buf.message().decode()
+                        print("%s is %s" % (node, mac))
+                        data.setval('mac', node, mac)
 
         switchdata = dict()
         if len(group_nodes) > 0:
@@ -87,32 +88,33 @@ class DiscoverCommand(Command):
                     switchdata[node] = json.loads(content)
 
         logging.debug("group_nodes is %s", group_nodes)
-        for nodename in group_nodes:
-            logging.debug("Doing group_nodes %s", nodename)
-            node = Node.find_node(nodename)
-            for interfacename in node['interfaces']:
-                logging.debug("Checking interface %s", interfacename)
-                if len(args.interfaces) > 0 and interfacename not in args.interfaces:
-                    logging.info("Skipping interface %s, not specified on command line", interfacename)
-                    continue
-                interface = node['interfaces'][interfacename]
-                if 'discoverytype' not in interface:
-                    logging.info("Skipping interface %s, discoverytype not set", interfacename)
-                    continue
-                if interface['discoverytype'] != 'switch':
-                    logging.info("Skipping interface %s, discoverytype is not switch", interfacename)
-                    continue
-                try:
-                    # TODO: If no match is found, try smart substring matching
-                    maclist = switchdata[interface['switch']][interface['switchport']]
-                    # TODO: add VLAN matching and "rules" to pick what interface to use instead of the first
-                    mac = maclist[0][0]
-                except Exception as e:
-                    logging.debug(e)
-                    logging.error("No mac address found for %s", nodename)
-                    continue
-                print("Node %s mac is %s" % (node['name'], mac))
-                data.setval('mac', nodename, mac)
+        with data.batch():
+            for nodename in group_nodes:
+                logging.debug("Doing group_nodes %s", nodename)
+                node = Node.find_node(nodename)
+                for interfacename in node['interfaces']:
+                    logging.debug("Checking interface %s", interfacename)
+                    if len(args.interfaces) > 0 and interfacename not in args.interfaces:
+                        logging.info("Skipping interface %s, not specified on command line", interfacename)
+                        continue
+                    interface = node['interfaces'][interfacename]
+                    if 'discoverytype' not in interface:
+                        logging.info("Skipping interface %s, discoverytype not set", interfacename)
+                        continue
+                    if interface['discoverytype'] != 'switch':
+                        logging.info("Skipping interface %s, discoverytype is not switch", interfacename)
+                        continue
+                    try:
+                        # TODO: If no match is found, try smart substring matching
+                        maclist = switchdata[interface['switch']][interface['switchport']]
+                        # TODO: add VLAN matching and "rules" to pick what interface to use instead of the first
+                        mac = maclist[0][0]
+                    except Exception as e:
+                        logging.debug(e)
+                        logging.error("No mac address found for %s", nodename)
+                        continue
+                    print("Node %s mac is %s" % (node['name'], mac))
+                    data.setval('mac', nodename, mac)
 
         rc = 0
         return rc
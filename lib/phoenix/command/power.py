@@ -9,7 +9,6 @@ import argparse
 from ClusterShell.NodeSet import NodeSet
 from jinja2 import Template
 from jinja2 import Environment
-import time
 import re
 import copy
 import importlib
@@ -18,7 +17,7 @@ import phoenix
 import phoenix.parallel
 from phoenix.system import System
 from phoenix.command import Command
-from phoenix.oob import OOBTimeoutError
+from phoenix.oob import OOBTimeoutError, PowerPoller
 
 class PowerCommand(Command):
     @classmethod
@@ -58,36 +57,33 @@ class PowerCommand(Command):
         return rc
 
     @classmethod
-    def run(cls, client):
-        action = client.command[1]
+    def _find_oob_class(cls, client):
+        """ Returns the oob class for the command, or None after reporting
+            why there isn't one
+        """
         if 'pdu' in client.command:
             oobkind = "pdu"
-            try:
-                oobtype = client.node['pdutype']
-                oobcls = phoenix.get_component("oob", oobtype, oobtype.capitalize() + "Pdu")
-            except KeyError:
-                client.output("pdutype not set", stderr=True)
-                client.mark_command_complete(rc=1)
-                return 1
         else:
             oobkind = "bmc"
-            try:
-                oobtype = client.node['bmctype']
-                oobcls = phoenix.get_component("oob", oobtype, oobtype.capitalize() + "Bmc")
-            except KeyError:
-                client.output("bmctype not set", stderr=True)
-                client.mark_command_complete(rc=1)
-                return 1
+        try:
+            oobtype = client.node[oobkind + 'type']
+            return phoenix.get_component("oob", oobtype, oobtype.capitalize() + oobkind.capitalize())
+        except KeyError:
+            client.output("%stype not set" % oobkind, stderr=True)
+            return None
+
+    @classmethod
+    def run(cls, client):
+        action = client.command[1]
+        oobcls = cls._find_oob_class(client)
+        if oobcls is None:
+            client.mark_command_complete(rc=1)
+            return 1
         try:
             if 'wait' in client.command and (action == "on" or action == "off"):
                 rc = oobcls.power(client.node, client, [action])
                 if rc == 0:
-                    for i in range(0, 180):
-                        time.sleep(1)
-                        rc = oobcls.power(client.node, client, ['stat'])
-                        if client.state.lower() == action.lower():
-                            return rc
-                    rc = 1
+                    return PowerPoller.add(client, oobcls, action)
             else:
                 rc = oobcls.power(client.node, client, [action])
             return rc
@@ -98,5 +94,28 @@ class PowerCommand(Command):
             client.output("Error running command: %s - %s" % (str(e), e.args), stderr=True)
             return 1
 
+    @classmethod
+    async def run_async(cls, client):
+        action = client.command[1]
+        oobcls = cls._find_oob_class(client)
+        if oobcls is None:
+            return 1
+        if not oobcls.has_async:
+            return NotImplemented
+        try:
+            if 'wait' in client.command and (action == "on" or action == "off"):
+                rc = await oobcls.power_async(client.node, client, [action])
+                if rc == 0:
+                    return PowerPoller.add(client, oobcls, action)
+            else:
+                rc = await oobcls.power_async(client.node, client, [action])
+            return rc
+        except OOBTimeoutError:
+            client.output("Timeout", stderr=True)
+            return 1
+        except Exception as e:
+            client.output("Error running command: %s - %s" % (str(e), e.args), stderr=True)
+            return 1
+
 if __name__ == '__main__':
     sys.exit(PowerCommand.run())
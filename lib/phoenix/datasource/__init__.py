@@ -4,10 +4,15 @@
 
 import logging
 import sys
+import threading
+import contextlib
 import phoenix
 from phoenix.system import System
 
 class Datasource(object):
+    # Updates collected by batch(), per thread
+    batches = threading.local()
+
     @classmethod
     def getval(cls, *args):
         raise NotImplementedError
@@ -16,4 +21,49 @@ class Datasource(object):
     def setval(cls, *args):
         raise NotImplementedError
 
+    @classmethod
+    def setvals(cls, key, values):
+        """ Sets many names of one key, values is a dict or (name, value) pairs """
+        if isinstance(values, dict):
+            values = values.items()
+        for name, value in values:
+            cls.setval(key, name, value)
+
+    @classmethod
+    @contextlib.contextmanager
+    def batch(cls):
+        """ Collects setval calls made inside the block and commits them
+            together at the end. Nested blocks commit with the outermost.
+            Values set in the block are not visible until it ends.
+        """
+        if getattr(cls.batches, 'pending', None) is not None:
+            yield
+            return
+        cls.batches.pending = dict()
+        try:
+            yield
+            pending = cls.batches.pending
+        finally:
+            cls.batches.pending = None
+        cls._commit(pending)
+
+    @classmethod
+    def _batched(cls, key, name, value):
+        """ Queues a value if a batch is open, returns False if not """
+        pending = getattr(cls.batches, 'pending', None)
+        if pending is None:
+            return False
+        pending.setdefault(key, dict())[name] = value
+        return True
+
+    @classmethod
+    def _commit(cls, pending):
+        for key, values in pending.items():
+            cls.setvals(key, values)
+
+    @classmethod
+    def invalidate(cls, key=None):
+        """ Forget cached data for key, or for every key """
+        pass
+
 DEFAULT_PROVIDER='csvfile'
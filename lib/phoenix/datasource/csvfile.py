@@ -2,15 +2,16 @@
 """CSV Data Source Functions"""
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
+import os
+import stat
 import logging
-import time
+import tempfile
 import csv
 import phoenix
 
 from phoenix.datasource import Datasource
 
 class CsvfileDatasource(Datasource):
-    cachetime = 300
     data = {}
     data_freshness = {}
 
@@ -20,12 +21,15 @@ class CsvfileDatasource(Datasource):
 
     @classmethod
     def _read(cls, key, force=False):
-        # Avoid thrashing the reads
-        # Consider changing this to stat the file instead
-        cur_time = time.time()
+        # Only read the file again when its stats change
+        try:
+            st = os.stat(cls._get_filename(key))
+            stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stat_key = None
 
-        if key in cls.data_freshness:
-            if (cls.data_freshness[key] + cls.cachetime) > cur_time:
+        if not force and key in cls.data_freshness:
+            if cls.data_freshness[key] == stat_key:
                 logging.debug("Data is fresh, skipping re-read")
                 return
 
@@ -36,20 +40,38 @@ class CsvfileDatasource(Datasource):
                 for row in reader:
                     newdata[row[0]] = row[1]
             cls.data[key] = newdata
-            cls.data_freshness[key] = time.time()
         except Exception as e:
             logging.warning("Exception reading datafile: %s", e)
             # Assume if you can't read the file it's blank
             cls.data[key] = {}
-            cls.data_freshness[key] = time.time()
-            pass
+        cls.data_freshness[key] = stat_key
 
     @classmethod
     def _write(cls, key):
-        with open(cls._get_filename(key), 'w') as csvfile:
-            writer = csv.writer(csvfile, delimiter=',')
-            for datakey in sorted(cls.data[key]):
-                writer.writerow([datakey, cls.data[key][datakey]])
+        # Write a new file and rename it over the old one so readers
+        # always see either the old or the new contents
+        filename = cls._get_filename(key)
+        (tmpfd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.%s' % key)
+        try:
+            try:
+                os.fchmod(tmpfd, stat.S_IMODE(os.stat(filename).st_mode))
+            except FileNotFoundError:
+                os.fchmod(tmpfd, 0o644)
+            with os.fdopen(tmpfd, 'w') as csvfile:
+                writer = csv.writer(csvfile, delimiter=',')
+                for datakey in sorted(cls.data[key]):
+                    writer.writerow([datakey, cls.data[key][datakey]])
+            os.replace(tmpname, filename)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    @classmethod
+    def invalidate(cls, key=None):
+        if key is None:
+            cls.data_freshness.clear()
+        else:
+            cls.data_freshness.pop(key, None)
 
     @classmethod
     def getval(cls, *args):
@@ -64,8 +86,19 @@ class CsvfileDatasource(Datasource):
     @classmethod
     def setval(cls, *args):
         logging.debug("args[0] is %s", args[0])
+        if cls._batched(args[0], "/".join(args[1:-1]), args[-1]):
+            return
         # This is probably overkill, but fine for now
         cls._read(args[0])
         cls.data[args[0]]["/".join(args[1:-1])] = args[-1]
         # Probably need to throttle this
         cls._write(args[0])
+
+    @classmethod
+    def setvals(cls, key, values):
+        if isinstance(values, dict):
+            values = values.items()
+        # Pick up changes made by other processes before rewriting
+        cls._read(key, force=True)
+        cls.data[key].update(values)
+        cls._write(key)
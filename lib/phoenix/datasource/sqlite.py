@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""SQLite Data Source Functions"""
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import sys
+import csv
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+import phoenix
+from phoenix.system import System
+from phoenix.datasource import Datasource
+
+class SqliteDatasource(Datasource):
+    ''' Stores data in an SQLite database with one row per (key, name).
+        WAL journaling lets readers carry on while a writer commits, but it
+        needs shared memory between the processes using the database. When
+        servers on different hosts share the database over a network
+        filesystem, set journal_mode to 'delete' so only file locks are used.
+    '''
+    settings = { 'filename':     None,
+                 'journal_mode': 'wal',
+                 'timeout':      30,
+               }
+    loaded_settings = False
+    local = threading.local()
+
+    @classmethod
+    def _load_settings(cls):
+        if cls.loaded_settings:
+            return
+        cls.settings = dict(cls.settings)
+        cls.settings.update(System.setting('sqlite', default=dict()))
+        if cls.settings['filename'] is None:
+            cls.settings['filename'] = "%s/phoenix.db" % phoenix.data_path
+        cls.loaded_settings = True
+
+    @classmethod
+    def _connect(cls):
+        ''' Returns the connection for this thread, opening it if needed '''
+        conn = getattr(cls.local, 'conn', None)
+        # Connections must not be shared with a forked child
+        if conn is not None and cls.local.pid == os.getpid():
+            return conn
+        cls._load_settings()
+        logging.debug("Opening sqlite database %s", cls.settings['filename'])
+        conn = sqlite3.connect(cls.settings['filename'], timeout=cls.settings['timeout'])
+        conn.execute("PRAGMA busy_timeout = %d" % (cls.settings['timeout'] * 1000))
+        conn.execute("PRAGMA journal_mode = %s" % cls.settings['journal_mode'])
+        conn.execute("PRAGMA synchronous = NORMAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS data ("
+                         "key TEXT NOT NULL, "
+                         "name TEXT NOT NULL, "
+                         "value TEXT, "
+                         "PRIMARY KEY (key, name)) WITHOUT ROWID")
+        cls.local.conn = conn
+        cls.local.pid = os.getpid()
+        return conn
+
+    @classmethod
+    def getval(cls, *args):
+        logging.debug("Inside SqliteDatasource getval for key %s", args)
+        row = cls._connect().execute("SELECT value FROM data WHERE key = ? AND name = ?",
+                                     (args[0], '/'.join(args[1:]))).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    @classmethod
+    def setval(cls, *args):
+        if cls._batched(args[0], "/".join(args[1:-1]), args[-1]):
+            return
+        cls.setvals(args[0], { "/".join(args[1:-1]): args[-1] })
+
+    @classmethod
+    def _commit(cls, pending):
+        # Every key of the batch in one transaction
+        conn = cls._connect()
+        with conn:
+            for key, values in pending.items():
+                conn.executemany("INSERT OR REPLACE INTO data (key, name, value) VALUES (?, ?, ?)",
+                                 [(key, name, value) for name, value in values.items()])
+
+    @classmethod
+    def setvals(cls, key, values):
+        ''' Sets many names of one key in a single transaction '''
+        if isinstance(values, dict):
+            values = values.items()
+        conn = cls._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO data (key, name, value) VALUES (?, ?, ?)",
+                             [(key, name, value) for name, value in values])
+
+    @classmethod
+    def import_csv(cls, directory=None):
+        ''' Copies every csvfile datasource file into the database '''
+        if directory is None:
+            directory = phoenix.data_path
+        for filename in sorted(Path(directory).glob('*.csv')):
+            with open(filename, 'r') as csvfile:
+                reader = csv.reader(csvfile, delimiter=',')
+                rows = [(row[0], row[1]) for row in reader if len(row) >= 2]
+            logging.info("Importing %d entries from %s", len(rows), filename)
+            cls.setvals(filename.stem, rows)
+
+if __name__ == '__main__':
+    # Migrate from the csvfile datasource: python3 -m phoenix.datasource.sqlite [directory]
+    phoenix.setup_logging(1)
+    SqliteDatasource.import_csv(sys.argv[1] if len(sys.argv) > 1 else None)
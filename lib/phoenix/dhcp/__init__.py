@@ -11,7 +11,7 @@ class Dhcp(object):
     dhcptype = "unknown"
 
     @classmethod
-    def update_dhcp_reservations(cls):
+    def update_dhcp_reservations(cls, nodes=None, jobs=None):
         raise NotImplementedError
 
     @classmethod
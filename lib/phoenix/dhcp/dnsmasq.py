@@ -32,13 +32,21 @@ class DnsmasqDhcp(object):
     environment = None
 
     @classmethod
-    def update_dhcp_reservations(cls):
+    def update_dhcp_reservations(cls, nodes=None, jobs=None):
+        ''' Writes the reservations for nodes, all indexed nodes by default.
+            The interfaces are resolved in parallel, see Node.map_nodes.
+        '''
         cls.load_settings()
         leasetime='10m'
         curtime = datetime.datetime.now()
         timestamp = curtime.strftime('%Y-%m-%d %H:%M:%S')
         output = [ '# this file was generated by Phoenix at %s' % timestamp ]
-        for nodename,node in sorted(Node.nodes.items()):
+        if nodes is None:
+            if not Node.loaded_nodes:
+                Node.load_nodes(nodeset=NodeSet())
+            nodes = Node.indexed_nodes()
+        records = Node.resolve_nodes(sorted(nodes), ['interfaces'], jobs=jobs)
+        for nodename,node in sorted(records.items()):
             if 'interfaces' not in node:
                 continue
             for ifacename, iface in node['interfaces'].items():
@@ -109,7 +117,7 @@ class DnsmasqDhcp(object):
         if cls.environment is not None:
             return
 
-        cls.environment = Environment()
+        cls.environment = Environment(bytecode_cache=phoenix.get_bytecode_cache())
         cls.environment.trim_blocks = True
         cls.environment.loader = ChoiceLoader([
             FileSystemLoader([Path(phoenix.conf_path) / 'templates']),
@@ -3,18 +3,14 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
 import logging
-from yaml import load, dump
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    logging.info("Unable to load CLoader and/or CDumper")
-    from yaml import Loader, Dumper
-
 from ClusterShell.NodeUtils import GroupSource, GroupSourceQueryFailed
 import phoenix
+from phoenix.snapshot import Snapshot
+from phoenix.watch import FileWatcher
 
 class Group(object):
     loaded_groups = False
+    filename = None
 
     # Dicts to hold all System data
     groups = dict()
@@ -31,11 +27,18 @@ class Group(object):
 
         # Read the yaml file
         logging.info("Loading group file '%s'", filename)
-        with open(filename) as groupfd:
-            cls.groups.update(load(groupfd, Loader=Loader))
+        FileWatcher.watch('groups', [filename], cls.reload)
+        cls.groups.update(Snapshot.load_yaml(filename))
 
+        cls.filename = filename
         cls.loaded_groups = True
 
+    @classmethod
+    def reload(cls):
+        """ Reads groups.yaml again, keeping the old groups if that fails """
+        FileWatcher.watch('groups', [cls.filename], cls.reload)
+        cls.groups = dict(Snapshot.load_yaml(cls.filename))
+
     @classmethod
     def find_group(cls, group):
         if not cls.loaded_groups:
@@ -3,20 +3,56 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
 import logging
-from yaml import load, dump
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    logging.info("Unable to load CLoader and/or CDumper")
-    from yaml import Loader, Dumper
-
+import os
+import hashlib
 import phoenix
 import ipaddress
+import collections.abc
 from phoenix.system import System
+from phoenix.snapshot import Snapshot
+from phoenix.watch import FileWatcher
 from phoenix.data import Data
 
+class SubnetList(collections.abc.Sequence):
+    ''' The equal-sized subnets of a network, like list(network.subnets())
+        but each subnet is computed when it is asked for, so a huge ipv6
+        network costs no more than a small one.
+    '''
+    def __init__(self, network, prefixlen):
+        if prefixlen < network.prefixlen:
+            raise ValueError('new prefix must be longer')
+        if prefixlen > network.max_prefixlen:
+            raise ValueError('prefix length diff %d is invalid for netblock %s' % (prefixlen - network.prefixlen, network))
+        self.network = network
+        self.prefixlen = prefixlen
+        self.size = 1 << (network.max_prefixlen - prefixlen)
+        self.count = 1 << (prefixlen - network.prefixlen)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.count))]
+        if idx < 0:
+            idx += self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError('subnet index out of range')
+        address = int(self.network.network_address) + idx * self.size
+        return self.network.__class__((address, self.prefixlen))
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self[idx]
+
+    def __repr__(self):
+        return 'SubnetList(%s, %d)' % (self.network, self.prefixlen)
+
 class Network(object):
     loaded_config = False
+    filename = None
+    # Bumped every time the config is (re)loaded so caches can tell it changed
+    generation = 0
 
     # Dicts to hold all Network data
     config = dict()
@@ -32,13 +68,16 @@ class Network(object):
 
         # Read the yaml file
         logging.info("Loading network file '%s'", filename)
+        cls.filename = filename
+        # Networks can also come from system.yaml and use its domain
+        FileWatcher.watch('network', [filename], cls.reload, depends=['system'])
         try:
-            with open(filename) as networkfd:
-                cls.config = load(networkfd, Loader=Loader) or {}
-                for network in cls.config:
-                    cls._cache_network(network)
-                cls.loaded_config = True
-                return
+            cls.config = Snapshot.load_yaml(filename) or {}
+            for network in cls.config:
+                cls._cache_network(network)
+            cls.generation += 1
+            cls.loaded_config = True
+            return
         except IOError:
             logging.error("%s does not exist", filename)
 
@@ -46,10 +85,21 @@ class Network(object):
             cls.config = System.setting('networks')
             for network in cls.config:
                 cls._cache_network(network)
+            cls.generation += 1
             cls.loaded_config = True
         except KeyError:
             logging.error("Network settings not found in system either")
 
+    @classmethod
+    def reload(cls):
+        """ Reads the networks again, keeping the old ones if that fails """
+        cls.loaded_config = False
+        try:
+            cls.load_config(cls.filename)
+        except:
+            cls.loaded_config = True
+            raise
+
     @classmethod
     def _cache_network(cls, net):
         """ Parse and cache a network definition """
@@ -102,7 +152,7 @@ class Network(object):
             else:
                 prefix = cfg[t['rackmask']]
 
-            subnets = list(ipobj.subnets(new_prefix=prefix))
+            subnets = SubnetList(ipobj, prefix)
             cfg[t['subnets']] = subnets
 
             cfg[t['rackaddresses']] = subnets[0].num_addresses
@@ -164,6 +214,129 @@ class Network(object):
             subnet = net['subnets6'][rack]
         return str(subnet.network_address + offset)
 
+class AddressIndex(object):
+    ''' Lookups between addresses (ip, ip6 and mac) and the node interfaces
+        that use them. Duplicate addresses and addresses outside of the
+        interface's network are found while the index is built.
+    '''
+    fields = ['ip', 'ip6', 'mac']
+
+    def __init__(self):
+        # node name -> interface name -> {network, ip, ip6, mac}
+        self.interfaces = dict()
+        # address -> list of (node name, interface name)
+        self.addresses = dict()
+        # address -> list of (node name, interface name), more than one each
+        self.duplicates = dict()
+        # (node name, interface name, address, network)
+        self.violations = list()
+
+    @staticmethod
+    def normalize(address):
+        ''' Returns the form an address is indexed under '''
+        address = str(address)
+        try:
+            return ipaddress.ip_address(address).compressed
+        except ValueError:
+            return address.lower()
+
+    def lookup(self, address):
+        ''' Returns the (node, interface) pairs using an address '''
+        return self.addresses.get(self.normalize(address), [])
+
+    def add_node(self, node):
+        if 'interfaces' not in node:
+            return
+        interfaces = dict()
+        for ifacename in node['interfaces']:
+            iface = node['interfaces'][ifacename]
+            entry = dict()
+            for field in ['network'] + self.fields:
+                if field in iface and iface[field] is not None:
+                    entry[field] = iface[field]
+            interfaces[ifacename] = entry
+            self.add_interface(node['name'], ifacename, entry)
+        self.interfaces[node['name']] = interfaces
+
+    def add_interface(self, nodename, ifacename, entry):
+        owner = (nodename, ifacename)
+        for field in self.fields:
+            if field not in entry:
+                continue
+            address = self.normalize(entry[field])
+            owners = self.addresses.setdefault(address, list())
+            owners.append(owner)
+            if len(owners) == 2:
+                self.duplicates[address] = owners
+            if field != 'mac' and 'network' in entry:
+                self._check_network(owner, address, entry['network'], field)
+
+    def _check_network(self, owner, address, netname, field):
+        net = Network.networks().get(netname)
+        ipobj = None
+        if net is not None:
+            ipobj = net.get('ipobj' if field == 'ip' else 'ip6obj')
+        if ipobj is None:
+            return
+        try:
+            inside = ipaddress.ip_address(address) in ipobj
+        except ValueError:
+            inside = False
+        if not inside:
+            self.violations.append(owner + (address, netname))
+
+    @classmethod
+    def build(cls, nodes):
+        ''' Creates an index from a list of Node objects or records from
+            Node.resolve_nodes
+        '''
+        index = cls()
+        for node in nodes:
+            index.add_node(node)
+        return index
+
+    @staticmethod
+    def sources():
+        ''' Files the addresses of nodes are derived from: everything in the
+            config and data directories, templates included, and the phoenix
+            code that runs the plugins
+        '''
+        sources = list()
+        cache = os.path.abspath(phoenix.cache_path)
+        for directory in [phoenix.conf_path, phoenix.data_path]:
+            for (dirpath, dirnames, filenames) in os.walk(directory):
+                if os.path.abspath(dirpath).startswith(cache):
+                    # Snapshots are written there
+                    dirnames[:] = []
+                    continue
+                dirnames.sort()
+                sources.extend(os.path.join(dirpath, x) for x in sorted(filenames))
+        for (dirpath, dirnames, filenames) in os.walk(os.path.dirname(os.path.abspath(__file__))):
+            dirnames[:] = sorted(x for x in dirnames if x != '__pycache__')
+            sources.extend(os.path.join(dirpath, x) for x in sorted(filenames) if x.endswith('.py'))
+        return sources
+
+    @classmethod
+    def load(cls, nodes, jobs=None):
+        ''' Returns the index for a nodeset, from the snapshot cache if
+            none of the config or data files changed since it was built.
+            Otherwise the nodes are resolved with jobs workers.
+        '''
+        # phoenix.node imports this module
+        from phoenix.node import Node
+
+        name = 'addresses-%s' % hashlib.sha1(str(nodes).encode()).hexdigest()
+        key = Snapshot.sources_key(cls.sources())
+        index = Snapshot.fetch(name, key)
+        if index is not None:
+            logging.debug("Using the cached address index")
+            return index
+
+        records = Node.resolve_nodes(nodes, ['name', 'interfaces'], jobs=jobs)
+        index = cls.build(records.values())
+        Snapshot.store(name, key, index)
+        return index
+
 def handleautointerfaces(node):
     # autointerfaces
     # Format: interface,network,ipoffset[,key=value[,key2=value2]][;interface,network,ipoffset[,key=value]]
@@ -26,13 +26,18 @@ from jinja2.runtime import Context
 from pathlib import Path
 import re
 import copy
+import hashlib
 import importlib
 import ipaddress
 import collections
+import threading
+import multiprocessing
 import phoenix
 from phoenix.system import System
 from phoenix.network import Network
 from phoenix.data import Data
+from phoenix.snapshot import Snapshot
+from phoenix.watch import FileWatcher
 
 # Technically, maps in yaml are unordered. We want entries in nodes.yaml
 # to be processed in the order present in the file so that overriding
@@ -91,11 +96,40 @@ class NodeLayer(object):
     def __iter__(self):
         return iter(self.data)
 
+# Marks a key that was looked up and not found in any layer
+_missing = object()
+
+def _export(value):
+    ''' Converts a resolved value to plain dicts and lists '''
+    if isinstance(value, collections.abc.Mapping):
+        result = dict()
+        for key in value:
+            try:
+                result[key] = _export(value[key])
+            except KeyError:
+                continue
+        return result
+    elif isinstance(value, (list, tuple)):
+        return [_export(x) for x in value]
+    return value
+
+def _map_shard(names):
+    ''' Resolves a shard of nodes in a Node.map_nodes worker '''
+    nodes = [Node.find_node(name) for name in names]
+    Node.run_plugins_bulk(nodes)
+    return [(name, Node.map_function(node)) for name, node in zip(names, nodes)]
+
 class NodeLayerMap(collections.abc.Mapping):
-    def __init__(self, node=None, initlayers=None):
+    def __init__(self, node=None, initlayers=None, parent=None, key=None):
         self.node = node
+        # The map this is a submapping of, and its key there
+        self.parent = parent
+        self.key = key
         self.layers = initlayers or []
         self.layers.insert(0, NodeLayer(layertype="cache"))
+        # Resolved view of the layers, only used once the node is resolved
+        self.resolved = dict()
+        self.resolvedkeys = None
 
     def addlayer(self, layer, position=None):
         ''' Adds a layer to the map at the desired position. Position must be
@@ -106,6 +140,7 @@ class NodeLayerMap(collections.abc.Mapping):
         elif position < 1:
             raise IndexError
         self.layers.insert(position, layer)
+        self.invalidate()
 
     def haslayeroftype(self, layertype):
         ''' Determines if any of this map's layers are of the specified type'''
@@ -114,6 +149,24 @@ class NodeLayerMap(collections.abc.Mapping):
                 return True
         return False
 
+    def caching(self):
+        ''' The resolved view is only trusted after plugins and models are
+            applied to the node. Before that, layers are still being filled in.
+        '''
+        return self.node is not None and self.node.resolved
+
+    def invalidate(self, key=None):
+        ''' Drops the resolved view (including any submappings) and any
+            rendered templates that could depend on key (all of them if the
+            key is unknown or below the top level)
+        '''
+        self.resolved.clear()
+        self.resolvedkeys = None
+        if self.node is not None:
+            if self is not self.node.data:
+                key = None
+            self.node.invalidate_templates(key)
+
     def __str__(self):
         return(str(dict(self)))
 
@@ -121,9 +174,12 @@ class NodeLayerMap(collections.abc.Mapping):
         return(str(dict(self)))
 
     def getsubmapping(self, key):
-        return NodeLayerMap(self.node, [NodeLayer(meta=layer.meta, data=layer.data[key]) for layer in self.layers if key in layer.data and isinstance(layer.data[key], collections.abc.Mapping)])
+        return NodeLayerMap(self.node, [NodeLayer(meta=layer.meta, data=layer.data[key]) for layer in self.layers if key in layer.data and isinstance(layer.data[key], collections.abc.Mapping)], self, key)
 
-    def __getitem__(self, key):
+    def _lookup(self, key):
+        ''' Returns the winning raw value for key, a submapping if the value is
+            a mapping, or _missing if no layer has the key
+        '''
         for layer in self.layers:
             try:
                 result = layer.data[key]
@@ -131,15 +187,28 @@ class NodeLayerMap(collections.abc.Mapping):
                 continue
             if isinstance(result, collections.abc.Mapping):
                 return self.getsubmapping(key)
-            elif isinstance(result, NodeTemplate):
-                return result.render(self.node)
-            elif isinstance(result, types.FunctionType):
-                return result()
-            elif result is None:
-                raise KeyError(key)
-            else:
-                return result
-        raise KeyError(key)
+            return result
+        return _missing
+
+    def _resolve(self, key):
+        if not self.caching():
+            return self._lookup(key)
+        try:
+            return self.resolved[key]
+        except KeyError:
+            result = self._lookup(key)
+            self.resolved[key] = result
+            return result
+
+    def __getitem__(self, key):
+        result = self._resolve(key)
+        if result is _missing or result is None:
+            raise KeyError(key)
+        elif isinstance(result, NodeTemplate):
+            return result.render(self.node)
+        elif isinstance(result, types.FunctionType):
+            return result()
+        return result
 
     def getwithblame(self, key):
         for layer in self.layers:
@@ -152,22 +221,48 @@ class NodeLayerMap(collections.abc.Mapping):
         raise KeyError(key)
 
     def __contains__(self, key):
-        for l in self.layers:
-            if key in l.data:
-                return False if l.data[key] is None else True
-        return False
+        result = self._resolve(key)
+        return result is not _missing and result is not None
 
-    def __iter__(self):
+    def _keys(self):
         tombstones = set([x for x in self.layers[0] if self.layers[0][x] is None])
-        return iter(set().union(*self.layers) - tombstones)
+        return set().union(*self.layers) - tombstones
+
+    def __iter__(self):
+        if not self.caching():
+            return iter(self._keys())
+        if self.resolvedkeys is None:
+            self.resolvedkeys = self._keys()
+        return iter(self.resolvedkeys)
 
     def setcache(self, key, value):
         self.layers[0].data[key] = value
+        self.invalidate(key)
+        if self.parent is not None:
+            self._setrootcache(key, value)
+
+    def _setrootcache(self, key, value):
+        ''' Also writes a value set in a submapping to the cache layer of the
+            top level map, so it outlives this submapping
+        '''
+        path = [key]
+        root = self
+        while root.parent is not None:
+            path.insert(0, root.key)
+            root = root.parent
+        data = root.layers[0].data
+        for name in path[:-1]:
+            if not isinstance(data.get(name), dict):
+                data[name] = dict()
+            data = data[name]
+        data[key] = value
+        root.invalidate(path[0])
 
     def __setitem__(self, key, value):
         if self.node.in_plugin:
             # Add to plugin layer
             self.layers[-1].data[key] = value
+            self.invalidate(key)
         else:
             # Add to cache layer
             self.setcache(key, value)
@@ -183,12 +278,56 @@ class NodeContext(Context):
         return super().resolve_or_missing(key)
 
 class NodeTemplate(object):
+    # Template names that pull in System or Network config
+    system_regex = re.compile(r'\b(System|racklist|rackindex)\b')
+    network_regex = re.compile(r'\b(Network|ipadd)\b')
+    # Template names whose output can change without phoenix noticing
+    volatile_regex = re.compile(r'\bdata\b')
+
     def __init__(self, templatestr):
-        self.template = Node.environment.from_string(templatestr)
+        self.template = Node.compile_template(templatestr)
         self.templatestr = templatestr
+        # A name can only be used if it is spelled out in the template, so a
+        # plain search errs on the side of invalidating too often
+        self.uses_system = self.system_regex.search(templatestr) is not None
+        self.uses_network = self.network_regex.search(templatestr) is not None
+        self.cacheable = self.volatile_regex.search(templatestr) is None
+
+    def _generations(self):
+        return (System.generation if self.uses_system else None,
+                Network.generation if self.uses_network else None)
 
     def render(self, node):
-        Network.load_config()
+        ''' Renders the template for a node. Results are memoized on the node
+            along with the node attributes read while rendering; the node drops
+            the entry when one of those attributes is written.
+        '''
+        if not Network.loaded_config:
+            Network.load_config()
+        if node is None:
+            return self._render(node)
+
+        with node.lock:
+            try:
+                (value, depends, generations) = node.templatecache[self]
+                if generations == self._generations():
+                    node.record_dependencies(depends)
+                    return value
+            except KeyError:
+                pass
+
+            depends = set()
+            node.recording.append(depends)
+            try:
+                value = self._render(node)
+            finally:
+                node.recording.pop()
+            node.record_dependencies(depends)
+            if self.cacheable:
+                node.templatecache[self] = (value, depends, self._generations())
+            return value
+
+    def _render(self, node):
         return self.template.render({
             'node':node,
             'System': System.config,
@@ -212,23 +351,34 @@ class Node(object):
 
     plugins = dict()
     nodes = dict()
+    noderanges = list()
+    # (noderanges, node name -> layers of the noderanges holding it)
+    rangeindex = (None, None)
+    nodefiles = dict()
     nodemap = dict()
     nodeset_cache = dict()
+    compiled_templates = dict()
     models = dict()
+    # Smallest number of nodes handed to a map_nodes worker at once
+    shard_size = 64
+    map_function = None
 
     def __init__(self, name):
+        # Held while plugins run or a template renders for this node
+        self.lock = threading.RLock()
         self.ran_plugins = False
         self.in_plugin = False
         self.linked_model = False
+        self.resolving = False
+        self.resolved = False
+        self.templatecache = dict()
+        self.recording = list()
         self.name = name
         self.data = NodeLayerMap(self)
         self['name'] = name
 
     def __repr__(self):
-        if not self.ran_plugins:
-            self.run_plugins()
-        if not self.linked_model:
-            self.link_model()
+        self.resolve()
         return yaml.dump({self.name: dict(self.data)}, default_flow_style=False)
 
     def setrawitem(self, key, value):
@@ -245,12 +395,11 @@ class Node(object):
         self.data[key] = value
 
     def __getitem__(self, key):
+        if self.recording:
+            self.record_dependencies((key,))
         if key == "name":
             return self.name
-        if not self.ran_plugins:
-            self.run_plugins()
-        if not self.linked_model:
-            self.link_model()
+        self.resolve()
 
         if key == 'ztpscript':
             return self.ztpscript()
@@ -276,15 +425,73 @@ class Node(object):
         raise NotImplementedError("Attributes cannot be deleted from a node")
 
     def __contains__(self, key):
-        if not self.ran_plugins:
-            self.run_plugins()
-        if not self.linked_model:
-            self.link_model()
+        if self.recording:
+            self.record_dependencies((key,))
+        self.resolve()
         return key in self.data
 
+    def record_dependencies(self, keys):
+        ''' Notes attributes read by every template currently rendering '''
+        for depends in self.recording:
+            depends.update(keys)
+
+    def invalidate_templates(self, key=None):
+        ''' Drops rendered templates that read key, or all if key is None '''
+        if not self.templatecache:
+            return
+        if key is None:
+            self.templatecache.clear()
+            return
+        for template in [t for t, entry in self.templatecache.items() if key in entry[1]]:
+            del self.templatecache[template]
+
     def addlayer(self, layer, position=None):
         self.data.addlayer(layer, position)
 
+    def resolve(self):
+        ''' Runs plugins and links the model if that hasn't happened yet.
+            Once both are done the attribute lookups are memoized until a
+            layer is added or the cache or plugin layer is written.
+        '''
+        if self.resolved:
+            return
+        with self.lock:
+            if self.resolved:
+                return
+            # Plugins read the node while it is being resolved, only the
+            # outermost call gets to mark it as done
+            outer = not self.resolving
+            self.resolving = True
+            try:
+                if not self.ran_plugins:
+                    self.run_plugins()
+                # Plugins may set the model, so it is linked after them
+                if not self.linked_model and not self.in_plugin:
+                    self.link_model()
+            finally:
+                if outer:
+                    self.resolving = False
+            if outer and not self.in_plugin:
+                self.resolved = True
+
+    def export(self, keys=None):
+        ''' Returns the resolved attributes (all of them if keys is None) as
+            plain dicts and lists, with templates rendered, so the result
+            can be pickled and outlives the node
+        '''
+        self.resolve()
+        if keys is None:
+            keys = sorted(self.data)
+        record = dict()
+        for key in keys:
+            try:
+                record[key] = _export(self[key])
+            except KeyError:
+                continue
+            except Exception as e:
+                logging.warning("Could not resolve %s for %s: %s", key, self.name, e)
+        return record
+
     @classmethod
     def load_nodes(cls, filename=None, datastr=None, nodeset=None, clear=False):
         """ Reads and processes node data.
@@ -292,27 +499,87 @@ class Node(object):
             or if you want to focus on a different nodeset. By
             default, it just adds to the current view of nodes.
             Set clear=True to clear all currently-known nodes.
+
+            Every noderange is kept in an index. Only the nodes in
+            nodeset are built right away (all nodes if nodeset is None),
+            anything else is built on demand by find_node.
         """
 
         # Clear known nodes if requested
         if clear:
             cls.nodes = dict()
+            cls.noderanges = list()
+            cls.nodefiles = dict()
 
         if filename is not None and datastr is not None:
             logging.error("Cannot load nodes from a file and string")
             return False
         elif filename is None and datastr is None:
-            filename = "%s/nodes.yaml" % phoenix.conf_path
+            # nodes.yaml followed by any fragments in nodes.d, in name order
+            cls.watch_nodes()
+            for filename in cls.node_files():
+                cls.load_nodes(filename=filename, nodeset=nodeset)
+            return
+
+        newranges = cls._parse_node_file(filename, datastr)
+
+        previous = cls.noderanges
+        existing = list(cls.nodes.values())
+        cls.noderanges = previous + newranges
+
+        if nodeset is not None and not isinstance(nodeset, NodeSet):
+            nodeset = NodeSet(nodeset)
 
+        # Load the data into the node structures
+        for ns1, newlayer in newranges:
+            if nodeset is None:
+                members = ns1
+            else:
+                members = ns1.intersection(nodeset)
+
+            for node in members:
+                if node not in cls.nodes:
+                    cls._build_node(node, previous)
+
+                # Add the layer to the node
+                cls.nodes[node].addlayer(newlayer)
+
+            if nodeset is None:
+                continue
+            # Nodes built earlier that are outside of nodeset. Only they
+            # can be, none of those are built by this load.
+            outside = ns1.difference(members)
+            if len(outside) < len(existing):
+                for name in outside:
+                    if name in cls.nodes:
+                        cls.nodes[name].addlayer(newlayer)
+            else:
+                for node in existing:
+                    if node.name in outside:
+                        node.addlayer(newlayer)
+
+        # Keep the index up to date if it was built
+        (indexed, index) = cls.rangeindex
+        if indexed is previous:
+            cls._index_ranges(index, newranges)
+            cls.rangeindex = (cls.noderanges, index)
+
+        # Mark that nodes have been loaded
+        cls.loaded_nodes = True
+
+    @classmethod
+    def _parse_node_file(cls, filename=None, datastr=None):
+        """ Returns the (nodeset, layer) index entries of a node file """
         if filename is not None:
             logging.info("Loading node file '%s'", filename)
-            with open(filename) as nodefd:
-                nodedata = yaml.load(nodefd, Loader=Loader) or {}
-        elif datastr is not None:
+            st = os.stat(filename)
+            nodedata = Snapshot.load_yaml(filename) or {}
+        else:
             filename = 'datastr'
             nodedata = yaml.load(datastr, Loader=Loader) or {}
 
-        # Load the data into the node structures
+        # Build the index entries for this file
+        newranges = list()
         for noderange, data in nodedata.items():
             ns1 = NodeSet(noderange)
 
@@ -325,20 +592,162 @@ class Node(object):
                                  nodeset=ns1,
                                  data=data
                                 )
+            newranges.append((ns1, newlayer))
 
-            for node_nodeset_index, node in enumerate(ns1):
-                # Optimization to skip nodes we don't care about
-                if nodeset is not None and node not in nodeset:
-                    continue
-                if node not in cls.nodes:
-                    cls.nodes[node] = Node(node)
-
-                # Add the layer to the node
-                cls.nodes[node].addlayer(newlayer)
+        if filename != 'datastr':
+            cls.nodefiles[filename] = (Snapshot._stat_key(st), newranges)
+        return newranges
 
-        # Mark that nodes have been loaded
+    @classmethod
+    def reload_nodes(cls):
+        """ Rebuilds the noderange index off to the side and swaps it in.
+            Files whose stats did not change keep their parsed noderanges,
+            so only edited files are parsed again. Nodes are rebuilt on
+            demand; anyone still holding a Node from before the swap keeps
+            a consistent view of the old configuration.
+        """
+        cls.watch_nodes()
+        newranges = list()
+        nodefiles = dict()
+        for filename in cls.node_files():
+            st = os.stat(filename)
+            try:
+                (stat_key, ranges) = cls.nodefiles[filename]
+            except KeyError:
+                stat_key = None
+            if stat_key != Snapshot._stat_key(st):
+                ranges = cls._parse_node_file(filename)
+            else:
+                logging.debug("Node file '%s' is unchanged", filename)
+            nodefiles[filename] = cls.nodefiles[filename]
+            newranges.extend(ranges)
+
+        newmap = cls._read_nodemap()
+        newindex = dict()
+        cls._index_ranges(newindex, newranges)
+
+        # _build_node reads nodes before noderanges, so swapping noderanges
+        # first means a node built from old ranges never lands in the new
+        # table. Each assignment is atomic on its own.
+        cls.nodefiles = nodefiles
+        cls.rangeindex = (newranges, newindex)
+        cls.noderanges = newranges
+        cls.nodemap = newmap
+        cls.loaded_nodemap = True
+        cls.nodeset_cache = dict()
+        cls.nodes = dict()
         cls.loaded_nodes = True
 
+    @classmethod
+    def watch_nodes(cls):
+        """ Has FileWatcher rebuild the nodes when their files change """
+        def files():
+            confdir = Path(phoenix.conf_path)
+            return cls.node_files() + [confdir / 'nodes.d', confdir / 'nodemap.yaml']
+        # Plugins read settings, networks, groups and the cray_ex layout
+        FileWatcher.watch('nodes', files, cls.reload_nodes, depends=['system', 'network', 'groups', 'cray_ex'])
+
+    @classmethod
+    def node_files(cls):
+        """ Returns the node files to load: nodes.yaml and nodes.d/*.yaml """
+        confdir = Path(phoenix.conf_path)
+        fragdir = confdir / 'nodes.d'
+        fragments = list()
+        if fragdir.is_dir():
+            fragments = sorted([str(x) for x in fragdir.glob('*.yaml')])
+        # nodes.yaml is only optional if there are fragments
+        if len(fragments) == 0 or (confdir / 'nodes.yaml').exists():
+            fragments.insert(0, str(confdir / 'nodes.yaml'))
+        return fragments
+
+    @classmethod
+    def _range_index(cls, noderanges=None):
+        """ Returns a dict of node name -> layers of every noderange that
+            contains it, in order. It is built the first time a list of
+            noderanges is looked up, then load_nodes extends it.
+        """
+        if noderanges is None:
+            noderanges = cls.noderanges
+        (indexed, index) = cls.rangeindex
+        if indexed is not noderanges:
+            index = dict()
+            cls._index_ranges(index, noderanges)
+            cls.rangeindex = (noderanges, index)
+        return index
+
+    @staticmethod
+    def _index_ranges(index, noderanges):
+        for ns1, layer in noderanges:
+            for name in ns1:
+                index.setdefault(name, list()).append(layer)
+
+    @classmethod
+    def _build_node(cls, name, noderanges=None):
+        """ Creates a node with the layers of every indexed noderange that
+            contains it
+        """
+        nodes = cls.nodes
+        node = Node(name)
+        for layer in cls._range_index(noderanges).get(name, []):
+            node.addlayer(layer)
+        nodes[name] = node
+        return node
+
+    @classmethod
+    def indexed_nodes(cls):
+        """ Returns a NodeSet of every node in the noderange index """
+        nodes = NodeSet()
+        for ns1, layer in cls.noderanges:
+            nodes.update(ns1)
+        return nodes
+
+    @classmethod
+    def _is_indexed(cls, name):
+        return name in cls._range_index()
+
+    @classmethod
+    def map_nodes(cls, nodes, func, jobs=None):
+        """ Calls func(node) for every node name in nodes and returns a list
+            of (name, result) in the same order. The names are split into
+            shards that a pool of forked workers resolves, so plugins and
+            templates run on every core. Results must be picklable, which
+            resolve_nodes takes care of. jobs defaults to the number of cpus;
+            with one job, or one shard, everything runs in this process.
+        """
+        names = list(nodes)
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        # A few shards per worker evens out nodes that are slower to resolve
+        size = max(cls.shard_size, -(-len(names) // (jobs * 4)))
+        shards = [names[i:i + size] for i in range(0, len(names), size)]
+
+        # Workers get everything parsed so far with the fork
+        if not cls.loaded_nodes:
+            cls.load_nodes(nodeset=NodeSet())
+        if not cls.loaded_functions:
+            cls.load_functions()
+        if not Network.loaded_config:
+            Network.load_config()
+        cls.map_function = func
+
+        results = list()
+        if jobs <= 1 or len(shards) <= 1:
+            for shard in shards:
+                results.extend(_map_shard(shard))
+            return results
+        logging.info("Resolving %d nodes with %d workers", len(names), min(jobs, len(shards)))
+        with multiprocessing.get_context('fork').Pool(min(jobs, len(shards))) as pool:
+            for shard in pool.imap(_map_shard, shards):
+                results.extend(shard)
+        return results
+
+    @classmethod
+    def resolve_nodes(cls, nodes, keys=None, jobs=None):
+        """ Returns a dict of node name to the exported attributes (all of
+            them if keys is None) of every node in nodes, see map_nodes
+        """
+        return dict(cls.map_nodes(nodes, lambda node: node.export(keys), jobs=jobs))
+
     @classmethod
     def _load_nodemap(cls, filename=None, ndoeset=None, clear=False):
         """ Reads and processes a nodemap yaml file
@@ -347,38 +756,53 @@ class Node(object):
         if clear:
             cls.nodemap = dict()
 
+        cls.nodemap.update(cls._read_nodemap(filename))
+        cls.loaded_nodemap = True
+
+    @classmethod
+    def _read_nodemap(cls, filename=None):
+        """ Returns a nodemap yaml file as a dict mapping both ways """
         if filename is None:
             filename = "%s/nodemap.yaml" % phoenix.conf_path
 
         # Read the yaml file
         logging.info("Trying to load nodemap file '%s'", filename)
+        nodemap = dict()
         try:
-            with open(filename) as nodemapfd:
-                nodemapdata = yaml.load(nodemapfd, Loader=Loader) or {}
+            nodemapdata = Snapshot.load_yaml(filename) or {}
 
-            cls.nodemap.update(nodemapdata)
-            cls.nodemap.update({v: k for k, v in nodemapdata.items()})
+            nodemap.update(nodemapdata)
+            nodemap.update({v: k for k, v in nodemapdata.items()})
         except:
             logging.info("Could not load nodemap")
-
-        cls.loaded_nodemap = True
+        return nodemap
 
     @classmethod
     def find_node(cls, node):
         if not cls.loaded_nodes:
-            cls.load_nodes()
+            # Only index the noderanges, nodes are built as they are found
+            cls.load_nodes(nodeset=NodeSet())
         try:
             return cls.nodes[node]
         except KeyError:
-            if not cls.loaded_nodemap:
-                cls._load_nodemap()
-            try:
-                n2 = cls.nodemap[node]
-                logging.debug("Didn't find node %s but nodemap maps that to %s", node, n2)
-            except:
-                logging.debug("Nodemap did not map %s", node)
-                raise KeyError(node)
+            pass
+        if cls._is_indexed(node):
+            return cls._build_node(node)
+        if not cls.loaded_nodemap:
+            cls._load_nodemap()
+        try:
+            n2 = cls.nodemap[node]
+            logging.debug("Didn't find node %s but nodemap maps that to %s", node, n2)
+        except:
+            logging.debug("Nodemap did not map %s", node)
+            raise KeyError(node)
+        try:
             return cls.nodes[n2]
+        except KeyError:
+            pass
+        if not cls._is_indexed(n2):
+            raise KeyError(node)
+        return cls._build_node(n2)
 
     @classmethod
     def node_alias(cls, node):
@@ -397,19 +821,76 @@ class Node(object):
         logging.debug("Inside find_plugin")
         if name not in cls.plugins:
             try:
-                cls.plugins['name'] = importlib.import_module("phoenix.plugins.%s" % name)
+                cls.plugins[name] = importlib.import_module("phoenix.plugins.%s" % name)
             except Exception as e:
                 logging.debug(e)
                 raise
-        return cls.plugins['name']
+        return cls.plugins[name]
+
+    @classmethod
+    def run_plugins_bulk(cls, nodes):
+        """ Runs plugins for many nodes at once. A plugin that provides
+            set_nodes_attrs(nodes, layers, aliases) is called once with all
+            of its nodes, other plugins go through run_plugins per node.
+        """
+        batches = dict()
+        for node in nodes:
+            if node.ran_plugins:
+                continue
+            # Same view of the node that run_plugins gets from resolve
+            node.resolving = True
+            node.ran_plugins = True
+            # Read the layers directly, resolving would link the model
+            if 'plugin' in node.data:
+                plugin_name = node.data['plugin']
+            else:
+                node['plugin'] = 'generic'
+                plugin_name = 'generic'
+            batches.setdefault(plugin_name, list()).append(node)
+
+        for plugin_name, batch in batches.items():
+            plugin = cls.find_plugin(plugin_name)
+            if not hasattr(plugin, 'set_nodes_attrs'):
+                for node in batch:
+                    node.ran_plugins = False
+                    node.resolving = False
+                    node.run_plugins()
+                continue
+
+            logging.info("Running plugin %s for %d nodes", plugin_name, len(batch))
+            layers = list()
+            aliases = list()
+            for node in batch:
+                node.in_plugin = True
+                plugin_layer = NodeLayer(layertype='nodeplugin')
+                node.addlayer(plugin_layer, position=999)
+                layers.append(plugin_layer)
+                aliases.append(cls.node_alias(node.name))
+            try:
+                plugin.set_nodes_attrs(batch, layers=layers, aliases=aliases)
+            except Exception as E:
+                cls._log_plugin_exception(E)
+                raise
+            finally:
+                for node in batch:
+                    node.in_plugin = False
+                    node.resolving = False
+
+    @staticmethod
+    def _log_plugin_exception(E):
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        while exc_tb.tb_next != None:
+            exc_tb = exc_tb.tb_next 
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        logging.error("Plugin caught exception: %s. %s:%d", repr(E), fname, exc_tb.tb_lineno)
 
     def run_plugins(self):
         if self.ran_plugins:
             return
         self.ran_plugins = True
 
-        if 'plugin' in self:
-            plugin_name = self['plugin']
+        if 'plugin' in self.data:
+            plugin_name = self.data['plugin']
         else:
             self['plugin'] = 'generic'
             plugin_name = 'generic'
@@ -431,11 +912,7 @@ class Node(object):
             plugin.set_node_attrs(self, layer=plugin_layer, alias=alias)
             self.in_plugin = False
         except Exception as E:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            while exc_tb.tb_next != None:
-                exc_tb = exc_tb.tb_next 
-            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            logging.error("Plugin caught exception: %s. %s:%d", repr(E), fname, exc_tb.tb_lineno)
+            self._log_plugin_exception(E)
             raise
 
     def link_model(self):
@@ -452,7 +929,7 @@ class Node(object):
         if cls.loaded_functions:
             return
         logging.info("Loading Jinja templates")
-        cls.environment = Environment()
+        cls.environment = Environment(bytecode_cache=phoenix.get_bytecode_cache())
         cls.environment.loader = ChoiceLoader([
             FileSystemLoader([Path(phoenix.conf_path) / 'templates']),
             PackageLoader('phoenix', 'templates')
@@ -467,6 +944,72 @@ class Node(object):
         cls.environment.globals['racklist'] = System.racklist
         cls.environment.globals['rackindex'] = System.rackindex
         cls.loaded_functions = True
+        cls.watch_templates()
+
+    @classmethod
+    def watch_templates(cls):
+        """ Has FileWatcher drop cached templates when the files change """
+        def files():
+            templatedir = Path(phoenix.conf_path) / 'templates'
+            if not templatedir.is_dir():
+                return []
+            return [templatedir] + sorted(templatedir.rglob('*'))
+        def reload():
+            cls.watch_templates()
+            if cls.environment.cache is not None:
+                cls.environment.cache.clear()
+        FileWatcher.watch('templates', files, reload)
+
+    @classmethod
+    def compile_template(cls, templatestr):
+        ''' Compiles a template string, sharing the result with any other
+            value using the same string and going through the bytecode
+            cache like file templates do
+        '''
+        try:
+            return cls.compiled_templates[templatestr]
+        except KeyError:
+            pass
+        env = cls.environment
+        if env.bytecode_cache is None:
+            template = env.from_string(templatestr)
+        else:
+            name = '<string %s>' % hashlib.sha1(templatestr.encode()).hexdigest()
+            bucket = env.bytecode_cache.get_bucket(env, name, None, templatestr)
+            if bucket.code is None:
+                bucket.code = env.compile(templatestr, name)
+                env.bytecode_cache.set_bucket(bucket)
+            template = env.template_class.from_code(env, bucket.code, env.make_globals(None))
+        cls.compiled_templates[templatestr] = template
+        return template
+
+    @classmethod
+    def precompile_templates(cls, nodes=None):
+        ''' Loads every file template referenced by a node so they are
+            compiled and in the bytecode cache before they are needed
+        '''
+        if not cls.loaded_functions:
+            cls.load_functions()
+        keys = ['ipxe_template', 'ztptemplate']
+        names = set(['ipxe.j2'])
+        if nodes is None:
+            nodes = cls.nodes.values()
+            # Names given in the node files, for nodes that are not built
+            for ns1, layer in cls.noderanges:
+                for key in keys:
+                    if isinstance(layer.data.get(key), str):
+                        names.add(layer.data[key])
+        for node in nodes:
+            for key in keys:
+                if key in node:
+                    names.add(node[key])
+        for name in sorted(names):
+            try:
+                cls.environment.get_template(name)
+                logging.debug("Precompiled template %s", name)
+            except Exception as e:
+                logging.error("Could not compile template %s: %s", name, e)
+        return names
 
     @classmethod
     def nodeset_offset(cls, nodesetstr, offset=0):
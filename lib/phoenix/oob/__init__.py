@@ -2,14 +2,501 @@
 """Generic Out-Of-Band Functions"""
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
-import time # for sleep in reset - eventually remove
+import os
+import time
+import random
+import json
+import asyncio
 import logging
+import tempfile
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
+from collections import defaultdict, deque
+from pathlib import Path
+
+import phoenix
+from phoenix.system import System
 
 class OOBTimeoutError(Exception):
         pass
 
+class OOBUnreachableError(OOBTimeoutError):
+        pass
+
+class OOBConnectError(OOBTimeoutError):
+        """ No connection could be made, so the request was never sent """
+        pass
+
+class CircuitBreaker(object):
+    ''' Fails requests to a controller that is not answering right away,
+        instead of letting every node behind it wait for the connect
+        timeout. After failures connection failures in a row the host is
+        skipped for cooldown seconds. Then a single request is let through,
+        and the host is used again if it connects.
+    '''
+    settings = { 'breaker_failures': 3,
+                 'breaker_cooldown': 30,
+               }
+    loaded_settings = False
+    lock = threading.Lock()
+    # Host -> {'failures', 'until', 'probing'}
+    hosts = dict()
+
+    @classmethod
+    def _load_settings(cls):
+        if cls.loaded_settings:
+            return
+        cls.settings = dict(cls.settings)
+        cls.settings.update(System.setting('oob', default=dict()))
+        cls.loaded_settings = True
+
+    @classmethod
+    def check(cls, host):
+        ''' Raises OOBUnreachableError if no request should be sent to host '''
+        if host not in cls.hosts:
+            return
+        cls._load_settings()
+        with cls.lock:
+            entry = cls.hosts.get(host)
+            if entry is None or entry['failures'] < cls.settings['breaker_failures']:
+                return
+            if not entry['probing'] and time.monotonic() >= entry['until']:
+                # Half open, this request finds out if the host is back
+                entry['probing'] = True
+                return
+            raise OOBUnreachableError("Endpoint %s unreachable (%d connection failures)" % (host, entry['failures']))
+
+    @classmethod
+    def success(cls, host):
+        if host not in cls.hosts:
+            return
+        with cls.lock:
+            entry = cls.hosts.pop(host, None)
+        if entry is not None and entry['probing']:
+            logging.info("Endpoint %s is reachable again", host)
+
+    @classmethod
+    def release(cls, host):
+        ''' Lets another request probe host, after one that failed without
+            finding out whether it connects
+        '''
+        if host not in cls.hosts:
+            return
+        with cls.lock:
+            entry = cls.hosts.get(host)
+            if entry is not None:
+                entry['probing'] = False
+
+    @classmethod
+    def failure(cls, host):
+        cls._load_settings()
+        with cls.lock:
+            entry = cls.hosts.setdefault(host, { 'failures': 0, 'until': 0, 'probing': False })
+            entry['failures'] += 1
+            entry['probing'] = False
+            if entry['failures'] >= cls.settings['breaker_failures']:
+                if entry['failures'] == cls.settings['breaker_failures']:
+                    logging.warning("Endpoint %s is unreachable, failing requests to it for %ds",
+                                    host, cls.settings['breaker_cooldown'])
+                entry['until'] = time.monotonic() + cls.settings['breaker_cooldown']
+
+class BmcProfile(object):
+    ''' Facts discovered about a BMC or PDU, like the path of its system or
+        whether it supports sessions, so later commands don't need to ask
+        again. Each controller has a json file under cache_path holding
+        fact -> (value, time). Facts older than bmc_cache_ttl seconds are
+        discovered again. With refresh set, facts saved by earlier
+        commands are ignored and replaced.
+    '''
+    # Host -> fact -> {'value', 'time'}
+    profiles = dict()
+    lock = threading.Lock()
+    refresh = False
+    ttl = None
+
+    @classmethod
+    def _profile_file(cls, host):
+        return Path(phoenix.cache_path) / 'bmc' / ('%s.json' % host.replace('/', '_'))
+
+    @classmethod
+    def _profile(cls, host):
+        try:
+            return cls.profiles[host]
+        except KeyError:
+            pass
+        profile = dict()
+        if not cls.refresh:
+            try:
+                with open(cls._profile_file(host)) as fd:
+                    profile = json.load(fd)
+            except (OSError, ValueError):
+                pass
+        cls.profiles[host] = profile
+        return profile
+
+    @classmethod
+    def get(cls, host, fact, default=None):
+        ''' Returns a fact about a host, or default if it is unknown or too old '''
+        if cls.ttl is None:
+            cls.ttl = System.setting('bmc_cache_ttl', 86400)
+        with cls.lock:
+            entry = cls._profile(host).get(fact)
+        if entry is None or entry.get('time', 0) + cls.ttl < time.time():
+            return default
+        return entry.get('value')
+
+    @classmethod
+    def set(cls, host, fact, value):
+        ''' Records a fact about a host and saves the profile '''
+        with cls.lock:
+            profile = cls._profile(host)
+            old = profile.get(fact)
+            if old is not None and old.get('value') == value and old.get('time', 0) + 60 > time.time():
+                # Another node behind the same controller just found the same
+                return
+            profile[fact] = { 'value': value, 'time': time.time() }
+            profilefile = cls._profile_file(host)
+            try:
+                profilefile.parent.mkdir(parents=True, exist_ok=True)
+                (tmpfd, tmpname) = tempfile.mkstemp(dir=profilefile.parent, prefix='.tmp')
+                try:
+                    with os.fdopen(tmpfd, 'w') as fd:
+                        json.dump(profile, fd)
+                    os.replace(tmpname, profilefile)
+                except:
+                    os.unlink(tmpname)
+                    raise
+            except OSError as e:
+                logging.debug("Could not save the profile of %s: %s", host, e)
+
+class ResourceCache(object):
+    ''' Resources read from controllers by the command running in this
+        context, by (host, path). Commands that need several attributes of
+        one resource, like the memory and the processors of a system, only
+        read it once. Each node's command has its own context, with the
+        thread pool and with the asyncio engine, so nothing is shared
+        between nodes or kept after the command is done.
+    '''
+    resources = contextvars.ContextVar('phoenix_resources', default=None)
+
+    @classmethod
+    @contextlib.contextmanager
+    def scope(cls):
+        token = cls.resources.set(dict())
+        try:
+            yield
+        finally:
+            cls.resources.reset(token)
+
+    @classmethod
+    def get(cls, host, path):
+        resources = cls.resources.get()
+        if resources is None:
+            return None
+        return resources.get((host, path))
+
+    @classmethod
+    def put(cls, host, path, value):
+        resources = cls.resources.get()
+        if resources is not None:
+            resources[(host, path)] = value
+
+    @classmethod
+    def invalidate(cls, host):
+        ''' Forgets what was read from a host, after changing something on it '''
+        resources = cls.resources.get()
+        if resources is not None:
+            for key in [key for key in resources if key[0] == host]:
+                del resources[key]
+
+class RequestPolicy(object):
+    ''' Retries and hedging of requests to controllers. A failed request is
+        sent again up to retries times, after a random delay of up to
+        retry_delay seconds that doubles with every attempt (capped at
+        retry_max_delay). Reads are retried after timeouts, server errors
+        and dropped connections, other requests only when no connection
+        could be made. With hedge set, a read that takes longer than
+        hedge_percentile of the reads in this run is sent a second time
+        and the first answer is used. The retries and hedges of each
+        node's command are counted on its client.
+    '''
+    settings = { 'retries':           2,
+                 'retry_delay':       0.5,
+                 'retry_max_delay':   5,
+                 'hedge':             False,
+                 'hedge_percentile':  95,
+                 'hedge_min_samples': 20,
+                 'hedge_threads':     32,
+               }
+    loaded_settings = False
+    client = contextvars.ContextVar('phoenix_client', default=None)
+    # Seconds taken by recent reads
+    latencies = deque(maxlen=1000)
+    executor = None
+    lock = threading.Lock()
+
+    @classmethod
+    def _load_settings(cls):
+        if cls.loaded_settings:
+            return
+        cls.settings = dict(cls.settings)
+        cls.settings.update(System.setting('oob', default=dict()))
+        cls.loaded_settings = True
+
+    @classmethod
+    @contextlib.contextmanager
+    def scope(cls, client):
+        token = cls.client.set(client)
+        try:
+            yield
+        finally:
+            cls.client.reset(token)
+
+    @classmethod
+    def _count(cls, counter):
+        client = cls.client.get()
+        if client is not None:
+            setattr(client, counter, getattr(client, counter, 0) + 1)
+
+    @classmethod
+    def _retry(cls, attempt, reason):
+        ''' Returns the delay before the next attempt, or None to give up '''
+        cls._load_settings()
+        if attempt >= cls.settings['retries']:
+            return None
+        cls._count('retries')
+        delay = random.uniform(0, min(cls.settings['retry_delay'] * 2 ** attempt, cls.settings['retry_max_delay']))
+        logging.debug("Retrying after %s in %.2fs", reason, delay)
+        return delay
+
+    @classmethod
+    def retry(cls, attempt, reason):
+        ''' Waits before attempt + 1, returns False if there are no retries left '''
+        delay = cls._retry(attempt, reason)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    @classmethod
+    async def retry_async(cls, attempt, reason):
+        delay = cls._retry(attempt, reason)
+        if delay is None:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    @classmethod
+    def _hedge_delay(cls):
+        ''' Returns how long a read may take before it is hedged, or None '''
+        samples = sorted(cls.latencies)
+        if len(samples) < cls.settings['hedge_min_samples']:
+            return None
+        return samples[min(len(samples) - 1, len(samples) * cls.settings['hedge_percentile'] // 100)]
+
+    @classmethod
+    def hedged(cls, func, *args):
+        ''' Calls func, a read that can safely be sent twice '''
+        cls._load_settings()
+        if not cls.settings['hedge']:
+            return func(*args)
+        delay = cls._hedge_delay()
+        start = time.monotonic()
+        if delay is None:
+            result = func(*args)
+        else:
+            with cls.lock:
+                if cls.executor is None:
+                    cls.executor = concurrent.futures.ThreadPoolExecutor(max_workers=cls.settings['hedge_threads'],
+                                                                         thread_name_prefix="phoenix_hedge")
+            first = cls.executor.submit(contextvars.copy_context().run, func, *args)
+            try:
+                result = first.result(timeout=delay)
+            except concurrent.futures.TimeoutError:
+                cls._count('hedges')
+                second = cls.executor.submit(contextvars.copy_context().run, func, *args)
+                pending = {first, second}
+                while True:
+                    (done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    answered = [future for future in done if future.exception() is None]
+                    if answered or not pending:
+                        result = (answered or list(done))[0].result()
+                        break
+        cls.latencies.append(time.monotonic() - start)
+        return result
+
+    @classmethod
+    async def hedged_async(cls, func, *args):
+        ''' Coroutine version of hedged, func is a coroutine function '''
+        cls._load_settings()
+        if not cls.settings['hedge']:
+            return await func(*args)
+        delay = cls._hedge_delay()
+        start = time.monotonic()
+        if delay is None:
+            result = await func(*args)
+        else:
+            pending = {asyncio.ensure_future(func(*args))}
+            try:
+                (done, pending) = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    cls._count('hedges')
+                    pending.add(asyncio.ensure_future(func(*args)))
+                while True:
+                    if not done:
+                        (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    answered = [task for task in done if task.exception() is None]
+                    if answered or not pending:
+                        result = (answered or list(done))[0].result()
+                        break
+                    done = set()
+            finally:
+                for task in pending:
+                    task.cancel()
+        cls.latencies.append(time.monotonic() - start)
+        return result
+
+# Returned by a command instead of a return code when something else, like
+# the PowerPoller, is going to complete the node later
+PENDING = object()
+
+class PowerPoller(object):
+    ''' Waits for nodes to reach a power state without keeping a worker
+        thread busy for each one. Every node is polled with an interval
+        that grows from interval to max_interval seconds. The nodes behind
+        one BMC or PDU are polled one after the other by a single job, so
+        a controller never sees more than one poll at a time.
+    '''
+    settings = { 'interval':     1,
+                 'max_interval': 10,
+                 'backoff':      1.5,
+                 'threads':      32,
+               }
+    loaded_settings = False
+    cond = threading.Condition()
+    entries = list()
+    # Controllers with a poll job running
+    busy = set()
+    thread = None
+    executor = None
+
+    @classmethod
+    def _load_settings(cls):
+        if cls.loaded_settings:
+            return
+        cls.settings = dict(cls.settings)
+        cls.settings.update(System.setting('poller', default=dict()))
+        cls.loaded_settings = True
+
+    @classmethod
+    def add(cls, client, oobcls, target, timeout=180, then=None):
+        ''' Completes the client once its node is in the target state. If
+            then is set, that action is run first, even if the target was
+            not reached within timeout seconds. Returns PENDING.
+        '''
+        cls._load_settings()
+        try:
+            controller = client.node[oobcls.oobtype]
+        except KeyError:
+            controller = client.node['name']
+        now = time.monotonic()
+        entry = { 'client':     client,
+                  'oobcls':     oobcls,
+                  'target':     target.lower(),
+                  'then':       then,
+                  'controller': controller,
+                  'deadline':   now + timeout,
+                  'interval':   cls.settings['interval'],
+                  'next':       now + cls.settings['interval'],
+                }
+        with cls.cond:
+            if cls.thread is None:
+                cls.executor = concurrent.futures.ThreadPoolExecutor(max_workers=cls.settings['threads'],
+                                                                     thread_name_prefix="phoenix_poller")
+                cls.thread = threading.Thread(target=cls._run, name="phoenix_poller", daemon=True)
+                cls.thread.start()
+            cls.entries.append(entry)
+            cls.cond.notify()
+        return PENDING
+
+    @classmethod
+    def _run(cls):
+        while True:
+            with cls.cond:
+                now = time.monotonic()
+                waiting = [entry for entry in cls.entries if entry['controller'] not in cls.busy]
+                due = [entry for entry in waiting if entry['next'] <= now]
+                if not due:
+                    timeout = min([entry['next'] for entry in waiting], default=now + 60) - now
+                    cls.cond.wait(timeout)
+                    continue
+                groups = defaultdict(list)
+                for entry in due:
+                    groups[entry['controller']].append(entry)
+                cls.busy.update(groups)
+            for (controller, group) in groups.items():
+                cls.executor.submit(cls._poll, controller, group)
+
+    @classmethod
+    def _poll(cls, controller, group):
+        done = list()
+        for entry in group:
+            try:
+                if cls._check(entry):
+                    done.append(entry)
+            except Exception as e:
+                entry['client'].output("Power request failed: %s (%s)" % (type(e).__name__, e), stderr=True)
+                entry['client'].mark_command_complete(rc=1)
+                done.append(entry)
+        with cls.cond:
+            now = time.monotonic()
+            for entry in group:
+                if entry in done:
+                    cls.entries.remove(entry)
+                else:
+                    entry['interval'] = min(entry['interval'] * cls.settings['backoff'], cls.settings['max_interval'])
+                    entry['next'] = now + entry['interval']
+            cls.busy.discard(controller)
+            cls.cond.notify()
+
+    @classmethod
+    def _check(cls, entry):
+        ''' Polls one node, returns True once it is complete '''
+        client = entry['client']
+        oobcls = entry['oobcls']
+        if client.closed:
+            # Timed out or aborted in the meantime
+            return True
+        try:
+            (ok, state) = oobcls._power_state(client.node, auth=oobcls._get_auth(client.node))
+        except OOBUnreachableError as e:
+            client.output(str(e), stderr=True)
+            client.mark_command_complete(rc=1)
+            return True
+        except OOBTimeoutError as e:
+            logging.debug("Polling %s timed out: %s", client.node['name'], e)
+            (ok, state) = (False, None)
+        reached = ok and state.lower() == entry['target']
+        if not reached and time.monotonic() < entry['deadline']:
+            return False
+        if entry['then'] is not None:
+            rc = oobcls.power(client.node, client, [entry['then']])
+        elif reached:
+            client.set_state(state)
+            client.output(state)
+            rc = 0
+        else:
+            client.output("Timed out waiting for power state %s" % entry['target'], stderr=True)
+            rc = 1
+        client.mark_command_complete(rc=rc)
+        return True
+
 class Oob(object):
     oobtype = "unknown"
+    # Set by classes that implement the *_async coroutines
+    has_async = False
 
     @classmethod
     def _get_auth(cls, node):
@@ -59,23 +546,67 @@ class Oob(object):
                     client.output(state, stderr=not ok)
                     return 0 if ok else 1
                 except NotImplementedError:
-                    # Fix to use off '--wait' instead of an arbitrary sleep
+                    # Power on once the node is off, or after a minute
                     cls._power_off(node, cls._get_auth(node))
-                    time.sleep(60)
-                    cls._power_on(node, cls._get_auth(node))
-                    client.output("Ok")
-                    client.set_state("Ok")
-                    return 1
+                    return PowerPoller.add(client, cls, 'off', timeout=60, then='on')
             else:
                 state = 'Error'
                 client.output("Invalid requested node state command (%s)" % command, stderr=True)
                 return -1
+        except OOBUnreachableError as e:
+            client.output(str(e), stderr=True)
+            return 1
         except OOBTimeoutError as e:
             client.output("Connection timeout", stderr=True)
         except Exception as e:
             client.output("Power request failed: %s (%s)" % (type(e).__name__, e), stderr=True)
             raise
 
+    @classmethod
+    def preconnect(cls, host):
+        ''' Opens the connections a command is going to need to a host '''
+        pass
+
+    @classmethod
+    async def preconnect_async(cls, host):
+        pass
+
+    @classmethod
+    async def power_async(cls, node, client, args):
+        ''' Coroutine version of power for the asyncio engine '''
+        command = args[0].lower()
+        logging.debug("inside power_async command: {0}".format(command))
+
+        try:
+            if command in ['stat', 'state', 'status', 'query']:
+                (ok, state) = await cls._power_state_async(node, auth=cls._get_auth(node))
+            elif command in ['on']:
+                (ok, state) = await cls._power_on_async(node, cls._get_auth(node))
+            elif command in ['off']:
+                (ok, state) = await cls._power_off_async(node, cls._get_auth(node))
+            elif command in ['forceoff']:
+                (ok, state) = await cls._power_forceoff_async(node, cls._get_auth(node))
+            elif command in ['reset', 'restart']:
+                try:
+                    (ok, state) = await cls._power_reset_async(node, cls._get_auth(node))
+                except NotImplementedError:
+                    await cls._power_off_async(node, cls._get_auth(node))
+                    return PowerPoller.add(client, cls, 'off', timeout=60, then='on')
+            else:
+                client.output("Invalid requested node state command (%s)" % command, stderr=True)
+                return -1
+            client.set_state(state)
+            client.output(state, stderr=not ok)
+            return 0 if ok else 1
+        except OOBUnreachableError as e:
+            client.output(str(e), stderr=True)
+            return 1
+        except OOBTimeoutError:
+            client.output("Connection timeout", stderr=True)
+        except Exception as e:
+            client.output("Power request failed: %s (%s)" % (type(e).__name__, e), stderr=True)
+            raise
+
     @classmethod
     def _power_state(cls, node):
         raise NotImplementedError
@@ -89,7 +620,11 @@ class Oob(object):
         raise NotImplementedError
 
     @classmethod
-    def _power_reset(cls, node):
+    def _power_reset(cls, node, auth=None):
+        raise NotImplementedError
+
+    @classmethod
+    async def _power_reset_async(cls, node, auth=None):
         raise NotImplementedError
 
     @classmethod
@@ -123,6 +658,9 @@ class Oob(object):
                 (ok, state) = cls._firmware_upgrade(node, url, fwtype=fwtype, auth=cls._get_auth(node))
                 client.output(state, stderr=not ok)
                 return 0 if ok else 1
+        except OOBUnreachableError as e:
+            client.output(str(e), stderr=True)
+            return 1
         except OOBTimeoutError as e:
             client.output("Connection timeout", stderr=True)
         except Exception as e:
@@ -143,6 +681,9 @@ class Oob(object):
             (ok, state) = cls._inventory(node, args)
             client.output(state, stderr=not ok)
             return 0 if ok else 1
+        except OOBUnreachableError as e:
+            client.output(str(e), stderr=True)
+            return 1
         except OOBTimeoutError as e:
             client.output("Connection timeout", stderr=True)
         except Exception as e:
@@ -159,6 +700,9 @@ class Oob(object):
             (ok, state) = cls._bios(node, args)
             client.output(state, stderr=not ok)
             return 0 if ok else 1
+        except OOBUnreachableError as e:
+            client.output(str(e), stderr=True)
+            return 1
         except OOBTimeoutError as e:
             client.output("Connection timeout", stderr=True)
         except Exception as e:
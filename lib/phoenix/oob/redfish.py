@@ -2,18 +2,38 @@
 """Redfish BMC Functions"""
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
+import os
+import time
 import logging
 import requests
+import requests.adapters
+import threading
+import tempfile
+import asyncio
 import json
 import re
+from pathlib import Path
 
-from phoenix.oob import OOBTimeoutError
+try:
+    import aiohttp
+    has_aiohttp = True
+    # The BMC could not be reached at all, as opposed to a slow reply.
+    # ConnectionTimeoutError was added in aiohttp 3.10.
+    aiohttp_connect_errors = (aiohttp.ClientConnectorError,) + \
+                             ((aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, 'ConnectionTimeoutError') else ())
+except ImportError:
+    has_aiohttp = False
+
+import phoenix
+from phoenix.oob import OOBTimeoutError, OOBUnreachableError, OOBConnectError, CircuitBreaker, RequestPolicy
 from phoenix.command import CommandTimeout
 from phoenix.system import System
 
 # This is needed to turn off SSL warnings
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.exceptions import InsecureRequestWarning, NewConnectionError
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+# Nodes sharing a BMC or PDU overflow its connection pool, which is expected
+logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
 
 import yaml
 try:
@@ -22,12 +42,328 @@ except ImportError:
     logging.info("Unable to load CLoader and/or CDumper")
     from yaml import Loader, Dumper
 
-from phoenix.oob import Oob
+from phoenix.oob import Oob, BmcProfile, ResourceCache
+from phoenix.parallel import AsyncEngine
 
 class RedfishError(Exception):
     pass
 
+class RedfishResponse(object):
+    ''' The parts of a requests response used here, for aiohttp replies '''
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
 class Redfish(Oob):
+    has_async = has_aiohttp
+    # Event loop -> aiohttp session used by the asyncio engine
+    sessions = dict()
+    # Host -> requests session, which keeps the connections to the BMC open
+    hostsessions = dict()
+    sessionlock = threading.Lock()
+    settings = { 'pool_size':      4,
+                 'sessions':       True,
+                 'session_ttl':    1800,
+                 'expand':         True,
+                 'expand_ttl':     1.0,
+               }
+    loaded_settings = False
+    # Host -> SessionService token entry, see _auth_token
+    tokens = dict()
+    tokenlocks = dict()
+    asynctokenlocks = dict()
+    # Host -> semaphore bounding the requests in flight to it
+    endpoint_slots = dict()
+    async_endpoint_slots = dict()
+    # (host, collection) -> shared $expand fetch, see _expanded_member
+    collections = dict()
+    async_collections = dict()
+
+    @classmethod
+    def _load_settings(cls):
+        if Redfish.loaded_settings:
+            return
+        Redfish.settings = dict(Redfish.settings)
+        Redfish.settings.update(System.setting('redfish', default=dict()))
+        Redfish.loaded_settings = True
+
+    @classmethod
+    def _session(cls, host):
+        ''' Returns the session for a host. Every request to the same BMC
+            goes through it, so its connections are reused between requests
+            instead of doing a TCP and TLS handshake each time.
+        '''
+        try:
+            return Redfish.hostsessions[host]
+        except KeyError:
+            pass
+        with Redfish.sessionlock:
+            if host not in Redfish.hostsessions:
+                cls._load_settings()
+                session = requests.Session()
+                session.verify = False
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=Redfish.settings['pool_size'])
+                session.mount('https://', adapter)
+                Redfish.hostsessions[host] = session
+            return Redfish.hostsessions[host]
+
+    @classmethod
+    def preconnect(cls, host):
+        ''' Opens a connection to the service root of a BMC '''
+        try:
+            cls._do_redfish_req(host, "", "get", auth=None)
+        except Exception as e:
+            logging.debug("Preconnecting to %s failed: %s", host, e)
+
+    @classmethod
+    async def preconnect_async(cls, host):
+        try:
+            await cls._do_redfish_req_async(host, "", "get", auth=None)
+        except Exception as e:
+            logging.debug("Preconnecting to %s failed: %s", host, e)
+
+    @classmethod
+    def _session_file(cls, host):
+        return Path(phoenix.cache_path) / 'redfish' / 'sessions' / host.replace('/', '_')
+
+    @staticmethod
+    def _secure_dir(directory):
+        ''' Creates a directory only the user running phoenix can access.
+            Returns False if it belongs to someone else.
+        '''
+        directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = directory.stat()
+        if st.st_uid != os.geteuid():
+            logging.warning("Not using %s, it is owned by uid %d", directory, st.st_uid)
+            return False
+        if st.st_mode & 0o077:
+            # mkdir does not change the mode of an existing directory
+            directory.chmod(0o700)
+        return True
+
+    @classmethod
+    def _saved_token(cls, host):
+        ''' Returns the saved session entry of a host, or None '''
+        try:
+            return Redfish.tokens[host]
+        except KeyError:
+            pass
+        sessionfile = cls._session_file(host)
+        try:
+            with open(sessionfile) as fd:
+                st = os.fstat(fd.fileno())
+                if st.st_uid != os.geteuid() or st.st_mode & 0o077:
+                    logging.warning("Ignoring %s, it is not private to uid %d", sessionfile, os.geteuid())
+                    return None
+                entry = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        Redfish.tokens[host] = entry
+        return entry
+
+    @staticmethod
+    def _valid_token(entry, user):
+        if entry is None or entry.get('user') != user or entry.get('expires', 0) < time.time():
+            return None
+        return entry.get('token')
+
+    @classmethod
+    def _save_token(cls, host, user, token, location):
+        ''' Keeps a session token for later commands. The directory is only
+            accessible to the user running phoenix, normally root.
+        '''
+        entry = { 'user': user,
+                  'token': token,
+                  'location': location,
+                  'expires': time.time() + Redfish.settings['session_ttl'],
+                }
+        Redfish.tokens[host] = entry
+        sessionfile = cls._session_file(host)
+        try:
+            if not cls._secure_dir(sessionfile.parent):
+                return
+            # mkstemp creates the file with mode 0600
+            (tmpfd, tmpname) = tempfile.mkstemp(dir=sessionfile.parent, prefix='.tmp')
+            try:
+                with os.fdopen(tmpfd, 'w') as fd:
+                    json.dump(entry, fd)
+                os.replace(tmpname, sessionfile)
+            except:
+                os.unlink(tmpname)
+                raise
+        except OSError as e:
+            logging.debug("Could not save the session of %s: %s", host, e)
+
+    @classmethod
+    def _drop_token(cls, host, token):
+        ''' Forgets a token the BMC rejected. There is nothing to log out of. '''
+        entry = Redfish.tokens.get(host)
+        if entry is None or entry.get('token') != token:
+            # Already replaced by another thread
+            return
+        logging.debug("Session of %s is no longer valid", host)
+        del Redfish.tokens[host]
+        try:
+            os.unlink(cls._session_file(host))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _session_url(host, entry):
+        ''' Returns the URL to log out of a replaced session, or None '''
+        if entry is None or not entry.get('location') or not entry.get('token'):
+            return None
+        if entry['location'].startswith('https://'):
+            return entry['location']
+        return "https://%s%s" % (host, entry['location'])
+
+    @classmethod
+    def _end_session(cls, host, entry):
+        ''' Logs out of a session that is being replaced, BMCs only allow a
+            few of them at once
+        '''
+        url = cls._session_url(host, entry)
+        if url is None:
+            return
+        logging.debug("Deleting the old Redfish session on %s", host)
+        try:
+            cls._session(host).delete(url, verify=False, headers={'X-Auth-Token': entry['token']}, timeout=(5,30))
+        except requests.RequestException as e:
+            logging.debug("Could not delete the old session on %s: %s", host, e)
+
+    @classmethod
+    async def _end_session_async(cls, host, entry):
+        ''' Coroutine version of _end_session '''
+        url = cls._session_url(host, entry)
+        if url is None:
+            return
+        logging.debug("Deleting the old Redfish session on %s", host)
+        try:
+            async with cls._async_session().delete(url, headers={'X-Auth-Token': entry['token']},
+                                                   timeout=aiohttp.ClientTimeout(sock_connect=5, sock_read=30)) as reply:
+                await reply.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.debug("Could not delete the old session on %s: %s", host, e)
+
+    @classmethod
+    def _use_sessions(cls, host, auth):
+        cls._load_settings()
+        return Redfish.settings['sessions'] and auth is not None and BmcProfile.get(host, 'sessions', True)
+
+    @classmethod
+    def _new_token(cls, host, auth, status, token, location):
+        ''' Records the outcome of a SessionService request '''
+        if status in [404, 405, 501]:
+            logging.info("%s does not support Redfish sessions (status %d), using basic authentication", host, status)
+            BmcProfile.set(host, 'sessions', False)
+            return None
+        if status not in [200, 201] or token is None:
+            # Maybe busy or out of sessions, try again with the next command
+            logging.info("Could not create a Redfish session on %s (status %d), using basic authentication", host, status)
+            return None
+        cls._save_token(host, auth[0], token, location)
+        return token
+
+    @classmethod
+    def _auth_token(cls, host, auth):
+        ''' Returns a session token for a host, creating a session if there
+            is no saved one. None means basic authentication is used.
+        '''
+        if not cls._use_sessions(host, auth):
+            return None
+        with Redfish.sessionlock:
+            lock = Redfish.tokenlocks.setdefault(host, threading.Lock())
+        # Only one session per BMC, they often have a low limit
+        with lock:
+            entry = cls._saved_token(host)
+            token = cls._valid_token(entry, auth[0])
+            if token is not None:
+                return token
+            # The host may have been given up on while waiting for the lock
+            CircuitBreaker.check(host)
+            cls._end_session(host, entry)
+            url = "https://%s/redfish/v1/SessionService/Sessions" % host
+            logging.debug("Creating a Redfish session on %s", host)
+            response = cls._session(host).post(url, verify=False, json={'UserName': auth[0], 'Password': auth[1]}, timeout=(5,30))
+            return cls._new_token(host, auth, response.status_code, response.headers.get('X-Auth-Token'),
+                                  response.headers.get('Location'))
+
+    @classmethod
+    async def _auth_token_async(cls, host, auth):
+        ''' Coroutine version of _auth_token '''
+        if not cls._use_sessions(host, auth):
+            return None
+        lock = Redfish.asynctokenlocks.setdefault(host, asyncio.Lock())
+        async with lock:
+            entry = cls._saved_token(host)
+            token = cls._valid_token(entry, auth[0])
+            if token is not None:
+                return token
+            # The host may have been given up on while waiting for the lock
+            CircuitBreaker.check(host)
+            await cls._end_session_async(host, entry)
+            url = "https://%s/redfish/v1/SessionService/Sessions" % host
+            logging.debug("Creating a Redfish session on %s", host)
+            async with cls._async_session().post(url, json={'UserName': auth[0], 'Password': auth[1]},
+                                                 timeout=aiohttp.ClientTimeout(sock_connect=5, sock_read=30)) as reply:
+                await reply.read()
+                return cls._new_token(host, auth, reply.status, reply.headers.get('X-Auth-Token'),
+                                      reply.headers.get('Location'))
+
+    @staticmethod
+    def _auth_headers(auth, token, headers):
+        ''' Returns the auth and headers to send with a session token '''
+        if token is None:
+            return (auth, headers)
+        return (None, dict(headers, **{'X-Auth-Token': token}))
+
+    @classmethod
+    def _endpoint_slot(cls, host):
+        ''' Returns the semaphore limiting concurrent requests to a host,
+            so nodes sharing a controller do not overload it
+        '''
+        try:
+            return Redfish.endpoint_slots[host]
+        except KeyError:
+            pass
+        with Redfish.sessionlock:
+            return Redfish.endpoint_slots.setdefault(host, threading.BoundedSemaphore(System.setting('endpoint_limit', 4)))
+
+    @classmethod
+    def _async_endpoint_slot(cls, host):
+        try:
+            return Redfish.async_endpoint_slots[host]
+        except KeyError:
+            return Redfish.async_endpoint_slots.setdefault(host, asyncio.Semaphore(System.setting('endpoint_limit', 4)))
+
+    @classmethod
+    def _send(cls, host, url, request_type, auth, token, data, headers, timeout):
+        with cls._endpoint_slot(host):
+            return cls._send_request(host, url, request_type, auth, token, data, headers, timeout)
+
+    @classmethod
+    def _send_request(cls, host, url, request_type, auth, token, data, headers, timeout):
+        (auth, headers) = cls._auth_headers(auth, token, headers)
+        session = cls._session(host)
+        if request_type == "get":
+            return session.get(url, verify=False, auth=auth, headers=headers, timeout=timeout)
+        elif request_type == "post":
+            return session.post(url, verify=False, auth=auth, headers=headers, json=data, timeout=timeout)
+        elif request_type == "put":
+            return session.put(url, verify=False, auth=auth, headers=headers, json=data, timeout=timeout)
+        elif request_type == "patch":
+            return session.patch(url, verify=False, auth=auth, headers=headers, json=data, timeout=timeout)
+        else:
+            raise NotImplementedError("HTTP request type %s not understood" % request_type)
+
     @classmethod
     def _do_redfish_req(cls, host, path, request_type, auth=('admin', 'password'), data={}, headers={}, timeout=(5,30)):
         """A simple redfish request - returns a requests response"""
@@ -35,27 +371,192 @@ class Redfish(Oob):
         logging.debug("Making %s request to %s", request_type, url)
         logging.debug("Data is %s", data)
 
-        try:
-            if request_type == "get":
-                response = requests.get(url, verify=False, auth=auth, timeout=timeout)
-            elif request_type == "post":
-                response = requests.post(url, verify=False, auth=auth, headers=headers, json=data, timeout=timeout)
-            elif request_type == "put":
-                response = requests.put(url, verify=False, auth=auth, headers=headers, json=data, timeout=timeout)
-            elif request_type == "patch":
-                response = requests.patch(url, verify=False, auth=auth, headers=headers, json=data, timeout=timeout)
+        response = cls._cached_response(host, path, request_type)
+        if response is not None:
+            return response
+        attempt = 0
+        while True:
+            CircuitBreaker.check(host)
+            try:
+                if request_type == "get":
+                    response = RequestPolicy.hedged(cls._try_redfish_req, host, url, request_type, auth, data, headers, timeout)
+                else:
+                    response = cls._try_redfish_req(host, url, request_type, auth, data, headers, timeout)
+            except OOBUnreachableError:
+                raise
+            except OOBTimeoutError as e:
+                if not cls._retryable_error(request_type, e) or not RequestPolicy.retry(attempt, e):
+                    raise
             else:
-                raise NotImplementedError("HTTP request type %s not understood" % request_type)
+                if not cls._retryable_status(request_type, response) or \
+                   not RequestPolicy.retry(attempt, "status %d" % response.status_code):
+                    break
+            attempt += 1
+        
+        logging.debug("Response is %s", response.text)
+        cls._cache_response(host, path, request_type, response)
+        return response
+
+    @classmethod
+    def _try_redfish_req(cls, host, url, request_type, auth, data, headers, timeout):
+        """Sends a request once, with a new session if the old one expired"""
+        try:
+            token = cls._auth_token(host, auth)
+            response = cls._send(host, url, request_type, auth, token, data, headers, timeout)
+            if token is not None and response.status_code == 401:
+                # The session timed out or was deleted on the BMC
+                cls._drop_token(host, token)
+                token = cls._auth_token(host, auth)
+                response = cls._send(host, url, request_type, auth, token, data, headers, timeout)
         except requests.ConnectTimeout as e:
+            CircuitBreaker.failure(host)
+            raise OOBConnectError(e)
+        except requests.ConnectionError as e:
+            if cls._connect_failed(e):
+                CircuitBreaker.failure(host)
+                raise OOBConnectError(e)
+            # The BMC accepted the connection, only failures to connect
+            # count against the breaker
+            CircuitBreaker.success(host)
             raise OOBTimeoutError(e)
         except requests.ReadTimeout as e:
+            CircuitBreaker.success(host)
             raise OOBTimeoutError(e)
-        except requests.ConnectionError as e:
-            raise OOBTimeoutError(e)
-        
+        except:
+            # Says nothing about the host, but must not leave it half open
+            CircuitBreaker.release(host)
+            raise
+        CircuitBreaker.success(host)
+        return response
+
+    @staticmethod
+    def _connect_failed(error):
+        """Whether a ConnectionError means no connection could be made"""
+        reason = error.args[0] if error.args else None
+        return isinstance(reason, NewConnectionError) or isinstance(getattr(reason, 'reason', None), NewConnectionError)
+
+    @staticmethod
+    def _retryable_error(request_type, error):
+        # A change that may have reached the BMC is not made twice
+        return request_type == "get" or isinstance(error, OOBConnectError)
+
+    @staticmethod
+    def _retryable_status(request_type, response):
+        return request_type == "get" and response.status_code >= 500
+
+    @staticmethod
+    def _cached_response(host, path, request_type):
+        """Returns a resource this command already read, or None"""
+        if request_type != "get":
+            # What was read before may change
+            ResourceCache.invalidate(host)
+            return None
+        response = ResourceCache.get(host, path)
+        if response is not None:
+            logging.debug("Using the response of %s from earlier in this command", path)
+        return response
+
+    @staticmethod
+    def _cache_response(host, path, request_type, response):
+        if request_type == "get" and response.status_code == 200:
+            ResourceCache.put(host, path, response)
+
+    @classmethod
+    async def _send_async(cls, url, request_type, auth, token, data, headers, timeout):
+        (auth, headers) = cls._auth_headers(auth, token, headers)
+        kwargs = { 'auth': aiohttp.BasicAuth(*auth) if auth is not None else None,
+                   'headers': headers,
+                   'timeout': aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1]),
+                 }
+        if request_type != "get":
+            kwargs['json'] = data
+        async with cls._async_session().request(request_type.upper(), url, **kwargs) as reply:
+            return RedfishResponse(reply.status, await reply.read())
+
+    @classmethod
+    async def _do_redfish_req_async(cls, host, path, request_type, auth=('admin', 'password'), data={}, headers={}, timeout=(5,30)):
+        """Coroutine version of _do_redfish_req - returns a RedfishResponse"""
+        url = "https://%s/redfish/v1/%s" % (host, path)
+        logging.debug("Making %s request to %s", request_type, url)
+        logging.debug("Data is %s", data)
+
+        if request_type not in ["get", "post", "put", "patch"]:
+            raise NotImplementedError("HTTP request type %s not understood" % request_type)
+        response = cls._cached_response(host, path, request_type)
+        if response is not None:
+            return response
+        attempt = 0
+        while True:
+            CircuitBreaker.check(host)
+            try:
+                if request_type == "get":
+                    response = await RequestPolicy.hedged_async(cls._try_redfish_req_async, host, url, request_type, auth, data, headers, timeout)
+                else:
+                    response = await cls._try_redfish_req_async(host, url, request_type, auth, data, headers, timeout)
+            except OOBUnreachableError:
+                raise
+            except OOBTimeoutError as e:
+                if not cls._retryable_error(request_type, e) or not await RequestPolicy.retry_async(attempt, e):
+                    raise
+            else:
+                if not cls._retryable_status(request_type, response) or \
+                   not await RequestPolicy.retry_async(attempt, "status %d" % response.status_code):
+                    break
+            attempt += 1
+
         logging.debug("Response is %s", response.text)
+        cls._cache_response(host, path, request_type, response)
+        return response
+
+    @classmethod
+    async def _try_redfish_req_async(cls, host, url, request_type, auth, data, headers, timeout):
+        """Coroutine version of _try_redfish_req"""
+        try:
+            token = await cls._auth_token_async(host, auth)
+            async with cls._async_endpoint_slot(host):
+                response = await cls._send_async(url, request_type, auth, token, data, headers, timeout)
+            if token is not None and response.status_code == 401:
+                cls._drop_token(host, token)
+                token = await cls._auth_token_async(host, auth)
+                async with cls._async_endpoint_slot(host):
+                    response = await cls._send_async(url, request_type, auth, token, data, headers, timeout)
+        except aiohttp_connect_errors as e:
+            CircuitBreaker.failure(host)
+            raise OOBConnectError(e)
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            # Connected, like a reset on a pooled connection or a slow reply
+            CircuitBreaker.success(host)
+            raise OOBTimeoutError(e)
+        except:
+            # Including a cancelled hedge
+            CircuitBreaker.release(host)
+            raise
+        CircuitBreaker.success(host)
         return response
 
+    @classmethod
+    def _async_session(cls):
+        ''' Returns the aiohttp session of the running event loop '''
+        loop = asyncio.get_running_loop()
+        try:
+            return Redfish.sessions[loop]
+        except KeyError:
+            pass
+        # Concurrency is limited by the AsyncEngine, not the connection pool
+        connector = aiohttp.TCPConnector(limit=0, ssl=False)
+        session = aiohttp.ClientSession(connector=connector)
+        Redfish.sessions[loop] = session
+        return session
+
+    @classmethod
+    async def close_async_sessions(cls):
+        session = Redfish.sessions.pop(asyncio.get_running_loop(), None)
+        Redfish.asynctokenlocks.clear()
+        Redfish.async_endpoint_slots.clear()
+        Redfish.async_collections.clear()
+        if session is not None:
+            await session.close()
+
     @classmethod
     def _get_redfish_attribute(cls, node, path, attr, status_codes=None, request_type="get", auth=None):
         """A simple redfish request - returns a string with the requested attribute
@@ -69,11 +570,32 @@ class Redfish(Oob):
         if auth is None:
             auth = cls._get_auth(node)
         response = cls._do_redfish_req(node[cls.oobtype], path, request_type, auth)
+        return cls._redfish_attribute(response, attr, status_codes)
+
+    @classmethod
+    async def _get_redfish_attribute_async(cls, node, path, attr, status_codes=None, request_type="get", auth=None):
+        """Coroutine version of _get_redfish_attribute"""
+        try:
+            host = node[cls.oobtype]
+        except:
+            return (False, "Parameter %s not set on node" % cls.oobtype)
+        if auth is None:
+            auth = cls._get_auth(node)
+        response = await cls._do_redfish_req_async(host, path, request_type, auth)
+        return cls._redfish_attribute(response, attr, status_codes)
+
+    @staticmethod
+    def _redfish_attribute(response, attr, status_codes=None):
+        """Returns (ok, value) for an attribute of a response"""
         if status_codes is not None and response.status_code not in status_codes:
             return (False, "Redfish response returned status %d" % response.status_code)
         if len(response.content) == 0:
             return(False, "Redfish returned a blank response")
-        value = response.json()
+        return Redfish._json_attribute(response.json(), attr)
+
+    @staticmethod
+    def _json_attribute(value, attr):
+        """Returns (ok, value) for an attribute of a decoded resource"""
         if type(attr) is not list:
             attr = attr.split('.')
         try:
@@ -83,6 +605,83 @@ class Redfish(Oob):
             return (False, "Redfish response JSON does not have attribute '%s'" % attr)
         return (True, value)
 
+    @classmethod
+    def _use_expand(cls, host, path):
+        cls._load_settings()
+        return Redfish.settings['expand'] and '/' in path and BmcProfile.get(host, 'expand', True)
+
+    @classmethod
+    def _expanded_member(cls, host, path, auth):
+        """Returns the resource at path out of one $expand fetch of its
+           collection. Nodes sharing a BMC that ask within expand_ttl seconds
+           of each other share the fetch. Returns None if the BMC can't
+           expand the collection.
+           """
+        collection = path.rsplit('/', 1)[0]
+        key = (host, collection)
+        with Redfish.sessionlock:
+            entry = Redfish.collections.get(key)
+            owner = (entry is None or
+                     (entry['event'].is_set() and time.monotonic() - entry['time'] > Redfish.settings['expand_ttl']))
+            if owner:
+                entry = { 'event': threading.Event(), 'members': None, 'time': 0 }
+                Redfish.collections[key] = entry
+        if owner:
+            try:
+                response = cls._do_redfish_req(host, "%s?$expand=.($levels=1)" % collection, "get", auth)
+                entry['members'] = cls._expanded_members(host, response)
+            finally:
+                entry['time'] = time.monotonic()
+                entry['event'].set()
+        else:
+            entry['event'].wait()
+        if entry['members'] is None:
+            return None
+        return entry['members'].get(path)
+
+    @classmethod
+    async def _expanded_member_async(cls, host, path, auth):
+        """Coroutine version of _expanded_member"""
+        collection = path.rsplit('/', 1)[0]
+        key = (host, collection)
+        entry = Redfish.async_collections.get(key)
+        if entry is None or (entry['future'].done() and time.monotonic() - entry['time'] > Redfish.settings['expand_ttl']):
+            entry = { 'future': asyncio.get_running_loop().create_future(), 'time': 0 }
+            Redfish.async_collections[key] = entry
+            try:
+                response = await cls._do_redfish_req_async(host, "%s?$expand=.($levels=1)" % collection, "get", auth)
+                entry['future'].set_result(cls._expanded_members(host, response))
+            except Exception:
+                entry['future'].set_result(None)
+                raise
+            finally:
+                entry['time'] = time.monotonic()
+        members = await asyncio.shield(entry['future'])
+        if members is None:
+            return None
+        return members.get(path)
+
+    @staticmethod
+    def _expanded_members(host, response):
+        """Returns path -> resource for an expanded collection, or None.
+           Only a BMC that rejects the query or does not expand it is
+           remembered as not supporting $expand.
+           """
+        if response.status_code not in [200, 400, 501]:
+            # Busy or not logged in, read the members one at a time for now
+            logging.debug("Could not expand a collection on %s (status %d)", host, response.status_code)
+            return None
+        try:
+            members = { x['@odata.id'].split('/redfish/v1/', 1)[-1]: x for x in response.json()['Members'] }
+        except Exception:
+            members = None
+        if response.status_code != 200 or members is None or any(len(x) == 1 for x in members.values()):
+            # Rejected, or members that are only links
+            logging.debug("%s does not support $expand", host)
+            BmcProfile.set(host, 'expand', False)
+            return None
+        return members
+
     @classmethod
     def _post_redfish(cls, node, path, data, status_codes=None, auth=None, method="post"):
         try:
@@ -117,16 +716,50 @@ class Redfish(Oob):
             host = node[cls.oobtype]
         except:
             return list()
+        systems = BmcProfile.get(host, 'systems')
+        if systems is not None:
+            return systems
         if auth is None:
             auth = cls._get_auth(node)
         try:
             response = cls._do_redfish_req(host, "Systems", "get", auth=auth)
-            value = response.json()
-            members = value['Members']
-            return [x['@odata.id'].split('/')[-1] for x in members]
+            return cls._save_members(host, 'systems', response)
         except:
             return list()
 
+    @classmethod
+    async def _redfish_get_systems_async(cls, node, auth=None):
+        """Coroutine version of _redfish_get_systems"""
+        try:
+            host = node[cls.oobtype]
+        except:
+            return list()
+        systems = BmcProfile.get(host, 'systems')
+        if systems is not None:
+            return systems
+        if auth is None:
+            auth = cls._get_auth(node)
+        try:
+            response = await cls._do_redfish_req_async(host, "Systems", "get", auth=auth)
+            return cls._save_members(host, 'systems', response)
+        except:
+            return list()
+
+    @classmethod
+    def _save_members(cls, host, fact, response):
+        """Returns the members of a collection and remembers them for the host"""
+        members = cls._redfish_members(response)
+        if len(members) > 0:
+            BmcProfile.set(host, fact, members)
+        return members
+
+    @staticmethod
+    def _redfish_members(response):
+        """Returns the last path component of each member of a collection"""
+        value = response.json()
+        members = value['Members']
+        return [x['@odata.id'].split('/')[-1] for x in members]
+
     @classmethod
     def _redfish_path_system(cls, node):
         """Determine the best path the the System entry"""
@@ -135,11 +768,7 @@ class Redfish(Oob):
                 return node['redfishpath']
             except KeyError:
                 systems = cls._redfish_get_systems(node)
-                logging.debug("Systems is %s", systems)
-                system = "Systems/%s" % systems[0] if len(systems) > 0 else 'Systems/Self'
-                # Save the detected value to avoid having to query the BMC again later
-                node['redfishpath'] = system
-                return system
+                return cls._set_redfish_path_system(node, systems)
         elif cls.oobtype == "pdu":
             try:
                 return node['pduredfishpath']
@@ -148,37 +777,93 @@ class Redfish(Oob):
         else:
             return 'Systems/Self'
 
+    @classmethod
+    async def _redfish_path_system_async(cls, node):
+        """Coroutine version of _redfish_path_system"""
+        if cls.oobtype == "bmc" and 'redfishpath' not in node:
+            systems = await cls._redfish_get_systems_async(node)
+            return cls._set_redfish_path_system(node, systems)
+        return cls._redfish_path_system(node)
+
+    @staticmethod
+    def _set_redfish_path_system(node, systems):
+        logging.debug("Systems is %s", systems)
+        system = "Systems/%s" % systems[0] if len(systems) > 0 else 'Systems/Self'
+        # Save the detected value to avoid having to query the BMC again later
+        node['redfishpath'] = system
+        return system
+
     @classmethod
     def _redfish_path_simpleupdate(cls, node):
         """Determine the best path the the SimpleUpdate action"""
         try:
             return node['redfishsimpleupdate']
+        except KeyError:
+            pass
+        try:
+            host = node[cls.oobtype]
         except KeyError:
             return 'UpdateService/Actions/UpdateService.SimpleUpdate'
+        path = BmcProfile.get(host, 'simpleupdate')
+        if path is None:
+            try:
+                (rc, target) = cls._get_redfish_attribute(node, 'UpdateService', ['Actions', '#UpdateService.SimpleUpdate', 'target'],
+                                                          status_codes=[200])
+            except Exception:
+                rc = False
+            if not rc or not isinstance(target, str):
+                return 'UpdateService/Actions/UpdateService.SimpleUpdate'
+            path = target.split('/redfish/v1/', 1)[-1]
+            BmcProfile.set(host, 'simpleupdate', path)
+        return path
 
     @classmethod
     def _power_state(cls, node, auth=None):
         redfishpath = cls._redfish_path_system(node)
         logging.debug("Inside _power_state %s", redfishpath)
+        host = node.get(cls.oobtype)
+        if host is not None and cls._use_expand(host, redfishpath):
+            member = cls._expanded_member(host, redfishpath, auth or cls._get_auth(node))
+            if member is not None:
+                return cls._json_attribute(member, 'PowerState')
         return cls._get_redfish_attribute(node, redfishpath, 'PowerState', status_codes=[200], auth=auth)
 
+    @classmethod
+    async def _power_state_async(cls, node, auth=None):
+        redfishpath = await cls._redfish_path_system_async(node)
+        host = node.get(cls.oobtype)
+        if host is not None and cls._use_expand(host, redfishpath):
+            member = await cls._expanded_member_async(host, redfishpath, auth or cls._get_auth(node))
+            if member is not None:
+                return cls._json_attribute(member, 'PowerState')
+        return await cls._get_redfish_attribute_async(node, redfishpath, 'PowerState', status_codes=[200], auth=auth)
+
     @classmethod
     def _redfish_reset(cls, node, resettype, auth=None):
         if auth is None:
             auth = cls._get_auth(node)
         redfishpath = cls._redfish_path_system(node)
+        response = cls._do_redfish_req(node[cls.oobtype], cls._redfish_path_reset(redfishpath), "post", auth,
+                                       { 'ResetType': resettype }, { 'Content-Type': 'application/json' })
+        return cls._redfish_reset_result(response)
+
+    @classmethod
+    async def _redfish_reset_async(cls, node, resettype, auth=None):
+        if auth is None:
+            auth = cls._get_auth(node)
+        redfishpath = await cls._redfish_path_system_async(node)
+        response = await cls._do_redfish_req_async(node[cls.oobtype], cls._redfish_path_reset(redfishpath), "post", auth,
+                                                   { 'ResetType': resettype }, { 'Content-Type': 'application/json' })
+        return cls._redfish_reset_result(response)
+
+    @staticmethod
+    def _redfish_path_reset(redfishpath):
         if "Chassis" in redfishpath:
-            path = '%s/Actions/Chassis.Reset' % redfishpath
-        else:
-            path = '%s/Actions/ComputerSystem.Reset' % redfishpath
-        if cls.oobtype == "bmc":
-            host = node['bmc']
-        elif cls.oobtype == "pdu":
-            host = node['pdu']
+            return '%s/Actions/Chassis.Reset' % redfishpath
+        return '%s/Actions/ComputerSystem.Reset' % redfishpath
 
-        data = { 'ResetType': resettype }
-        headers = { 'Content-Type': 'application/json' }
-        response = cls._do_redfish_req(host, path, "post", auth, data, headers)
+    @staticmethod
+    def _redfish_reset_result(response):
         if response.status_code not in [200, 202, 204]:
             try:
                 value = response.json()
@@ -200,6 +885,45 @@ class Redfish(Oob):
     def _power_forceoff(cls, node, auth=None):
         return cls._redfish_reset(node, 'ForceOff', auth)
 
+    @classmethod
+    async def _power_on_async(cls, node, auth=None):
+        return await cls._redfish_reset_async(node, 'On', auth)
+
+    @classmethod
+    async def _power_off_async(cls, node, auth=None):
+        return await cls._redfish_reset_async(node, 'Off', auth)
+
+    @classmethod
+    async def _power_forceoff_async(cls, node, auth=None):
+        return await cls._redfish_reset_async(node, 'ForceOff', auth)
+
+    @classmethod
+    def _firmware_ids(cls, node):
+        """Return the entries of the firmware inventory"""
+        try:
+            host = node[cls.oobtype]
+        except KeyError:
+            return list()
+        ids = BmcProfile.get(host, 'firmware')
+        if ids is not None:
+            return ids
+        try:
+            response = cls._do_redfish_req(host, "UpdateService/FirmwareInventory", "get", auth=cls._get_auth(node))
+            return cls._save_members(host, 'firmware', response)
+        except:
+            return list()
+
+    @classmethod
+    def _firmware_id(cls, node, fwtype):
+        """Match a firmware type with the name the BMC uses for it"""
+        ids = cls._firmware_ids(node)
+        if fwtype in ids:
+            return fwtype
+        for fwid in ids:
+            if fwid.lower() == fwtype.lower():
+                return fwid
+        return fwtype
+
     @classmethod
     def _redfish_path_firmware(cls, node, fwtype=None):
         """Determine the best path to the Firmware entries"""
@@ -208,7 +932,7 @@ class Redfish(Oob):
                 fwtype = node['firmware_name']
             except KeyError:
                 fwtype = 'BIOS'
-        return 'UpdateService/FirmwareInventory/%s' % fwtype
+        return 'UpdateService/FirmwareInventory/%s' % cls._firmware_id(node, fwtype)
 
     @classmethod
     def _redfish_target_firmware(cls, node, fwtype=None):
@@ -219,7 +943,7 @@ class Redfish(Oob):
                 if fwtype is not None and fwtype.lower() == "recovery":
                     return '/redfish/v1/UpdateService/FirmwareInventory/Recovery'
                 return None
-        return '/redfish/v1/UpdateService/FirmwareInventory/%s' % fwtype
+        return '/redfish/v1/UpdateService/FirmwareInventory/%s' % cls._firmware_id(node, fwtype)
 
     @classmethod
     def _firmware_state(cls, node, fwtype=None, auth=None):
@@ -228,9 +952,41 @@ class Redfish(Oob):
 
     @classmethod
     def _firmware_version(cls, node, fwtype=None, auth=None):
+        if fwtype is not None and fwtype.lower() == 'all':
+            return cls._firmware_versions(node, auth=auth)
         path = cls._redfish_path_firmware(node, fwtype)
         return cls._get_redfish_attribute(node, path, ['Version'], auth=auth)
 
+    @classmethod
+    def _firmware_versions(cls, node, auth=None):
+        """Returns the version of every firmware inventory entry, read with
+           a single $expand request if the BMC supports it
+           """
+        try:
+            host = node[cls.oobtype]
+        except KeyError:
+            return (False, "Parameter %s not set on node" % cls.oobtype)
+        if auth is None:
+            auth = cls._get_auth(node)
+        members = None
+        if cls._use_expand(host, 'UpdateService/FirmwareInventory/'):
+            response = cls._do_redfish_req(host, "UpdateService/FirmwareInventory?$expand=.($levels=1)", "get", auth)
+            members = cls._expanded_members(host, response)
+        if members is None:
+            members = dict()
+            for fwid in cls._firmware_ids(node):
+                path = 'UpdateService/FirmwareInventory/%s' % fwid
+                response = cls._do_redfish_req(host, path, "get", auth)
+                if response.status_code == 200:
+                    members[path] = response.json()
+        else:
+            BmcProfile.set(host, 'firmware', [path.rsplit('/', 1)[-1] for path in members])
+        if len(members) == 0:
+            return (False, "No firmware inventory found")
+        versions = ["%s: %s" % (path.rsplit('/', 1)[-1], resource.get('Version', 'unknown'))
+                    for (path, resource) in members.items()]
+        return (True, "\n".join(versions))
+
     @classmethod
     def _firmware_upgrade(cls, node, url, fwtype=None, auth=None):
         path = cls._redfish_path_simpleupdate(node)
@@ -274,13 +1030,18 @@ class Redfish(Oob):
         systempath = cls._redfish_path_system(node)
         if len(args) == 0:
             return (True, 'Summary is not currently supported')
+        elif all(item in cls.inventory_map for item in args):
+            # Items on the same resource share one request, see ResourceCache
+            results = list()
+            for item in args:
+                (itempath, attr) = cls.inventory_map[item]
+                results.append((item,) + cls._get_redfish_attribute(node, '%s/%s' % (systempath, itempath), attr))
+            if len(results) == 1:
+                return results[0][1:]
+            return (all(ok for (item, ok, value) in results),
+                    "\n".join("%s: %s" % (item, value) for (item, ok, value) in results))
         elif len(args) == 1:
-            try:
-                invitem = cls.inventory_map[args[0]]
-                itempath = invitem[0]
-                attr = invitem[1]
-            except KeyError:
-                return (False, "Unknown inventory item '%s'" % args[0])
+            return (False, "Unknown inventory item '%s'" % args[0])
         else:
             itempath = args[0]
             attr = args[1]
@@ -379,6 +1140,9 @@ class Redfish(Oob):
                 else:
                     return(rc, msg)
 
+if has_aiohttp:
+    AsyncEngine.closers.append(Redfish.close_async_sessions)
+
 class RedfishBmc(Redfish):
     oobtype = "bmc"
 
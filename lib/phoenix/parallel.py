@@ -7,9 +7,8 @@ Calls out to Phoenix functions
 
 ################################################################################
 # Note: The PhoenixClient and PhoenixWorker were inspired by the ClusterShell  #
-#       ExecClient and ExecWorker. Messages go through a pipe to utilize the   #
-#       existing underlying engines. In the future this may be re-evaluated to #
-#       use a "native" python-based engine instead.                            #
+#       ExecClient and ExecWorker. Messages are queued in memory and a single  #
+#       PhoenixDoorbell pipe per worker wakes up the underlying engine.        #
 ################################################################################
 
 import random
@@ -22,13 +21,15 @@ import threading
 import signal
 import socket
 import traceback
-import resource
+import itertools
+import asyncio
 
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 
 import phoenix
 from phoenix.node import Node
 from phoenix.command import Command
+from phoenix.oob import BmcProfile
 from phoenix.system import System
 
 from ClusterShell.Task import Task, task_self
@@ -187,15 +188,6 @@ def gettopology(nodes, fanout=128):
     logging.debug("Topology is\n%s", topology)
     return topology
 
-def increase_nofile():
-    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-    logging.debug("Attempting to increase RLIMIT_NOFILE from %d to %d", soft, hard)
-    if hard > soft:
-        try:
-            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
-        except:
-            logging.error("Could not increase RLIMIT_NOFILE")
-
 def setup(nodes, args):
     sys.excepthook = excepthook
 
@@ -203,23 +195,27 @@ def setup(nodes, args):
     if type(nodes) is not NodeSet:
         nodes=NodeSet(nodes)
 
-    # Attempt to increase the number of open files
-    if len(nodes) > 500:
-        increase_nofile()
-
     task = task_self()
     task.set_default('local_worker', PhoenixWorker)
     # Defaults are not sent to gateways, but info is.
     # https://github.com/cea-hpc/clustershell/pull/439
     task.set_info('tree_default:local_workername', 'phoenix.parallel')
-    task.set_info('fanout', args.fanout)
+    fanout = args.fanout
+    if fanout == 'auto':
+        # The worker's window is adjusted up to the ceiling
+        task.set_info('phoenix_fanout_auto', True)
+        fanout = FanoutController.ceiling()
+    task.set_info('fanout', fanout)
+    task.set_info('phoenix_engine', getattr(args, 'engine', 'threads'))
+    task.set_info('phoenix_preconnect', getattr(args, 'preconnect', False))
+    task.set_info('phoenix_refresh_bmc_cache', getattr(args, 'refresh_bmc_cache', False))
     task.set_default("stderr", False)
 
     if args.verbose:
         task.set_info('debug', True)
 
     if args.local == False:
-        task.topology = gettopology(nodes, args.fanout)
+        task.topology = gettopology(nodes, fanout)
 
     options=DisplayOptions()
     if len(nodes) == 1:
@@ -250,11 +246,20 @@ def print_remaining(task, nodes, handler):
     print("Remaining nodes: %s (%d)" % (uncompleted_nodes, len(uncompleted_nodes)))
     return uncompleted_nodes
 
+def fanout_type(value):
+    """ A fanout is a number of nodes, or auto """
+    if str(value).lower() == 'auto':
+        return 'auto'
+    return int(value)
+
 def parser_add_arguments_parallel(parser):
-    parser.add_argument('-f', '--fanout', type=int, default=System.setting('fanout', 128), help='Fanout value')
+    parser.add_argument('-f', '--fanout', type=fanout_type, default=System.setting('fanout', 128), help='Fanout value, or auto to adjust it to the response times')
     parser.add_argument('-t', '--command-timeout', type=int, default=System.setting('command-timeout', 0))
     parser.add_argument('-T', '--connect-timeout', type=int, default=System.setting('connect-timeout', 20))
     parser.add_argument('-l', '--local', default=False, action='store_true', dest='local')
+    parser.add_argument('--engine', default=System.setting('engine', 'threads'), choices=['threads', 'asyncio'], help='Run node operations on threads or on one asyncio event loop')
+    parser.add_argument('--preconnect', default=System.setting('preconnect', False), action='store_true', help='Connect to every BMC before starting')
+    parser.add_argument('--refresh-bmc-cache', default=False, action='store_true', help='Discover BMC paths and features again instead of using the cached ones')
 
 class NodeHandler(EventHandler):
     def __init__(self, client, node):
@@ -263,30 +268,196 @@ class NodeHandler(EventHandler):
         self.count = 0
         EventHandler.__init__(self)
 
-class PhoenixClient(EngineClient):
+class FanoutController(object):
+    """ Adjusts how many nodes a worker runs at once, for --fanout auto.
+        The nodes are measured in rounds of one window. A round is
+        congested if its median time was more than latency_factor times
+        that of the fastest round, or if more than error_rate of its nodes
+        timed out or had to retry requests. The window doubles after each
+        round until the first congestion, then grows by increase nodes
+        per round and is multiplied by decrease after a congested one. It
+        always stays between floor and ceiling.
+    """
+    settings = { 'floor':          8,
+                 'ceiling':        512,
+                 'increase':       4,
+                 'decrease':       0.5,
+                 'latency_factor': 2.0,
+                 'error_rate':     0.05,
+               }
+    loaded_settings = False
+
+    @classmethod
+    def _load_settings(cls):
+        if cls.loaded_settings:
+            return
+        cls.settings = dict(cls.settings)
+        cls.settings.update(System.setting('fanout_auto', default=dict()))
+        cls.loaded_settings = True
+
+    @classmethod
+    def ceiling(cls):
+        cls._load_settings()
+        return cls.settings['ceiling']
+
+    def __init__(self):
+        self._load_settings()
+        self.window = self.settings['floor']
+        self.slowstart = True
+        self.best = None
+        self.samples = list()
+        self.start = time.monotonic()
+        self.changed = self.start
+
+    def sample(self, started, error):
+        """ Records a finished node, returns the window to use """
+        if started < self.changed:
+            # Started before the last change, so it says nothing about it
+            return self.window
+        self.samples.append((time.monotonic() - started, error))
+        if len(self.samples) < self.window:
+            return self.window
+        latencies = sorted(latency for (latency, error) in self.samples)
+        median = latencies[len(latencies) // 2]
+        errors = sum(1 for (latency, error) in self.samples if error) / len(self.samples)
+        self.samples = list()
+        if self.best is None or median < self.best:
+            self.best = median
+        old = self.window
+        if errors > self.settings['error_rate'] or median > self.best * self.settings['latency_factor']:
+            self.slowstart = False
+            self.window = int(self.window * self.settings['decrease'])
+        elif self.slowstart:
+            self.window = self.window * 2
+        else:
+            self.window = self.window + self.settings['increase']
+        self.window = max(self.settings['floor'], min(self.settings['ceiling'], self.window))
+        if self.window != old:
+            self.changed = time.monotonic()
+            logging.info("Fanout %d -> %d at %.1fs (median %.2fs, fastest %.2fs, %d%% errors)",
+                         old, self.window, time.monotonic() - self.start, median, self.best, errors * 100)
+        return self.window
+
+class AsyncEngine(object):
+    """ Runs the node operations of a PhoenixWorker as coroutines on one
+        event loop in a background thread. At most limit operations run at
+        once. Coroutines registered in closers are awaited on shutdown, for
+        anything that keeps per-loop state like HTTP sessions.
+    """
+    closers = list()
+
+    def __init__(self, limit):
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        self.limit = limit
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="phoenix_asyncio", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _bounded(self, coro):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+        async with self.semaphore:
+            return await coro
+
+    def submit(self, coro):
+        """ Schedules a coroutine from any thread """
+        return asyncio.run_coroutine_threadsafe(self._bounded(coro), self.loop)
+
+    async def _close(self):
+        for closer in self.closers:
+            try:
+                await closer()
+            except Exception as e:
+                logging.debug("Closing %s failed: %s", closer, e)
+
+    def shutdown(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        try:
+            asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(timeout=10)
+        except Exception as e:
+            logging.debug("Event loop cleanup failed: %s", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+class PhoenixDoorbell(EngineClient):
+    """ Delivers messages from the command threads of a PhoenixWorker to the
+        engine thread. Messages wait in an in-memory queue and a single pipe,
+        shared by every client of the worker, wakes the engine up. The pipe
+        is only written to when the queue was drained, so it never fills up
+        and a busy worker thread is never blocked by it.
+    """
+    def __init__(self, worker):
+        EngineClient.__init__(self, worker, None, False, -1, False)
+        # Like a ClusterShell EnginePort, not subject to fanout
+        self.delayable = False
+        self.queue = deque()
+        self.rung = False
+        (readfd, self.writefd) = os.pipe()
+        os.set_blocking(readfd, False)
+        os.set_blocking(self.writefd, False)
+        # Named like an EnginePort stream, the engine peeks at ports with it
+        self.streams.set_stream('in', readfd, E_READ)
+
+    def _start(self):
+        return self
+
+    def put(self, client, event, message):
+        """ Queues a message for the engine thread, safe from any thread """
+        self.queue.append((client, event, message))
+        # The engine clears rung before draining the queue, so if it is
+        # still set this message is going to be seen
+        if not self.rung:
+            self.rung = True
+            try:
+                os.write(self.writefd, b'!')
+            except BlockingIOError:
+                pass
+
+    def _handle_read(self, sname):
+        try:
+            self._read(sname, 4096)
+        except BlockingIOError:
+            self._set_reading(sname)
+        # Only after emptying the pipe, or a ring could be swallowed
+        self.rung = False
+        while self.queue:
+            (client, event, message) = self.queue.popleft()
+            client._handle_event(event, message)
+
+    def _close(self, abort, timeout):
+        self.queue.clear()
+        os.close(self.writefd)
+        EngineClient._close(self, abort, timeout)
 
+class PhoenixClient(EngineClient):
+    """ Runs a phoenix command for one node in the worker's thread pool.
+        Output and completion go through the worker's PhoenixDoorbell, so a
+        client does not use any file descriptors of its own.
+    """
     def __init__(self, node, command, worker, stderr, timeout, autoclose=False):
         EngineClient.__init__(self, worker, node, stderr, timeout, autoclose)
-        self._stderr = None
         self.command = command
+        # Requests sent again, see RequestPolicy
         self.retries = 0
+        self.hedges = 0
         self.rc = 0
         self.node = None
         self.state = None
-
-        if stderr:
-            self._stderr = os.pipe()
-
-        self._stdout = os.pipe()
+        self.closed = False
+        self.started = None
+        # Out of the engine while something else finishes the command
+        self.parked = False
         self.handler = NodeHandler(self, node)
 
     def _start(self):
-        if self._stderr:
-            self.streams.set_stream(self.worker.SNAME_STDERR, self._stderr[0], E_READ)
-        self.streams.set_stream(self.worker.SNAME_STDOUT, self._stdout[0], E_READ)
-        logging.debug("Streams set")
-
         self.worker._on_start(self.key)
+        self.started = time.monotonic()
 
         try:
             self.node = Node.find_node(self.key)
@@ -295,7 +466,10 @@ class PhoenixClient(EngineClient):
             self.mark_command_complete(rc=1)
         else:
             logging.info("Phoenix client submitting command for node %s in thread %d", self.key, getThread() )
-            self.worker.executor.submit(Command.run, self)
+            if self.worker.async_engine is not None:
+                self.worker.async_engine.submit(Command.run_async(self))
+            else:
+                self.worker.executor.submit(Command.run, self)
             logging.info("submitted")
         finally:
             logging.info("returning self")
@@ -306,42 +480,83 @@ class PhoenixClient(EngineClient):
             message = str(message)
         try:
             message = message.encode()
-            if not message.endswith(b'\n'):
-                message = message + b'\n'
+            if message.endswith(b'\n'):
+                message = message[:-1]
             if stderr and self._stderr:
-                os.write(self._stderr[1], message)
+                sname = self.worker.SNAME_STDERR
             else:
-                os.write(self._stdout[1], message)
+                sname = self.worker.SNAME_STDOUT
+            self.worker.doorbell.put(self, sname, message)
         except Exception as e:
             logging.debug("Failed to write out message: %s", e)
 
     def mark_command_complete(self, rc=None):
-        logging.info("Command %s complete for node %s. Closing fd %d", self.command, self.key, self._stdout[1])
-        os.close(self._stdout[1])
-        if self._stderr:
-            os.close(self._stderr[1])
-        if rc:
-            self.rc = rc
+        logging.info("Command %s complete for node %s", self.command, self.key)
+        self.worker.doorbell.put(self, 'complete', rc)
+
+    def mark_command_timeout(self):
+        """ Closes the client as timed out, safe from any thread """
+        self.worker.doorbell.put(self, 'timeout', None)
+
+    def mark_command_pending(self):
+        """ Gives the client's fanout slot to the next node while the
+            command is finished elsewhere, which then calls
+            mark_command_complete or mark_command_timeout
+        """
+        self.worker.doorbell.put(self, 'pending', None)
+
+    def _handle_event(self, event, message):
+        """ Handles a message from the doorbell in the engine thread """
+        if self.closed:
+            # Timed out or aborted while the command was still running
+            return
+        if event == 'pending':
+            self.parked = True
+            self._engine.remove(self)
+        elif event == 'complete':
+            if message:
+                self.rc = message
+            self._leave()
+        elif event == 'timeout':
+            self._leave(timeout=True)
+        else:
+            for line in message.split(b'\n'):
+                self.worker._on_node_msgline(self.key, line, event)
+
+    def _leave(self, abort=False, timeout=False):
+        if self.parked:
+            # Already out of the engine
+            self.parked = False
+            self._close(abort, timeout)
+        else:
+            self._engine.remove(self, abort=abort, did_timeout=timeout)
+
+    def abort(self):
+        if self.parked:
+            self._leave(abort=True)
+        else:
+            EngineClient.abort(self)
 
     def _close(self, abort, timeout):
+        if self.parked:
+            # Removed from the engine by mark_command_pending
+            self.worker._client_parked(self)
+            return
         if abort and self.rc == 0:
              self.rc = 1
              logging.debug("Node %s trying to _close with abort and rc=0", self.key)
 
+        self.closed = True
         self.streams.clear()
         self.invalidate()
+        if self.retries > 0 or self.hedges > 0:
+            self.worker.resent[self.key] = (self.retries, self.hedges)
 
         if timeout:
             self.worker._on_node_timeout(self.key)
         else:
             self.worker._on_node_close(self.key, self.rc)
-
-    def _handle_read(self, sname):
-        # Some of the ClusterShell built-in workers cache local variables
-        # as an optimization, but phoenix commands aren't expected to be
-        # very talkative. Skip that here for simplicity
-        for msg in self._readlines(sname):
-            self.worker._on_node_msgline(self.key, msg, sname) 
+        self.worker._client_closed(self, abort, timeout)
 
     def set_state(self, state):
         logging.debug("Node %s setting state to %s", self.key, state)
@@ -355,29 +570,38 @@ class PhoenixWorker(DistantWorker):
         DistantWorker.__init__(self, handler)
         self._clients_timeout_count = 0
         self._clients_closed_count = 0
-        self._clients = []
+        # Clients that were created and are not closed yet
+        self._clients = set()
+        # Clients in the engine, and the ones that left it with
+        # mark_command_pending
+        self._running = 0
+        self._parked = set()
+        self.fanout_controller = None
 
         signal.signal(signal.SIGUSR2, tb_signal_handler)
 
         self.nodes = NodeSet(nodes)
         self.command = kwargs.get('command')
         self.executor = None # Wait until the task is bound so we know requested fanout
+        self.async_engine = None
 
-        # Load Phoenix with the nodes we care about
+        # Load Phoenix with the nodes we care about. Anything only known by
+        # an alias in the nodemap is built on demand by Node.find_node
         # Consider if we want to only do this if Node.loaded_nodes is False to
         # avoid reading the conf files again
-        #Node.load_nodes(nodeset=self.nodes)
-        # FIXME: since implementing nodemaps, we have to load all nodes
-        # Find a better way to map determine what nodes to load
-        Node.load_nodes()
+        Node.load_nodes(nodeset=self.nodes)
 
         autoclose = kwargs.get('autoclose', False)
         stderr = kwargs.get('stderr', False)
         timeout = kwargs.get('timeout')
 
-        cls = self.__class__.SHELL_CLASS
-        for node in self.nodes:
-            self._clients.append(cls(node, self.command, self, stderr, timeout, autoclose))
+        # Clients are created as they are needed, see _engine_clients
+        self._client_args = (self.command, self, stderr, timeout, autoclose)
+        self._node_count = len(self.nodes)
+        self._pending = iter(self.nodes)
+        self.doorbell = PhoenixDoorbell(self)
+        # Node -> (retries, hedges) for the summary
+        self.resent = dict()
 
     def _set_task(self, task):
         if self.task is not None:
@@ -385,6 +609,8 @@ class PhoenixWorker(DistantWorker):
             raise WorkerError("Worker has already been attached to a task")
         self.task = task
         self.fanout = task.info("fanout", 0)
+        if task.info('phoenix_fanout_auto', False):
+            self.fanout_controller = FanoutController()
         logging.debug("Inside _set_task")
         # Create the thread executor with the thread count set to the fanout
         try:
@@ -392,11 +618,113 @@ class PhoenixWorker(DistantWorker):
         except TypeError:
             # The python 2.x ThreadPoolExecutor doesn't support thread_name_prefix
             self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = self.fanout)
+        # The executor is still used by commands without a coroutine version
+        if task.info('phoenix_engine', 'threads') == 'asyncio':
+            self.async_engine = AsyncEngine(self.fanout if self.fanout > 0 else self._node_count)
+        if task.info('phoenix_refresh_bmc_cache', False):
+            BmcProfile.refresh = True
+        if task.info('phoenix_preconnect', False):
+            self._preconnect()
         logging.info("set_task done, executor is %s", self.executor)
 
+    def _preconnect(self):
+        """ Opens connections to all the out of band controllers in parallel,
+            so the handshakes are done before the first node starts
+        """
+        nodes = list()
+        for name in self.nodes:
+            try:
+                nodes.append(Node.find_node(name))
+            except KeyError:
+                continue
+        hosts = Command.preconnect_hosts(self.command, nodes)
+        logging.info("Preconnecting to %d hosts", len(hosts))
+        if self.async_engine is not None:
+            futures = [self.async_engine.submit(oobcls.preconnect_async(host))
+                       if oobcls.has_async else self.executor.submit(oobcls.preconnect, host)
+                       for (oobcls, host) in hosts]
+        else:
+            futures = [self.executor.submit(oobcls.preconnect, host) for (oobcls, host) in hosts]
+        concurrent.futures.wait(futures)
+
+    def _new_clients(self, count):
+        clients = [self.SHELL_CLASS(node, *self._client_args)
+                   for node in itertools.islice(self._pending, max(0, count))]
+        self._clients.update(clients)
+        self._running += len(clients)
+        return clients
+
+    def _window(self):
+        """ Returns how many clients may be running at once """
+        if self.fanout_controller is not None:
+            return self.fanout_controller.window
+        return self.fanout if self.fanout > 0 else self._node_count
+
+    def _fill(self):
+        for client in self._new_clients(self._window() - self._running):
+            self.task._engine.add(client)
+
+    def _measure(self, client, timeout):
+        if self.fanout_controller is not None and client.started is not None:
+            self.fanout_controller.sample(client.started, timeout or client.retries > 0)
+
     # Required by other parts of ClusterShell
     def _engine_clients(self):
-        return self._clients
+        # Only a fanout sized window of clients exists at a time, the next
+        # one is created when a client closes
+        if self._node_count == 0:
+            return []
+        self._pending = iter(self._start_order())
+        return [self.doorbell] + self._new_clients(self._window())
+
+    def _start_order(self):
+        """ Returns the nodes ordered round robin by controller, taking up
+            to endpoint_limit nodes of each. A window of clients then does
+            not all go to the same chassis controller or PDU, while nodes
+            sharing one still run together and can share requests.
+        """
+        if Command.oobkind(self.command) is None:
+            return self.nodes
+        groups = dict()
+        for name in self.nodes:
+            try:
+                endpoint = Command.endpoint(self.command, Node.find_node(name))
+            except KeyError:
+                endpoint = None
+            groups.setdefault(endpoint, list()).append(name)
+        if len(groups) < 2:
+            return self.nodes
+        limit = System.setting('endpoint_limit', 4)
+        chunks = [[names[i:i + limit] for i in range(0, len(names), limit)] for names in groups.values()]
+        return [name for batch in itertools.zip_longest(*chunks) if batch is not None
+                for chunk in batch if chunk is not None for name in chunk]
+
+    def _client_closed(self, client, abort, timeout):
+        self._clients.discard(client)
+        if client in self._parked:
+            self._parked.discard(client)
+        else:
+            self._running -= 1
+            self._measure(client, timeout)
+        if not abort:
+            self._fill()
+            return
+        # Nodes that never got a client end the same way
+        for node in list(self._pending):
+            if timeout:
+                self._on_node_timeout(node)
+            else:
+                self._on_node_close(node, 1)
+
+    def _client_parked(self, client):
+        # Still open, but no longer counts against the fanout
+        self._parked.add(client)
+        self._running -= 1
+        self._measure(client, False)
+        self._fill()
+
+    def _finished(self):
+        return self._clients_closed_count >= self._node_count
 
     def _on_node_timeout(self, node):
         DistantWorker._on_node_timeout(self, node)
@@ -411,13 +739,35 @@ class PhoenixWorker(DistantWorker):
     def _mark_client_closed(self):
         self._clients_closed_count += 1
         # Check if this was the last client, and if so, inform the event handler
-        if self._clients_closed_count == len(self._clients) and self.eh is not None:
+        if not self._finished():
+            return
+        # Nothing else is coming, let the engine loop end
+        self.doorbell.abort()
+        if self.async_engine is not None:
+            self.async_engine.shutdown()
+        if self.eh is not None:
             # For simplicity, ignore legacy support here (no ev_timeout event)
             self.eh.ev_close(self, self._clients_timeout_count > 0)
+        self._print_resent()
+
+    def _print_resent(self):
+        """ Lists the nodes whose requests had to be sent again """
+        for (index, label) in [(0, 'Retried'), (1, 'Hedged')]:
+            counts = defaultdict(NodeSet)
+            for (node, resent) in self.resent.items():
+                if resent[index] > 0:
+                    counts[resent[index]].add(node)
+            for count in sorted(counts):
+                sys.stderr.write("%s %d time%s: %s (%d)\n" % (label, count, '' if count == 1 else 's',
+                                                            counts[count], len(counts[count])))
 
     def abort(self):
-        for client in self._clients:
+        self._pending = iter(())
+        for client in list(self._clients):
             client.abort()
+        self.doorbell.abort()
+        if self.async_engine is not None:
+            self.async_engine.shutdown()
         self.executor.shutdown(wait=False)
 
     def set_write_eof(self):
@@ -12,6 +12,7 @@ from phoenix.network import Network
 from phoenix.network import handleautointerfaces
 from phoenix.node import Node
 from phoenix.data import Data
+from phoenix.watch import FileWatcher
 import phoenix
 
 cray_ex_regex = re.compile(r'x(?P<racknum>\d+)(?P<chassistype>[ce])(?P<chassis>\d+)((?P<slottype>[rs])(?P<slot>\d+)(b(?P<board>\d+)(n(?P<nodenum>\d+))?)?)?')
@@ -20,6 +21,10 @@ ipprefix = 'fc00:0:100:60'
 
 rosetta_group = dict()
 rosetta_swcnum = dict()
+rosetta_stat = None
+
+# nodeindex -> location, built from the nodegroups layout on first use
+layout_index = None
 
 # colorado_map[slot][node]
 colorado_map = {
@@ -84,7 +89,7 @@ Node.models['ex4252'] = {
 }
 
 # These are defaults for the cray_ex plugin
-settings = {
+defaults = {
     'startnid':     1,
     'niddigits':    5,
     'nodesperrack': 256,
@@ -92,34 +97,64 @@ settings = {
     'nicspernode':  1,
 }
 
-try:
-    usersettings = System.setting('cray_ex', default=dict())
-    settings.update(usersettings)
-except:
-    logging.error("cray_shasta section not found in system settings")
-if 'racks' in settings:
-    settings['racknodeset'] = NodeSet(settings['racks'])
-    settings['racklist'] = list(settings['racknodeset'])
-    if 'emptyracks' in settings:
-        settings['racklistnonempty'] = list(settings['racknodeset'].difference(NodeSet(settings['emptyracks'])))
+def load_settings():
+    ''' Builds the plugin settings from system.yaml. Runs again when
+        system.yaml changes
+    '''
+    global settings
+    global layout_index
+
+    FileWatcher.watch('cray_ex', [], load_settings, depends=['system'])
+    newsettings = dict(defaults)
+    try:
+        usersettings = System.setting('cray_ex', default=dict())
+        newsettings.update(usersettings)
+    except:
+        logging.error("cray_shasta section not found in system settings")
+    if 'racks' in newsettings:
+        newsettings['racknodeset'] = NodeSet(newsettings['racks'])
+        newsettings['racklist'] = list(newsettings['racknodeset'])
+        if 'emptyracks' in newsettings:
+            newsettings['racklistnonempty'] = list(newsettings['racknodeset'].difference(NodeSet(newsettings['emptyracks'])))
+        else:
+            newsettings['racklistnonempty'] = newsettings['racklist']
+        newsettings['rackidx'] = { rack: idx for idx, rack in enumerate(newsettings['racklist']) }
+        newsettings['rackidxnonempty'] = { rack: idx for idx, rack in enumerate(newsettings['racklistnonempty']) }
     else:
-        settings['racklistnonempty'] = settings['racklist']
-else:
-    logging.error("racks not set in system.yaml cray_shasta section")
-if type(settings['autoip']) == str:
-    settings['autoip'] = { settings['autoip']: 0 }
-elif type(settings['autoip']) == list:
-    settings['autoip'] = dict.fromkeys(settings['autoip'], 0)
+        logging.error("racks not set in system.yaml cray_shasta section")
+    if type(newsettings['autoip']) == str:
+        newsettings['autoip'] = { newsettings['autoip']: 0 }
+    elif type(newsettings['autoip']) == list:
+        newsettings['autoip'] = dict.fromkeys(newsettings['autoip'], 0)
+
+    settings = newsettings
+    layout_index = None
+
+load_settings()
 
 def read_rosetta():
+    ''' Loads rosetta_map.csv, only reading it again when it changes '''
+    global rosetta_stat
     filename = "%s/rosetta_map.csv" % phoenix.conf_path
-    if not os.path.exists(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        if rosetta_stat is not None:
+            rosetta_group.clear()
+            rosetta_swcnum.clear()
+            rosetta_stat = None
+        return
+    stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if stat_key == rosetta_stat:
         return
+    rosetta_group.clear()
+    rosetta_swcnum.clear()
     with open(filename, 'r') as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
         for row in reader:
             rosetta_group[row[0]] = int(row[1])
             rosetta_swcnum[row[0]] = int(row[2])
+    rosetta_stat = stat_key
 
 def _hostctrl_network(node):
     global settings
@@ -193,8 +228,8 @@ def _xname_to_node_attrs(node):
                 node['type'] = 'cc'
 
     try:
-        node['rackidx'] = settings['racklist'].index(node['rack'])
-        node['rackidxnonempty'] = settings['racklistnonempty'].index(node['rack'])
+        node['rackidx'] = settings['rackidx'][node['rack']]
+        node['rackidxnonempty'] = settings['rackidxnonempty'][node['rack']]
     except:
         # This could be a columbia switch, for example
         pass
@@ -226,85 +261,84 @@ def _name_to_nodeindex(node):
         return True
     return False
 
-def _node_info_by_layout(node):
-    ''' Iterate the nodegroups and build node object
-        Return breaks out as soon as it is found
-        Should only be called for when a specific node layout
-        is defined in system.yaml for cases like AFW
-        where the node location cannot be reliably calculated
+def _build_layout_index():
+    ''' Walks the nodegroups once and maps every nodeindex to its location.
+        Should only be used when a specific node layout is defined in
+        system.yaml for cases like AFW where the node location cannot be
+        reliably calculated
     '''
-    racklist = settings['racklist']
+    index = dict()
     for group in settings['nodegroups']:
         startnum           = settings['nodegroups'][group]['startnodenum']
         endnum             = settings['nodegroups'][group]['endnodenum']
         controllersperslot = settings['nodegroups'][group]['controllersperslot']
         nodespercontroller = settings['nodegroups'][group]['nodespercontroller']
         layout             = settings['nodegroups'][group]['nodelayout']
-        index              = node['nodeindex']
-
-        # Does this group apply to this node?
-        if startnum <= index and index <= endnum:
-            # count up the nodes within the group
-            counter = startnum
-
-            for rack in layout:
-                # keep track of which node it is inside rack
-                # default to start at zero unless explicitly
-                # set for the rack in the nodegroup in system.yaml
-                # allows for case where rack has multiple nodegroups
-                # and they can't all start at zero
-                nodeindexinrack = 0
-
-                # Get the index from zero for this rack within the list
-                rack_idx        = racklist.index(rack)
-
-                for rackdata in layout[rack]:
-                    # rackdata is either a integer defining which chassis in the rack
-                    # or it is a variable with data for the specific rack
-                    if rackdata == 'start_rackidx':
-                        nodeindexinrack = settings['nodegroups'][group]['nodelayout'][rack]['start_rackidx']
-
-                        # Go to next line of rackinfo after handling this option
-                        continue
-                    chassisidx = rackdata
-
-                    chassis = "c" + str(chassisidx)
-                    slot_ctr   = 0
-                    for slot in layout[rack][chassisidx]:
-                        # Keep track of which controller in the slot
-                        ctrl_ctr = 0
-                        while ctrl_ctr < controllersperslot:
-                            # Keep track of which node inside the controller
-                            node_ctr = 0
-                            while node_ctr < nodespercontroller:
-                                logging.debug("rackidx %s, counter %s, chassis %s, slot %s, controller %s, node %s", str(nodeindexinrack), str(counter), str(chassis), str(slot), str(ctrl_ctr),  str(node_ctr))
-                                if counter == index:
-                                    # Found the right node, update the node object with the info and break out
-                                    node['nodeindexinrack'] = nodeindexinrack
-                                    node['rack']            = rack
-                                    node['rackidx']         = rack_idx
-                                    node['racknum']         = int(node['rack'][1:])
-                                    node['chassis']         = chassisidx
-                                    node['slot']            = slot
-                                    node['board']           = ctrl_ctr
-                                    node['nodenum']         = node_ctr
-                                    node['xname']           = "%sc%ds%db%dn%d"%(node['rack'], chassisidx, slot, ctrl_ctr, node_ctr)
-                                    if 'model' in settings['nodegroups'][group]:
-                                        node['model'] = settings['nodegroups'][group]['model']
-                                    if 'racktype' not in node:
-                                        _racktype(node)
-                                    return
-                                # Update all the node level counters and go on to the next one
-                                node_ctr        = node_ctr + 1
-                                counter         = counter + 1
-                                nodeindexinrack = nodeindexinrack + 1
-                            # Go on to next controller
-                            ctrl_ctr    = ctrl_ctr + 1
-                        # Go on to next slot
-                        slot_ctr = slot_ctr + 1
-        logging.debug("Node index <%s> not in nodegroup <%s>", str(index), str(group) )
-    # Should not get here
-    logging.error("Node index <%s> not found in nodegroups defined by layout in system.yaml", str(index) )
+        model              = settings['nodegroups'][group].get('model')
+
+        # count up the nodes within the group
+        counter = startnum
+
+        for rack in layout:
+            # keep track of which node it is inside rack
+            # default to start at zero unless explicitly
+            # set for the rack in the nodegroup in system.yaml
+            # allows for case where rack has multiple nodegroups
+            # and they can't all start at zero
+            nodeindexinrack = 0
+
+            # Get the index from zero for this rack within the list
+            rack_idx        = settings['rackidx'][rack]
+
+            for rackdata in layout[rack]:
+                # rackdata is either a integer defining which chassis in the rack
+                # or it is a variable with data for the specific rack
+                if rackdata == 'start_rackidx':
+                    nodeindexinrack = layout[rack]['start_rackidx']
+
+                    # Go to next line of rackinfo after handling this option
+                    continue
+                chassisidx = rackdata
+
+                for slot in layout[rack][chassisidx]:
+                    for ctrl_ctr in range(controllersperslot):
+                        for node_ctr in range(nodespercontroller):
+                            # The first group that claims an index wins
+                            if startnum <= counter <= endnum and counter not in index:
+                                index[counter] = (rack, rack_idx, nodeindexinrack,
+                                                  chassisidx, slot, ctrl_ctr,
+                                                  node_ctr, model)
+                            counter         = counter + 1
+                            nodeindexinrack = nodeindexinrack + 1
+    logging.debug("Built the nodegroups layout index with %d nodes", len(index))
+    return index
+
+def _node_info_by_layout(node):
+    ''' Looks up the node location in the nodegroups layout index '''
+    global layout_index
+    if layout_index is None:
+        layout_index = _build_layout_index()
+
+    index = node['nodeindex']
+    try:
+        (rack, rack_idx, nodeindexinrack, chassisidx, slot, ctrl_ctr, node_ctr, model) = layout_index[index]
+    except KeyError:
+        logging.error("Node index <%s> not found in nodegroups defined by layout in system.yaml", str(index) )
+        return
+
+    node['nodeindexinrack'] = nodeindexinrack
+    node['rack']            = rack
+    node['rackidx']         = rack_idx
+    node['racknum']         = int(rack[1:])
+    node['chassis']         = chassisidx
+    node['slot']            = slot
+    node['board']           = ctrl_ctr
+    node['nodenum']         = node_ctr
+    node['xname']           = "%sc%ds%db%dn%d"%(rack, chassisidx, slot, ctrl_ctr, node_ctr)
+    if model is not None:
+        node['model'] = model
+    if 'racktype' not in node:
+        _racktype(node)
 
 def _nid_to_node_attrs(node):
     ''' If a node has nodeindex set, try to figure out the xname details'''
@@ -345,7 +379,7 @@ def _nid_to_node_attrs(node):
     node['nodeindexinrack'] = rackoffset
     node['rack']    = settings['racklist'][rackidx]
     if 'racklistnonempty' in settings:
-        node['rackidxnonempty'] = settings['racklistnonempty'].index(node['rack'])
+        node['rackidxnonempty'] = settings['rackidxnonempty'][node['rack']]
     node['rackidx'] = rackidx
     node['racknum'] = int(node['rack'][1:])
 
@@ -370,12 +404,24 @@ def set_node_attrs(node, layer=None, alias=None):
         Note that a "node" in this context could be a
         compute node, nC, cC, cec, or switch
     '''
+    read_rosetta()
+    _set_node_attrs(node, layer, alias)
+
+# Entry point called from Node.run_plugins_bulk
+def set_nodes_attrs(nodes, layers, aliases):
+    ''' Sets attributes for a list of nodes. Work that does not depend on
+        the node is only done once for the whole list.
+    '''
+    logging.debug("Running cray_ex plugin for %d nodes", len(nodes))
+    read_rosetta()
+    for node, layer, alias in zip(nodes, layers, aliases):
+        _set_node_attrs(node, layer, alias)
+
+def _set_node_attrs(node, layer, alias):
     logging.debug("Running cray_ex plugin for node %s", node['name'])
 
     global settings
 
-    read_rosetta()
-
     _name_to_nodeindex(node)
     # FIXME: This won't do the right thing if you system name starts with 'x'
     #        Hopefully that won't bite us any time soon...
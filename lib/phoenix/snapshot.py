@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Phoenix cache of parsed configuration files"""
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import logging
+import hashlib
+import pickle
+import tempfile
+from pathlib import Path
+
+import yaml
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    logging.info("Unable to load CLoader")
+    from yaml import Loader
+
+import phoenix
+
+class Snapshot(object):
+    ''' Parsed yaml files are stored as pickles under cache_path so the next
+        process can skip the yaml parser. A snapshot is reused as long as the
+        source file stats (mtime, size, inode) are unchanged. If only the
+        stats changed, the content hash decides. Snapshots are replaced with
+        a rename so concurrent readers always see a whole file. Loading a
+        pickle can run code, so snapshots are only read if they and their
+        directory belong to the current user and nobody else can write them.
+    '''
+    magic = b'PXSNAP'
+    version = 1
+    enabled = True
+
+    @classmethod
+    def _snapshot_dir(cls):
+        return Path(phoenix.cache_path) / 'snapshots'
+
+    @classmethod
+    def _snapshot_file(cls, filename):
+        key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        return cls._snapshot_dir() / ('%s.pxsnap' % key)
+
+    @staticmethod
+    def _stat_key(st):
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @classmethod
+    def _header(cls):
+        return cls.magic + b'%03d' % cls.version
+
+    @staticmethod
+    def _trusted(st):
+        return st.st_uid == os.geteuid() and not st.st_mode & 0o022
+
+    @classmethod
+    def _read(cls, snapfile):
+        ''' Returns (meta, fd) with fd positioned at the data, or None '''
+        try:
+            dirfd = os.open(snapfile.parent, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+        except OSError:
+            return None
+        try:
+            if not cls._trusted(os.fstat(dirfd)):
+                logging.warning("Ignoring snapshots in %s, it is writable by other users", snapfile.parent)
+                return None
+            filefd = os.open(snapfile.name, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=dirfd)
+        except OSError:
+            return None
+        finally:
+            os.close(dirfd)
+        fd = os.fdopen(filefd, 'rb')
+        try:
+            if not cls._trusted(os.fstat(filefd)):
+                logging.warning("Ignoring snapshot %s, it is writable by other users", snapfile)
+                fd.close()
+                return None
+            if fd.read(len(cls._header())) != cls._header():
+                logging.debug("Snapshot %s has a different version", snapfile)
+                fd.close()
+                return None
+            meta = pickle.load(fd)
+        except Exception as e:
+            logging.debug("Could not read snapshot %s: %s", snapfile, e)
+            fd.close()
+            return None
+        return (meta, fd)
+
+    @classmethod
+    def _write(cls, snapfile, meta, data):
+        try:
+            snapfile.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            st = os.stat(snapfile.parent)
+            if st.st_uid != os.geteuid():
+                logging.debug("Not writing snapshots to %s, it belongs to another user", snapfile.parent)
+                return
+            if st.st_mode & 0o077:
+                os.chmod(snapfile.parent, 0o700)
+            # mkstemp creates the file with mode 0600
+            (tmpfd, tmpname) = tempfile.mkstemp(dir=snapfile.parent, prefix='.tmp')
+            try:
+                with os.fdopen(tmpfd, 'wb') as outfd:
+                    outfd.write(cls._header())
+                    pickle.dump(meta, outfd, protocol=pickle.HIGHEST_PROTOCOL)
+                    pickle.dump(data, outfd, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpname, snapfile)
+            except:
+                os.unlink(tmpname)
+                raise
+        except Exception as e:
+            logging.debug("Could not write snapshot %s: %s", snapfile, e)
+
+    @classmethod
+    def _write_yaml(cls, filename, st, digest, data):
+        meta = { 'source': os.path.abspath(filename),
+                 'stat': cls._stat_key(st),
+                 'sha256': digest,
+               }
+        cls._write(cls._snapshot_file(filename), meta, data)
+
+    @classmethod
+    def _parse(cls, filename, st, content=None):
+        if content is None:
+            with open(filename, 'rb') as fd:
+                content = fd.read()
+        logging.debug("Parsing %s", filename)
+        data = yaml.load(content, Loader=Loader)
+        cls._write_yaml(filename, st, hashlib.sha256(content).hexdigest(), data)
+        return data
+
+    @classmethod
+    def load_yaml(cls, filename):
+        ''' Returns the parsed contents of a yaml file. Raises the same
+            exceptions as opening the file would if it is missing.
+        '''
+        st = os.stat(filename)
+        if not cls.enabled:
+            with open(filename) as fd:
+                return yaml.load(fd, Loader=Loader)
+
+        snapshot = cls._read(cls._snapshot_file(filename))
+        if snapshot is None:
+            return cls._parse(filename, st)
+
+        (meta, snapfd) = snapshot
+        with snapfd:
+            refresh = meta['stat'] != cls._stat_key(st)
+            if refresh:
+                with open(filename, 'rb') as fd:
+                    content = fd.read()
+                if hashlib.sha256(content).hexdigest() != meta['sha256']:
+                    return cls._parse(filename, st, content)
+            try:
+                data = pickle.load(snapfd)
+            except Exception as e:
+                logging.debug("Snapshot for %s is damaged: %s", filename, e)
+                return cls._parse(filename, st)
+
+        logging.debug("Using snapshot for %s", filename)
+        if refresh:
+            # Touched but not changed, store the new stats for next time
+            cls._write_yaml(filename, st, meta['sha256'], data)
+        return data
+
+    @classmethod
+    def sources_key(cls, sources):
+        ''' Returns the stats of a list of files, for fetch() and store().
+            Take this before reading the sources so a change made while
+            building the data is not missed.
+        '''
+        key = list()
+        for source in sources:
+            try:
+                key.append((os.path.abspath(source), cls._stat_key(os.stat(source))))
+            except OSError:
+                key.append((os.path.abspath(source), None))
+        return key
+
+    @classmethod
+    def fetch(cls, name, key):
+        ''' Returns the data stored under name if it was stored with the
+            same sources key, otherwise None
+        '''
+        if not cls.enabled:
+            return None
+        snapshot = cls._read(cls._snapshot_dir() / ('%s.pxsnap' % name))
+        if snapshot is None:
+            return None
+        (meta, snapfd) = snapshot
+        with snapfd:
+            if meta.get('sources') != key:
+                logging.debug("Snapshot %s is out of date", name)
+                return None
+            try:
+                return pickle.load(snapfd)
+            except Exception as e:
+                logging.debug("Snapshot %s is damaged: %s", name, e)
+                return None
+
+    @classmethod
+    def store(cls, name, key, data):
+        ''' Saves data that was built from the files in the sources key '''
+        if not cls.enabled:
+            return
+        cls._write(cls._snapshot_dir() / ('%s.pxsnap' % name), {'sources': key}, data)
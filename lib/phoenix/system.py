@@ -3,21 +3,19 @@
 # vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
 
 import logging
-from yaml import load, dump
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    logging.info("Unable to load CLoader and/or CDumper")
-    from yaml import Loader, Dumper
-
 from ClusterShell.NodeSet import NodeSet
 import phoenix
+from phoenix.snapshot import Snapshot
+from phoenix.watch import FileWatcher
 import re
 import copy
 
 class System(object):
     loaded_config = False
     loaded_racklist = False
+    filename = None
+    # Bumped every time the config is (re)loaded so caches can tell it changed
+    generation = 0
 
     # Dicts to hold all System data
     config = dict()
@@ -36,12 +34,26 @@ class System(object):
 
         # Read the yaml file
         logging.info("Loading system file '%s'", filename)
-        with open(filename) as systemfd:
-            systemdata = load(systemfd, Loader=Loader) or {}
+        FileWatcher.watch('system', [filename], cls.reload)
+        systemdata = Snapshot.load_yaml(filename) or {}
 
+        cls.filename = filename
         cls.config = systemdata
+        cls.rackmap = dict()
+        cls.loaded_racklist = False
+        cls.generation += 1
         cls.loaded_config = True
 
+    @classmethod
+    def reload(cls):
+        """ Reads system.yaml again, keeping the old config if that fails """
+        cls.loaded_config = False
+        try:
+            cls.load_config(cls.filename)
+        except:
+            cls.loaded_config = True
+            raise
+
     @classmethod
     def load_racklist(cls):
         ''' Special handling for 'racks'. Expected to be a map with keys being
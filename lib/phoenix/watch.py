@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Phoenix file change notification"""
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+import os
+import time
+import errno
+import threading
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_CHANGES = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+_event = struct.Struct('iIII')
+
+class Inotify(object):
+    ''' Minimal inotify wrapper that watches directory trees.
+        read() returns the paths that changed. A path of None means
+        events were lost and the caller should assume everything changed.
+    '''
+    libc = None
+
+    def __init__(self):
+        if Inotify.libc is None:
+            Inotify.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = dict()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path, mask=IN_CHANGES):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        return wd
+
+    def watch_tree(self, path):
+        ''' Watches a directory and every directory below it '''
+        for dirpath, dirnames, filenames in os.walk(path):
+            try:
+                self.add_watch(dirpath)
+            except OSError as e:
+                logging.warning("Could not watch %s: %s", dirpath, e)
+
+    def read(self, timeout=None):
+        ''' Waits up to timeout seconds for events, None waits forever '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        changed = list()
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, cookie, length) = _event.unpack_from(buf, offset)
+            offset += _event.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.append(None)
+                continue
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            try:
+                path = self.paths[wd]
+            except KeyError:
+                continue
+            if name:
+                path = os.path.join(path, os.fsdecode(name))
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # New directories need watches of their own
+                self.watch_tree(path)
+            changed.append(path)
+        return changed
+
+class FileWatcher(object):
+    ''' Registry of loaders and the files they were loaded from. check()
+        compares the current stats (mtime, size, inode) with the ones taken
+        at load time and reloads whatever changed, followed by everything
+        that depends on it, in dependency order.
+    '''
+    # name -> (files, reload, depends)
+    watches = dict()
+    # name -> stats of the files when they were loaded
+    stats = dict()
+    lock = threading.RLock()
+
+    @staticmethod
+    def _stats(files):
+        stats = list()
+        for filename in files:
+            try:
+                st = os.stat(filename)
+                stats.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    @classmethod
+    def watch(cls, name, files, reload, depends=()):
+        ''' Records that name is being loaded from files. Call it before
+            reading them so a change made during the load is not missed.
+            files may be a callable returning the list, for loaders like
+            the node files where new files can show up. reload is called
+            without arguments when a file changes or anything in depends
+            reloads, and is expected to call watch again.
+        '''
+        with cls.lock:
+            cls.watches[name] = (files, reload, tuple(depends))
+            cls.stats[name] = cls._stats(cls._files(files))
+
+    @staticmethod
+    def _files(files):
+        if callable(files):
+            files = files()
+        return [str(x) for x in files]
+
+    @classmethod
+    def _order(cls, names):
+        ''' Returns names and everything depending on them, dependencies first '''
+        order = list()
+        def visit(name, seen):
+            if name in order or name in seen or name not in cls.watches:
+                return
+            seen = seen | {name}
+            for dep in cls.watches[name][2]:
+                if dep in names or dep in order:
+                    visit(dep, seen)
+            order.append(name)
+
+        # Pull in the dependents until nothing new is added
+        names = set(names)
+        while True:
+            more = {name for name, watch in cls.watches.items()
+                    if name not in names and names.intersection(watch[2])}
+            if not more:
+                break
+            names.update(more)
+        for name in sorted(names):
+            visit(name, set())
+        return order
+
+    @classmethod
+    def changed(cls):
+        ''' Returns the names whose files changed since they were loaded '''
+        with cls.lock:
+            return [name for name, (files, reload, depends) in list(cls.watches.items())
+                    if cls._stats(cls._files(files)) != cls.stats[name]]
+
+    @classmethod
+    def check(cls):
+        ''' Reloads what changed and returns the names that were reloaded '''
+        with cls.lock:
+            changed = cls.changed()
+            if not changed:
+                return []
+            order = cls._order(changed)
+            logging.info("Reloading %s", ", ".join(order))
+            for name in order:
+                (files, reload, depends) = cls.watches[name]
+                stats = cls._stats(cls._files(files))
+                try:
+                    reload()
+                except Exception:
+                    logging.exception("Reloading %s failed, keeping the previous version", name)
+                    # Don't try again until the files change again
+                    cls.stats[name] = stats
+            return order
+
+    @classmethod
+    def start(cls, directories, debounce=1.0, interval=10):
+        ''' Checks for changes in a background thread. With inotify the
+            check runs once the directories have been quiet for debounce
+            seconds, otherwise it runs every interval seconds.
+        '''
+        try:
+            inotify = Inotify()
+            for directory in directories:
+                if os.path.isdir(directory):
+                    inotify.watch_tree(directory)
+        except OSError as e:
+            logging.warning("inotify is not available, checking for changes every %ds: %s", interval, e)
+            inotify = None
+
+        def run():
+            while True:
+                if inotify is None:
+                    time.sleep(interval)
+                else:
+                    inotify.read()
+                    while len(inotify.read(debounce)) > 0:
+                        pass
+                try:
+                    cls.check()
+                except Exception:
+                    logging.exception("Checking for config changes failed")
+
+        thread = threading.Thread(target=run, name='filewatcher', daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,35 @@
+import phoenix
+from phoenix.datasource.sqlite import SqliteDatasource
+from phoenix.datasource.csvfile import CsvfileDatasource
+
+def test_sqlite_datasource(tmp_path, monkeypatch):
+    monkeypatch.setattr(SqliteDatasource, 'settings', {'filename': str(tmp_path / 'phoenix.db'),
+                                                       'journal_mode': 'wal', 'timeout': 5})
+    monkeypatch.setattr(SqliteDatasource, 'loaded_settings', True)
+    (tmp_path / 'mac.csv').write_text('node01,02:00:00:00:00:01\nnode02,02:00:00:00:00:02\n')
+
+    SqliteDatasource.import_csv(str(tmp_path))
+    assert SqliteDatasource.getval('mac', 'node01') == '02:00:00:00:00:01'
+    assert SqliteDatasource.getval('mac', 'node03') is None
+
+    SqliteDatasource.setval('mac', 'node01', '02:00:00:00:00:11')
+    SqliteDatasource.setvals('mac', {'node02': '02:00:00:00:00:12', 'node03': '02:00:00:00:00:13'})
+    assert SqliteDatasource.getval('mac', 'node01') == '02:00:00:00:00:11'
+    assert SqliteDatasource.getval('mac', 'node03') == '02:00:00:00:00:13'
+    SqliteDatasource.local.conn.close()
+    SqliteDatasource.local.conn = None
+
+def test_csvfile_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(phoenix, 'data_path', str(tmp_path))
+    monkeypatch.setattr(CsvfileDatasource, 'data', dict())
+    monkeypatch.setattr(CsvfileDatasource, 'data_freshness', dict())
+    (tmp_path / 'mac.csv').write_text('node01,02:00:00:00:00:01\n')
+
+    with CsvfileDatasource.batch():
+        CsvfileDatasource.setval('mac', 'node02', '02:00:00:00:00:02')
+        CsvfileDatasource.setval('mac', 'node03', '02:00:00:00:00:03')
+        # Nothing is written until the batch ends
+        assert (tmp_path / 'mac.csv').read_text() == 'node01,02:00:00:00:00:01\n'
+    assert CsvfileDatasource.getval('mac', 'node03') == '02:00:00:00:00:03'
+    assert (tmp_path / 'mac.csv').read_text().count('\n') == 3
+    assert [x.name for x in tmp_path.iterdir()] == ['mac.csv']
@@ -0,0 +1,49 @@
+import ipaddress
+import os
+import pytest
+
+from phoenix.node import Node
+from phoenix.network import SubnetList
+from phoenix.network import AddressIndex
+
+def test_subnetlist():
+    network = ipaddress.ip_network('10.0.0.0/16')
+    subnets = SubnetList(network, 22)
+    assert list(subnets) == list(network.subnets(new_prefix=22))
+    assert len(subnets) == 64
+    assert subnets[1] == ipaddress.ip_network('10.0.4.0/22')
+    assert subnets[-1] == ipaddress.ip_network('10.0.252.0/22')
+    with pytest.raises(IndexError):
+        subnets[64]
+
+    # Far too many subnets to ever build as a list
+    subnets6 = SubnetList(ipaddress.ip_network('fc00::/32'), 96)
+    assert subnets6[65536] == ipaddress.ip_network('fc00::1:0:0:0/96')
+
+addressyaml = '''
+'node[01-03]':
+  interfaces:
+    eth0:
+      ip: '10.0.0.{{nodeindex}}'
+      ip6: 'fc00::{{nodeindex}}'
+      mac: '02:00:00:00:00:0{{nodeindex}}'
+node03:
+  interfaces:
+    eth0:
+      ip: '10.0.0.1'
+'''
+
+def test_address_index():
+    Node.load_nodes(datastr=addressyaml, clear=True)
+    index = AddressIndex.build(Node.nodes.values())
+    assert index.lookup('10.0.0.2') == [('node02', 'eth0')]
+    assert index.lookup('FC00:0::2') == [('node02', 'eth0')]
+    assert index.lookup('02:00:00:00:00:0A') == []
+    assert index.lookup('02:00:00:00:00:03') == [('node03', 'eth0')]
+    assert index.duplicates == {'10.0.0.1': [('node01', 'eth0'), ('node03', 'eth0')]}
+    assert index.interfaces['node03']['eth0']['ip'] == '10.0.0.1'
+
+def test_address_index_sources():
+    sources = AddressIndex.sources()
+    assert any(x.endswith(os.path.join('phoenix', 'network.py')) for x in sources)
+    assert any(x.endswith(os.path.join('plugins', '__init__.py')) for x in sources)
@@ -1,5 +1,9 @@
+import os
+import time
+import types
 import pytest
 
+import phoenix
 from phoenix.node import Node
 from phoenix.node import NodeLayer
 from phoenix.node import NodeLayerMap
@@ -87,3 +91,184 @@ def test_node_templates():
     assert n3['mapping2']['key7'] == 'hello-rack2node3'
     #print(dict(n3))
     print(n3)
+
+def test_node_resolved_cache():
+    Node.load_nodes(datastr=datayaml, clear=True)
+    n1 = Node.find_node('node01')
+    assert n1['key1'] == 'valueA'
+    assert n1.resolved
+    assert n1['mapping1'] is n1['mapping1']
+
+    # Writing to the cache layer must invalidate the resolved view
+    n1['key1'] = 'valueH'
+    assert n1['key1'] == 'valueH'
+
+    # As does adding a layer
+    n1.addlayer(NodeLayer(layertype='manual', data={'key2': 'valueI', 'mapping1': {'key3': 'valueJ'}}), position=1)
+    assert n1['key2'] == 'valueI'
+    assert n1['mapping1']['key3'] == 'valueJ'
+    assert n1['mapping1']['key4'] == 'valueD'
+
+def test_node_nested_write():
+    Node.load_nodes(datastr=datayaml, clear=True)
+    n1 = Node.find_node('node01')
+    n2 = Node.find_node('node02')
+    n1['mapping1']['key3'] = 'valueK'
+    assert n1['mapping1']['key3'] == 'valueK'
+
+    # Kept when the resolved view is dropped
+    n1['key1'] = 'valueL'
+    assert n1['mapping1']['key3'] == 'valueK'
+    assert n1['mapping1']['key4'] == 'valueD'
+    n1.addlayer(NodeLayer(layertype='manual', data={'mapping1': {'key3': 'valueM'}}), position=1)
+    assert n1['mapping1']['key3'] == 'valueK'
+
+    # Deeper, and without touching the layers shared with other nodes
+    n1['mapping1']['mapping3'] = {'key11': 'valueN'}
+    n1['mapping1']['mapping3']['key11'] = 'valueO'
+    n1['key2'] = 'valueP'
+    assert n1['mapping1']['mapping3']['key11'] == 'valueO'
+    assert n2['mapping1']['key3'] == 'valueC'
+    assert 'mapping3' not in n2['mapping1']
+
+templateyaml = '''
+'tnode[01-02]':
+  key8: '{{ key9 }}-x'
+  key9: a
+  key10: '{{ key8 }}-y'
+'''
+
+def test_node_template_cache():
+    Node.load_nodes(datastr=templateyaml, clear=True)
+    n1 = Node.find_node('tnode01')
+    n2 = Node.find_node('tnode02')
+    assert n1['key10'] == 'a-x-y'
+    assert n2['key10'] == 'a-x-y'
+    assert len(n1.templatecache) == 2
+
+    # Unrelated writes keep rendered templates
+    n1['key1'] = 'z'
+    assert len(n1.templatecache) == 2
+
+    # Writing an input re-renders everything that (indirectly) read it
+    n1['key9'] = 'b'
+    assert len(n1.templatecache) == 0
+    assert n1['key10'] == 'b-x-y'
+    assert n2['key10'] == 'a-x-y'
+
+def test_node_lazy_loading():
+    Node.load_nodes(datastr=datayaml, nodeset='node02', clear=True)
+    assert list(Node.nodes) == ['node02']
+
+    # Nodes outside of the requested nodeset are built on demand
+    n1 = Node.find_node('node01')
+    assert n1['key1'] == 'valueA'
+    assert n1['key2'] == 'valueE'
+    assert n1['mapping1']['key5'] == 'valueG'
+    assert Node.find_node('rack2node3')['key6'] == 'rack2node3-templated'
+    with pytest.raises(KeyError):
+        Node.find_node('node03')
+
+def test_node_range_index():
+    Node.load_nodes(datastr=datayaml, nodeset='node02', clear=True)
+    index = Node._range_index()
+    assert [layer.meta.noderange for layer in index['node01']] == ['node[01-02]', 'node01']
+    assert 'node03' not in index
+
+    # Later files extend the index, in file order
+    Node.load_nodes(datastr="'node[01-03]':\n  key1: valueH\n", nodeset='node03')
+    assert Node._range_index() is index
+    assert [layer.meta.noderange for layer in index['node01']] == ['node[01-02]', 'node01', 'node[01-03]']
+    assert Node.find_node('node01')['key1'] == 'valueH'
+    assert Node.find_node('node03')['key1'] == 'valueH'
+
+def test_node_load_scaling(tmp_path):
+    base = tmp_path / 'nodes.yaml'
+    base.write_text("'node[00001-20000]':\n  key1: valueA\n")
+    fragment = tmp_path / 'fragment.yaml'
+    fragment.write_text(''.join("'node[%05d-%05d]':\n  key2: value%d\n" % (i * 100 + 1, i * 100 + 100, i)
+                                for i in range(200)))
+    Node.load_nodes(filename=str(base), clear=True)
+    start = time.time()
+    Node.load_nodes(filename=str(fragment))
+    # Seconds per range per built node would make this minutes
+    assert time.time() - start < 5
+    assert Node.find_node('node00150')['key2'] == 'value1'
+
+    # Nodes built earlier but outside of nodeset still get the layers
+    Node.load_nodes(filename=str(base), nodeset='node[00001-00100]', clear=True)
+    Node.find_node('node00150')
+    Node.load_nodes(filename=str(fragment), nodeset='node[00001-00100]')
+    assert Node.find_node('node00050')['key2'] == 'value0'
+    assert Node.find_node('node00150')['key2'] == 'value1'
+    assert Node.find_node('node19999')['key2'] == 'value199'
+
+def test_node_reload(tmp_path, monkeypatch):
+    monkeypatch.setattr(phoenix, 'conf_path', str(tmp_path))
+    monkeypatch.setattr(phoenix, 'cache_path', str(tmp_path / 'cache'))
+    (tmp_path / 'nodes.d').mkdir()
+    (tmp_path / 'nodes.yaml').write_text(datayaml)
+    (tmp_path / 'nodes.d' / 'extra.yaml').write_text("'node[01-02]':\n  key7: valueH\n")
+    Node.load_nodes(clear=True)
+    n1 = Node.find_node('node01')
+    # Plugins only run when a node is read
+    assert not n1.ran_plugins
+    unchanged = Node.nodefiles[str(tmp_path / 'nodes.yaml')][1]
+
+    # Only the edited file is parsed again, old nodes keep the old view
+    (tmp_path / 'nodes.d' / 'extra.yaml').write_text("'node[01-02]':\n  key7: valueI\n")
+    os.utime(tmp_path / 'nodes.d' / 'extra.yaml', ns=(1, 1))
+    Node.reload_nodes()
+    assert Node.nodefiles[str(tmp_path / 'nodes.yaml')][1] is unchanged
+    assert Node.find_node('node01')['key7'] == 'valueI'
+    assert n1['key7'] == 'valueH'
+
+def test_node_plugin_bulk(monkeypatch):
+    calls = list()
+    def set_nodes_attrs(nodes, layers, aliases):
+        calls.append([node.name for node in nodes])
+        # The model is linked after the plugin, which may set it
+        assert not any(node.linked_model for node in nodes)
+        for node, layer in zip(nodes, layers):
+            layer['key8'] = node['key2'] + '-bulk'
+    monkeypatch.setitem(Node.plugins, 'bulk', types.SimpleNamespace(set_nodes_attrs=set_nodes_attrs))
+    Node.load_nodes(datastr=datayaml, nodeset='node[01-02]', clear=True)
+    for node in Node.nodes.values():
+        node['plugin'] = 'bulk'
+    Node.run_plugins_bulk(list(Node.nodes.values()))
+    assert calls == [['node01', 'node02']]
+    assert Node.find_node('node01')['key8'] == 'valueE-bulk'
+    assert Node.find_node('node02')['key8'] == 'valueB-bulk'
+    assert Node.find_node('node02').linked_model
+
+def test_node_resolve_parallel(monkeypatch):
+    Node.load_nodes(datastr=datayaml, nodeset='', clear=True)
+    # One node per shard so the pool is used
+    monkeypatch.setattr(Node, 'shard_size', 1)
+    nodes = ['rack2node3', 'node01', 'node02']
+    for jobs in [1, 2]:
+        records = Node.resolve_nodes(nodes, ['key2', 'key6', 'mapping1', 'mapping2'], jobs=jobs)
+        assert list(records) == nodes
+        assert records['node01'] == { 'key2': 'valueE',
+                                      'mapping1': {'key3': 'valueF', 'key4': 'valueD', 'key5': 'valueG'} }
+        assert records['rack2node3'] == { 'key6': 'rack2node3-templated',
+                                          'mapping2': {'key7': 'hello-rack2node3'} }
+
+def test_bytecode_cache_permissions(tmp_path, monkeypatch):
+    monkeypatch.setattr(phoenix, 'cache_path', str(tmp_path / 'cache'))
+    cachedir = tmp_path / 'cache' / 'jinja'
+    assert phoenix.get_bytecode_cache() is not None
+    assert cachedir.stat().st_mode & 0o777 == 0o700
+
+    # Readable by others is tightened, writable by others is not used
+    cachedir.chmod(0o755)
+    assert phoenix.get_bytecode_cache() is not None
+    assert cachedir.stat().st_mode & 0o777 == 0o700
+    cachedir.chmod(0o777)
+    assert phoenix.get_bytecode_cache() is None
+    cachedir.chmod(0o700)
+
+    # Nor is a link to somewhere else
+    cachedir.rename(tmp_path / 'elsewhere')
+    cachedir.symlink_to(tmp_path / 'elsewhere')
+    assert phoenix.get_bytecode_cache() is None
@@ -0,0 +1,171 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+import pytest
+
+import phoenix
+from phoenix.oob import BmcProfile, PowerPoller, RequestPolicy, ResourceCache, PENDING
+
+class FakeClient(object):
+    def __init__(self, name):
+        self.node = {'name': name, 'bmc': 'bmc1'}
+        self.closed = False
+        self.outputs = list()
+        self.rc = None
+        self.done = threading.Event()
+
+    def output(self, message, stderr=False):
+        self.outputs.append(message)
+
+    def set_state(self, state):
+        self.state = state
+
+    def mark_command_complete(self, rc):
+        self.rc = rc
+        self.done.set()
+
+class FakeOob(object):
+    ''' Nodes that report Off a few times before they are On '''
+    oobtype = 'bmc'
+    polls = dict()
+    lock = threading.Lock()
+    polling = 0
+    overlapped = False
+
+    @classmethod
+    def _get_auth(cls, node):
+        return None
+
+    @classmethod
+    def _power_state(cls, node, auth=None):
+        with cls.lock:
+            cls.polling += 1
+            cls.overlapped = cls.overlapped or cls.polling > 1
+            cls.polls[node['name']] = cls.polls.get(node['name'], 0) + 1
+            polls = cls.polls[node['name']]
+        time.sleep(0.002)
+        with cls.lock:
+            cls.polling -= 1
+        return (True, 'On' if polls >= 3 else 'Off')
+
+def test_power_poller(monkeypatch):
+    monkeypatch.setattr(PowerPoller, 'settings', {'interval': 0.01, 'max_interval': 0.02, 'backoff': 2, 'threads': 4})
+    monkeypatch.setattr(PowerPoller, 'loaded_settings', True)
+    clients = [FakeClient('node%02d' % i) for i in range(5)]
+    for client in clients:
+        assert PowerPoller.add(client, FakeOob, 'on') is PENDING
+    late = FakeClient('late')
+    PowerPoller.add(late, FakeOob, 'on', timeout=0)
+    for client in clients + [late]:
+        assert client.done.wait(5)
+    for client in clients:
+        assert client.rc == 0
+        assert client.outputs == ['On']
+        assert FakeOob.polls[client.node['name']] == 3
+    assert late.rc == 1
+    assert late.outputs == ['Timed out waiting for power state on']
+    # The nodes behind one BMC are polled one at a time
+    assert not FakeOob.overlapped
+
+@pytest.fixture
+def profiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(phoenix, 'cache_path', str(tmp_path / 'cache'))
+    monkeypatch.setattr(BmcProfile, 'profiles', dict())
+    monkeypatch.setattr(BmcProfile, 'ttl', 3600)
+    monkeypatch.setattr(BmcProfile, 'refresh', False)
+
+def test_bmc_profile(profiles, monkeypatch):
+    assert BmcProfile.get('bmc1', 'expand', True) is True
+    BmcProfile.set('bmc1', 'expand', False)
+    BmcProfile.set('bmc1', 'systems', ['Systems/1'])
+    assert BmcProfile.get('bmc1', 'expand', True) is False
+
+    # Later commands read what was saved
+    monkeypatch.setattr(BmcProfile, 'profiles', dict())
+    assert BmcProfile.get('bmc1', 'systems') == ['Systems/1']
+
+    # Old facts are discovered again
+    monkeypatch.setattr(BmcProfile, 'profiles', dict())
+    monkeypatch.setattr(time, 'time', lambda: 4000000000)
+    assert BmcProfile.get('bmc1', 'expand', True) is True
+
+def test_bmc_profile_fallback(profiles, monkeypatch):
+    BmcProfile.set('bmc1', 'expand', False)
+    # --refresh-bmc-cache ignores saved facts
+    monkeypatch.setattr(BmcProfile, 'profiles', dict())
+    monkeypatch.setattr(BmcProfile, 'refresh', True)
+    assert BmcProfile.get('bmc1', 'expand', True) is True
+
+    # So does a damaged profile
+    monkeypatch.setattr(BmcProfile, 'profiles', dict())
+    monkeypatch.setattr(BmcProfile, 'refresh', False)
+    BmcProfile._profile_file('bmc1').write_text('{"expand": ')
+    assert BmcProfile.get('bmc1', 'expand', True) is True
+    BmcProfile.set('bmc1', 'expand', False)
+    monkeypatch.setattr(BmcProfile, 'profiles', dict())
+    assert BmcProfile.get('bmc1', 'expand', True) is False
+
+def test_resource_cache():
+    # Nothing is kept outside of a command
+    ResourceCache.put('bmc1', 'Systems/1', 'system')
+    assert ResourceCache.get('bmc1', 'Systems/1') is None
+
+    with ResourceCache.scope():
+        ResourceCache.put('bmc1', 'Systems/1', 'system')
+        ResourceCache.put('bmc2', 'Systems/1', 'other')
+        assert ResourceCache.get('bmc1', 'Systems/1') == 'system'
+        # Each node's command has its own
+        with ResourceCache.scope():
+            assert ResourceCache.get('bmc1', 'Systems/1') is None
+        assert contextvars.copy_context().run(ResourceCache.get, 'bmc1', 'Systems/1') == 'system'
+        ResourceCache.invalidate('bmc1')
+        assert ResourceCache.get('bmc1', 'Systems/1') is None
+        assert ResourceCache.get('bmc2', 'Systems/1') == 'other'
+    assert ResourceCache.get('bmc2', 'Systems/1') is None
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setattr(RequestPolicy, 'settings', dict(RequestPolicy.settings, hedge=True, hedge_min_samples=5))
+    monkeypatch.setattr(RequestPolicy, 'loaded_settings', True)
+    monkeypatch.setattr(RequestPolicy, 'latencies', deque([0.01] * 5, maxlen=1000))
+
+class Client(object):
+    pass
+
+def test_hedged(hedging):
+    calls = list()
+    stuck = threading.Event()
+    def read():
+        calls.append(1)
+        if len(calls) == 1:
+            stuck.wait(5)
+            return 'slow'
+        return 'fast'
+    client = Client()
+    with RequestPolicy.scope(client):
+        assert RequestPolicy.hedged(read) == 'fast'
+    stuck.set()
+    assert client.hedges == 1
+
+def test_hedged_async(hedging):
+    started = list()
+    cancelled = list()
+    async def read():
+        started.append(1)
+        if len(started) == 1:
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+            return 'slow'
+        return 'fast'
+    async def run():
+        result = await RequestPolicy.hedged_async(read)
+        # Let the cancellation of the first read run
+        await asyncio.sleep(0)
+        return result
+    assert asyncio.run(run()) == 'fast'
+    assert cancelled == [1]
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import threading
+import time
+import pytest
+
+from phoenix.parallel import AsyncEngine, FanoutController, PhoenixDoorbell
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(FanoutController, 'settings', {'floor': 8, 'ceiling': 64, 'increase': 4, 'decrease': 0.5,
+                                                       'latency_factor': 2.0, 'error_rate': 0.05})
+    monkeypatch.setattr(FanoutController, 'loaded_settings', True)
+    return now
+
+def measure(controller, clock, latency, errors=0):
+    ''' Finishes one window of nodes that each took latency seconds '''
+    clock[0] += 100
+    window = controller.window
+    for i in range(window):
+        result = controller.sample(clock[0] - latency, i < errors)
+    return result
+
+def test_fanout_controller(clock):
+    controller = FanoutController()
+    assert controller.window == 8
+    # Slow start doubles the window
+    assert measure(controller, clock, 1.0) == 16
+    assert measure(controller, clock, 1.0) == 32
+    # Shrinks on errors, then grows by increase
+    assert measure(controller, clock, 1.0, errors=2) == 16
+    assert measure(controller, clock, 1.0) == 20
+    assert measure(controller, clock, 1.0) == 24
+    # And when nodes take much longer than in the fastest round
+    assert measure(controller, clock, 2.5) == 12
+    assert measure(controller, clock, 2.5) == 8
+    assert measure(controller, clock, 2.5) == 8
+
+def test_fanout_controller_limits(clock):
+    controller = FanoutController()
+    for i in range(5):
+        measure(controller, clock, 1.0)
+    assert controller.window == 64
+
+    # Nodes started before the window changed are not counted
+    clock[0] += 100
+    for i in range(64):
+        controller.sample(controller.changed - 1, True)
+    assert controller.window == 64
+    assert measure(controller, clock, 1.0, errors=64) == 32
+
+class Recorder(object):
+    ''' Stands in for the clients and the engine of a worker '''
+    def __init__(self):
+        self.messages = list()
+
+    def _handle_event(self, event, message):
+        self.messages.append((event, message))
+
+    def set_reading(self, client, sname):
+        pass
+
+def test_doorbell():
+    recorder = Recorder()
+    doorbell = PhoenixDoorbell(None)
+    doorbell._engine = recorder
+    readfd = doorbell.streams['in'].fd
+
+    def put(thread):
+        for i in range(500):
+            doorbell.put(recorder, 'out', (thread, i))
+    threads = [threading.Thread(target=put, args=(x,)) for x in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # One ring for all of them, so the pipe never fills up
+    assert os.read(readfd, 4096) == b'!'
+    doorbell._handle_read('in')
+    assert len(recorder.messages) == 4000
+    for thread in range(8):
+        assert [x[1] for x in recorder.messages if x[1][0] == thread] == [(thread, i) for i in range(500)]
+
+    # A message queued after draining rings again
+    doorbell.put(recorder, 'complete', 0)
+    doorbell._handle_read('in')
+    assert recorder.messages[-1] == ('complete', 0)
+    os.close(readfd)
+    os.close(doorbell.writefd)
+
+def test_async_engine(monkeypatch):
+    closed = list()
+    async def closer():
+        closed.append(asyncio.get_running_loop())
+    monkeypatch.setattr(AsyncEngine, 'closers', [closer])
+    running = [0, 0]
+    async def operation(i):
+        running[0] += 1
+        running[1] = max(running)
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        return i
+    engine = AsyncEngine(2)
+    futures = [engine.submit(operation(i)) for i in range(6)]
+    assert [future.result(timeout=5) for future in futures] == list(range(6))
+    # No more than limit at once
+    assert running[1] == 2
+    engine.shutdown()
+    assert closed == [engine.loop]
+    engine.thread.join(5)
+    assert not engine.thread.is_alive()
@@ -0,0 +1,250 @@
+import http.client
+import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+import phoenix
+from phoenix.oob import BmcProfile, CircuitBreaker, RequestPolicy, ResourceCache
+from phoenix.oob import OOBTimeoutError, OOBConnectError, OOBUnreachableError
+from phoenix.oob.redfish import Redfish, RedfishBmc
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or dict()
+        self.text = ''
+
+class FakeSession(object):
+    ''' Answers SessionService requests with the given statuses in turn '''
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.requests = list()
+
+    def post(self, url, **kwargs):
+        self.requests.append(('post', url))
+        status = self.statuses.pop(0)
+        token = 'token%d' % len(self.requests)
+        return FakeResponse(status, {'X-Auth-Token': token,
+                                     'Location': '/redfish/v1/SessionService/Sessions/%s' % token})
+
+    def delete(self, url, headers=None, **kwargs):
+        self.requests.append(('delete', url, headers['X-Auth-Token']))
+        return FakeResponse(204)
+
+@pytest.fixture
+def bmc(tmp_path, monkeypatch):
+    monkeypatch.setattr(phoenix, 'cache_path', str(tmp_path / 'cache'))
+    monkeypatch.setattr(BmcProfile, 'profiles', dict())
+    monkeypatch.setattr(Redfish, 'tokens', dict())
+    def use(session):
+        monkeypatch.setattr(Redfish, '_session', classmethod(lambda cls, host: session))
+        return session
+    return use
+
+def test_session_token(bmc):
+    session = bmc(FakeSession(201, 201))
+    auth = ('admin', 'password')
+    assert Redfish._auth_token('bmc1', auth) == 'token1'
+    assert Redfish._auth_token('bmc1', auth) == 'token1'
+    sessiondir = Redfish._session_file('bmc1').parent
+    assert sessiondir.stat().st_mode & 0o777 == 0o700
+    assert Redfish._session_file('bmc1').stat().st_mode & 0o777 == 0o600
+
+    # An expired token is logged out of before it is replaced
+    Redfish.tokens['bmc1']['expires'] = 0
+    assert Redfish._auth_token('bmc1', auth) == 'token3'
+    assert session.requests[1] == ('delete', 'https://bmc1/redfish/v1/SessionService/Sessions/token1', 'token1')
+
+    # A token the BMC rejected is forgotten
+    Redfish._drop_token('bmc1', 'token3')
+    assert 'bmc1' not in Redfish.tokens
+    assert not Redfish._session_file('bmc1').exists()
+
+def test_session_dir_permissions(bmc):
+    bmc(FakeSession(201))
+    sessiondir = Redfish._session_file('bmc1').parent
+    sessiondir.mkdir(mode=0o755, parents=True)
+    sessiondir.chmod(0o755)
+    Redfish._auth_token('bmc1', ('admin', 'password'))
+    assert sessiondir.stat().st_mode & 0o777 == 0o700
+
+def test_session_unsupported(bmc):
+    auth = ('admin', 'password')
+    # A busy BMC is asked again next time
+    bmc(FakeSession(503))
+    assert Redfish._auth_token('bmc1', auth) is None
+    assert BmcProfile.get('bmc1', 'sessions') is None
+    # One without a SessionService is not
+    bmc(FakeSession(405))
+    assert Redfish._auth_token('bmc1', auth) is None
+    assert BmcProfile.get('bmc1', 'sessions') is False
+    assert Redfish._auth_token('bmc1', auth) is None
+
+class FakeJsonResponse(FakeResponse):
+    def __init__(self, status_code, data):
+        FakeResponse.__init__(self, status_code)
+        self.data = data
+
+    def json(self):
+        return self.data
+
+def test_expanded_members(bmc):
+    members = [{'@odata.id': '/redfish/v1/Systems/1', 'Id': '1'}]
+    assert Redfish._expanded_members('bmc1', FakeJsonResponse(200, {'Members': members})) == {'Systems/1': members[0]}
+    assert BmcProfile.get('bmc1', 'expand') is None
+
+    # Failures that may go away do not stop later commands from expanding
+    for status in [401, 503]:
+        assert Redfish._expanded_members('bmc1', FakeJsonResponse(status, {})) is None
+        assert BmcProfile.get('bmc1', 'expand') is None
+
+    for (host, response) in [('bmc2', FakeJsonResponse(400, {})),
+                             ('bmc3', FakeJsonResponse(501, {})),
+                             ('bmc4', FakeJsonResponse(200, {})),
+                             ('bmc5', FakeJsonResponse(200, {'Members': [{'@odata.id': '/redfish/v1/Systems/1'}]}))]:
+        assert Redfish._expanded_members(host, response) is None
+        assert BmcProfile.get(host, 'expand') is False
+
+def refused():
+    return requests.ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'Connection refused')))
+
+def reset():
+    return requests.ConnectionError(ProtocolError('Connection aborted.', http.client.RemoteDisconnected()))
+
+@pytest.fixture
+def send(monkeypatch):
+    monkeypatch.setattr(CircuitBreaker, 'hosts', dict())
+    monkeypatch.setattr(CircuitBreaker, 'settings', {'breaker_failures': 2, 'breaker_cooldown': 0})
+    monkeypatch.setattr(CircuitBreaker, 'loaded_settings', True)
+    replies = list()
+    def fake_send(cls, host, url, request_type, auth, token, data, headers, timeout):
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+    monkeypatch.setattr(Redfish, '_send', classmethod(fake_send))
+    return replies
+
+def request():
+    return Redfish._try_redfish_req('bmc1', 'https://bmc1/redfish/v1/', 'get', None, {}, {}, (5, 30))
+
+def test_circuit_breaker(send):
+    # Resets of pooled connections do not open the breaker
+    send.extend([reset(), reset(), reset()])
+    for i in range(3):
+        with pytest.raises(OOBTimeoutError) as e:
+            request()
+        assert not isinstance(e.value, OOBConnectError)
+        CircuitBreaker.check('bmc1')
+
+    send.extend([refused(), requests.ConnectTimeout()])
+    for i in range(2):
+        with pytest.raises(OOBConnectError):
+            request()
+    # Open, once the cooldown is over a single request goes through
+    CircuitBreaker.check('bmc1')
+    with pytest.raises(OOBUnreachableError):
+        CircuitBreaker.check('bmc1')
+
+    # A failed probe opens it again, one that connects closes it
+    send.extend([refused(), FakeResponse(200)])
+    with pytest.raises(OOBConnectError):
+        request()
+    CircuitBreaker.check('bmc1')
+    assert request().status_code == 200
+    assert 'bmc1' not in CircuitBreaker.hosts
+    CircuitBreaker.check('bmc1')
+    CircuitBreaker.check('bmc1')
+
+def test_systems_profile(bmc, monkeypatch):
+    requests = list()
+    def fake_req(cls, host, path, request_type, auth=None, **kwargs):
+        requests.append(path)
+        return FakeJsonResponse(200, {'Members': [{'@odata.id': '/redfish/v1/Systems/Self'}]})
+    monkeypatch.setattr(Redfish, '_do_redfish_req', classmethod(fake_req))
+    monkeypatch.setattr(BmcProfile, 'ttl', 3600)
+    node = {'name': 'node01', 'bmc': 'bmc1'}
+    assert RedfishBmc._redfish_get_systems(node, auth=('admin', 'password')) == ['Self']
+    assert RedfishBmc._redfish_get_systems(node, auth=('admin', 'password')) == ['Self']
+    assert requests == ['Systems']
+
+    # Discovered again once the saved list is too old
+    monkeypatch.setattr(BmcProfile, 'ttl', -1)
+    assert RedfishBmc._redfish_get_systems(node, auth=('admin', 'password')) == ['Self']
+    assert requests == ['Systems', 'Systems']
+
+def test_resource_cache(send):
+    send.extend([FakeResponse(200), FakeResponse(204), FakeResponse(200)])
+    with ResourceCache.scope():
+        first = Redfish._do_redfish_req('bmc1', 'Systems/1', 'get', None)
+        assert Redfish._do_redfish_req('bmc1', 'Systems/1', 'get', None) is first
+        # A change makes the next read go to the BMC
+        Redfish._do_redfish_req('bmc1', 'Systems/1/Actions/ComputerSystem.Reset', 'post', None)
+        assert Redfish._do_redfish_req('bmc1', 'Systems/1', 'get', None) is not first
+    assert send == []
+
+class Client(object):
+    pass
+
+def test_retries(send, monkeypatch):
+    monkeypatch.setattr(RequestPolicy, 'settings', dict(RequestPolicy.settings, retries=2, retry_delay=0, hedge=False))
+    monkeypatch.setattr(RequestPolicy, 'loaded_settings', True)
+    client = Client()
+    with RequestPolicy.scope(client):
+        # Reads are retried after server errors, up to retries times
+        send.extend([FakeResponse(503), FakeResponse(503), FakeResponse(503)])
+        assert Redfish._do_redfish_req('bmc1', 'Systems/1', 'get', None).status_code == 503
+        assert client.retries == 2
+        send.extend([reset(), FakeResponse(200)])
+        assert Redfish._do_redfish_req('bmc1', 'Systems/1', 'get', None).status_code == 200
+
+        # A change that may have reached the BMC is not sent again
+        send.extend([reset(), FakeResponse(204)])
+        with pytest.raises(OOBTimeoutError):
+            Redfish._do_redfish_req('bmc1', 'Systems/1/Actions/ComputerSystem.Reset', 'post', None)
+        send.clear()
+        send.extend([FakeResponse(503), FakeResponse(204)])
+        assert Redfish._do_redfish_req('bmc1', 'Systems/1/Actions/ComputerSystem.Reset', 'post', None).status_code == 503
+        send.clear()
+        # Unless no connection was made
+        send.extend([refused(), FakeResponse(204)])
+        assert Redfish._do_redfish_req('bmc1', 'Systems/1/Actions/ComputerSystem.Reset', 'post', None).status_code == 204
+    assert client.retries == 4
+
+def test_session_expired_on_bmc(bmc, send, monkeypatch):
+    session = bmc(FakeSession(201, 201))
+    tokens = list()
+    def fake_send(cls, host, url, request_type, auth, token, data, headers, timeout):
+        tokens.append(token)
+        return FakeResponse(401 if token == 'token1' else 200)
+    monkeypatch.setattr(Redfish, '_send', classmethod(fake_send))
+    response = Redfish._try_redfish_req('bmc1', 'https://bmc1/redfish/v1/', 'get', ('admin', 'password'), {}, {}, (5, 30))
+    assert response.status_code == 200
+    assert tokens == ['token1', 'token2']
+    # The rejected session is not logged out of
+    assert [x[0] for x in session.requests] == ['post', 'post']
+    assert Redfish.tokens['bmc1']['token'] == 'token2'
+
+def test_host_sessions(monkeypatch):
+    monkeypatch.setattr(Redfish, 'hostsessions', dict())
+    first = Redfish._session('bmc1')
+    assert Redfish._session('bmc1') is first
+    assert Redfish._session('bmc2') is not first
+    adapter = first.get_adapter('https://bmc1/redfish/v1/')
+    assert adapter._pool_maxsize == Redfish.settings['pool_size']
+
+def test_circuit_breaker_probe_error(send):
+    send.extend([refused(), refused()])
+    for i in range(2):
+        with pytest.raises(OOBConnectError):
+            request()
+    # A probe that fails for another reason lets the next request probe
+    for error in [requests.exceptions.ChunkedEncodingError(), requests.TooManyRedirects(), ValueError()]:
+        CircuitBreaker.check('bmc1')
+        send.append(error)
+        with pytest.raises(type(error)):
+            request()
+    CircuitBreaker.check('bmc1')
+    send.append(FakeResponse(200))
+    assert request().status_code == 200
+    assert 'bmc1' not in CircuitBreaker.hosts
@@ -0,0 +1,48 @@
+import os
+import pytest
+
+import phoenix
+from phoenix.snapshot import Snapshot
+
+def test_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(phoenix, 'cache_path', str(tmp_path / 'cache'))
+    source = tmp_path / 'test.yaml'
+    source.write_text('key1: valueA\n')
+
+    assert Snapshot.load_yaml(str(source)) == {'key1': 'valueA'}
+    snapfile = Snapshot._snapshot_file(str(source))
+    assert snapfile.exists()
+
+    # Unchanged files come from the snapshot
+    mtime = snapfile.stat().st_mtime_ns
+    assert Snapshot.load_yaml(str(source)) == {'key1': 'valueA'}
+    assert snapfile.stat().st_mtime_ns == mtime
+
+    # Changed files are parsed again
+    source.write_text('key1: valueB\nkey2: valueC\n')
+    assert Snapshot.load_yaml(str(source)) == {'key1': 'valueB', 'key2': 'valueC'}
+    assert Snapshot.load_yaml(str(source)) == {'key1': 'valueB', 'key2': 'valueC'}
+
+    with pytest.raises(IOError):
+        Snapshot.load_yaml(str(tmp_path / 'missing.yaml'))
+
+def test_snapshot_permissions(tmp_path, monkeypatch):
+    monkeypatch.setattr(phoenix, 'cache_path', str(tmp_path / 'cache'))
+    source = tmp_path / 'test.yaml'
+    source.write_text('key1: valueA\n')
+
+    Snapshot.load_yaml(str(source))
+    snapfile = Snapshot._snapshot_file(str(source))
+    assert snapfile.parent.stat().st_mode & 0o777 == 0o700
+    assert snapfile.stat().st_mode & 0o777 == 0o600
+
+    # A snapshot others could have written is never loaded
+    Snapshot._write(snapfile, {'stat': Snapshot._stat_key(source.stat()), 'sha256': None}, {'key1': 'planted'})
+    os.chmod(snapfile, 0o666)
+    assert Snapshot.load_yaml(str(source)) == {'key1': 'valueA'}
+
+    os.chmod(snapfile.parent, 0o777)
+    assert Snapshot._read(snapfile) is None
+    assert Snapshot.load_yaml(str(source)) == {'key1': 'valueA'}
+    # Writing a new snapshot makes the directory private again
+    assert snapfile.parent.stat().st_mode & 0o777 == 0o700
@@ -0,0 +1,40 @@
+import os
+
+from phoenix.watch import FileWatcher
+
+def test_filewatcher(tmp_path, monkeypatch):
+    monkeypatch.setattr(FileWatcher, 'watches', dict())
+    monkeypatch.setattr(FileWatcher, 'stats', dict())
+    reloaded = list()
+    def loader(name, files, depends=()):
+        def reload():
+            reloaded.append(name)
+            FileWatcher.watch(name, files, reload, depends)
+        FileWatcher.watch(name, files, reload, depends)
+
+    (tmp_path / 'a.yaml').write_text('a: 1\n')
+    (tmp_path / 'b.yaml').write_text('b: 1\n')
+    loader('templates', [], depends=['nodes'])
+    loader('nodes', [tmp_path / 'b.yaml'], depends=['system'])
+    loader('system', [tmp_path / 'a.yaml'])
+    assert FileWatcher.check() == []
+
+    # Dependents reload after what they depend on
+    (tmp_path / 'a.yaml').write_text('a: 2\n')
+    assert FileWatcher.check() == ['system', 'nodes', 'templates']
+    assert reloaded == ['system', 'nodes', 'templates']
+    assert FileWatcher.check() == []
+
+    os.unlink(tmp_path / 'b.yaml')
+    assert FileWatcher.check() == ['nodes', 'templates']
+
+def test_filewatcher_nodes(monkeypatch):
+    from phoenix.node import Node
+    monkeypatch.setattr(FileWatcher, 'watches', dict())
+    monkeypatch.setattr(FileWatcher, 'stats', dict())
+    Node.watch_nodes()
+    FileWatcher.watch('system', [], lambda: None)
+    FileWatcher.watch('cray_ex', [], lambda: None, depends=['system'])
+    # Nodes are rebuilt after the cray_ex layout they are placed with
+    assert FileWatcher._order(['system']) == ['system', 'cray_ex', 'nodes']
+    assert FileWatcher._order(['cray_ex']) == ['cray_ex', 'nodes']